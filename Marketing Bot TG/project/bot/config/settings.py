@@ -20,6 +20,19 @@ class Config:
     # Database settings
     DB_PATH = 'bot_database.db'
 
+    # Настройки SQLite (PRAGMA), можно переопределить для Colab/VPS
+    SQLITE_CACHE_KB = int(os.getenv("SQLITE_CACHE_KB", "65536"))  # 64 MiB страничного кэша
+    SQLITE_MMAP_BYTES = int(os.getenv("SQLITE_MMAP_BYTES", "268435456"))  # 256 MiB memory-mapped I/O
+    SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+    SQLITE_WAL_AUTOCHECKPOINT = int(os.getenv("SQLITE_WAL_AUTOCHECKPOINT", "1000"))
+    SQLITE_OPTIMIZE_INTERVAL = int(os.getenv("SQLITE_OPTIMIZE_INTERVAL", "900"))  # PRAGMA optimize раз в 15 минут
+    SQLITE_CHECKPOINT_INTERVAL = int(os.getenv("SQLITE_CHECKPOINT_INTERVAL", "300"))  # wal_checkpoint(TRUNCATE) раз в 5 минут
+    SQLITE_CACHED_STATEMENTS = int(os.getenv("SQLITE_CACHED_STATEMENTS", "256"))  # Размер кэша подготовленных запросов
+    SQLITE_READ_CONNECTIONS = int(os.getenv("SQLITE_READ_CONNECTIONS", str(min(os.cpu_count() or 1, 4))))  # Пул соединений для чтения
+
+    # Как часто накопленные счетчики сообщений записываются в БД (в секундах)
+    MESSAGE_COUNT_FLUSH_INTERVAL = float(os.getenv("MESSAGE_COUNT_FLUSH_INTERVAL", "2"))
+
     # Knowledge base settings
     PDF_STORAGE_PATH = 'knowledge_base_files'
     VECTOR_STORAGE_PATH = 'vector_storage'
@@ -31,30 +44,37 @@ class Config:
     # Опциональные ID администраторов для Telegram бота
     # Эти ID нужны только для доступа к загрузке через Telegram бота
     # При использовании программного интерфейса эти проверки не применяются
-    ADMIN_IDS = []
+    # frozenset: проверка `user_id in config.ADMIN_IDS` выполняется на каждом апдейте
+    ADMIN_IDS = frozenset()
     admin_ids_str = os.getenv("ADMIN_IDS", "")
     if admin_ids_str:
         try:
-            ADMIN_IDS = [int(id.strip()) for id in admin_ids_str.split(",") if id.strip()]
+            # int() сам отбрасывает пробелы вокруг числа, пустые элементы пропускаем
+            ADMIN_IDS = frozenset(map(int, filter(str.strip, admin_ids_str.split(","))))
         except ValueError:
-            logging.warning("Invalid ADMIN_IDS format in .env file. Using empty list.")
-
-    # Check if we're running in Google Colab
-    try:
-        from google.colab import drive
-        RUNNING_IN_COLAB = True
-        # Uncomment to use Google Drive for database
-        # drive.mount('/content/drive')
-        # DB_PATH = '/content/drive/MyDrive/Colab_Notebooks/bot_database.db'
-        # PDF_STORAGE_PATH = '/content/drive/MyDrive/Colab_Notebooks/knowledge_base_files'
-        # VECTOR_STORAGE_PATH = '/content/drive/MyDrive/Colab_Notebooks/vector_storage'
-    except ImportError:
-        RUNNING_IN_COLAB = False
+            logging.warning("Invalid ADMIN_IDS format in .env file. Using empty set.")
+
+    # Check if we're running in Google Colab (по переменным окружения, без попытки импорта google.colab)
+    RUNNING_IN_COLAB = 'COLAB_GPU' in os.environ or 'COLAB_RELEASE_TAG' in os.environ
+    # Uncomment to use Google Drive for database
+    # if RUNNING_IN_COLAB:
+    #     from google.colab import drive
+    #     drive.mount('/content/drive')
+    #     DB_PATH = '/content/drive/MyDrive/Colab_Notebooks/bot_database.db'
+    #     PDF_STORAGE_PATH = '/content/drive/MyDrive/Colab_Notebooks/knowledge_base_files'
+    #     VECTOR_STORAGE_PATH = '/content/drive/MyDrive/Colab_Notebooks/vector_storage'
+
+    # Размеры пулов HTTP-соединений: к Telegram Bot API (не меньше числа
+    # одновременных отправок рассылки) и к OpenAI API
+    TELEGRAM_CONNECTION_LIMIT = int(os.getenv("TELEGRAM_CONNECTION_LIMIT", "50"))
+    OPENAI_CONNECTION_LIMIT = int(os.getenv("OPENAI_CONNECTION_LIMIT", "20"))
 
     # OpenAI model settings
     GPT_MODEL = "gpt-4o"
     GPT_MAX_TOKENS = 3000
     GPT_TEMP = 0.7
+    # Сколько последних пар (сообщение, ответ) из истории чата передается в GPT
+    GPT_HISTORY_TURNS = int(os.getenv("GPT_HISTORY_TURNS", "10"))
 
     # Subscription limits
     SUBSCRIPTION_LIMITS = {
@@ -62,6 +82,11 @@ class Config:
         'premium': 500
     }
 
+    # Время жизни кэша статуса подписки и лимита сообщений (в секундах)
+    SUBSCRIPTION_CACHE_TTL = int(os.getenv("SUBSCRIPTION_CACHE_TTL", "60"))
+    # Сколько пользователей хранится в этом кэше
+    SUBSCRIPTION_CACHE_SIZE = int(os.getenv("SUBSCRIPTION_CACHE_SIZE", "100000"))
+
     # Payment settings
     PAYMENT_PROVIDER_TOKEN = os.getenv("PAYMENT_PROVIDER_TOKEN", "")
     YOOKASSA_SHOP_ID = os.getenv("YOOKASSA_SHOP_ID", "")
@@ -69,8 +94,8 @@ class Config:
     PAYMENT_RETURN_URL = os.getenv("PAYMENT_RETURN_URL", "https://t.me/your_bot_username")
     PAYMENT_CURRENCY = "RUB"
 
-    # Logging settings
-    LOG_LEVEL = logging.INFO
+    # Logging settings (по умолчанию WARNING, для отладки LOG_LEVEL=INFO или DEBUG в .env)
+    LOG_LEVEL = getattr(logging, os.getenv("LOG_LEVEL", "WARNING").upper(), logging.WARNING)
     LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 
     # Cleanup settings (in days)
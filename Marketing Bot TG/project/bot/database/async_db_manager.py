@@ -2,16 +2,121 @@
 Asynchronous database manager module for handling database operations with aiosqlite
 """
 import aiosqlite
+import asyncio
 import logging
 import datetime
 import os
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from urllib.parse import quote
 from bot.config import config
+from bot.utils.ttl_cache import TTLCache
+from bot.database.schema import (
+    SCHEMA_STATEMENTS, SQL_CHAT_TIMESTAMP, SQL_NOW, TIMESTAMP_MIGRATION, TIMESTAMP_MIGRATION_CHECK,
+    USERS_ADDED_COLUMNS, connection_pragmas
+)
 
 logger = logging.getLogger(__name__)
 
+# Отладочные сообщения на горячем пути используют ленивое форматирование
+# logger.debug("... %s", value): при выключенном DEBUG строка не собирается
+
 # Синглтон для AsyncDBManager
 _instance = None
 
+# Сколько неактивных пользователей удаляется за одну транзакцию очистки
+CLEANUP_BATCH_SIZE = 500
+
+# Сколько запросов из очереди enqueue_write фиксируется одним коммитом
+WRITE_BATCH_SIZE = 64
+# Предел очереди отложенной записи: при переполнении enqueue_write ждет, а не копит память
+WRITE_QUEUE_SIZE = 10000
+
+# SQL-запросы горячего пути (обработка каждого сообщения) собраны в одном месте,
+# чтобы их было удобно сверять с индексами в schema.py
+_SQL_INSERT_CHAT = f"""
+    INSERT INTO chat_history (user_id, message, response, timestamp)
+    VALUES (?1, ?2, ?3, {SQL_CHAT_TIMESTAMP})
+"""
+
+# Последние limit записей истории в хронологическом порядке, без NULL.
+# Внутренний запрос идет по первичному ключу (user_id, timestamp) с конца,
+# внешний только переворачивает уже отобранные строки
+_SQL_SELECT_CHAT_HISTORY = """
+    SELECT message, response FROM (
+        SELECT message, response, timestamp FROM chat_history
+        WHERE user_id = ? AND message IS NOT NULL AND response IS NOT NULL
+        ORDER BY timestamp DESC
+        LIMIT ?
+    )
+    ORDER BY timestamp
+"""
+
+# Подзапрос - поиск по частичному индексу idx_chat_pending
+# Ответ на известное сообщение: поиск по rowid, без перебора истории пользователя.
+# response IS NULL защищает от повторной записи ответа
+_SQL_UPDATE_RESPONSE_BY_ROWID = """
+    UPDATE chat_history SET response = ?
+    WHERE rowid = ? AND user_id = ? AND response IS NULL
+"""
+
+_SQL_UPDATE_PENDING_RESPONSE = """
+    UPDATE chat_history SET response = ?
+    WHERE rowid = (
+        SELECT rowid FROM chat_history
+        WHERE user_id = ? AND message = ? AND response IS NULL
+        ORDER BY timestamp DESC LIMIT 1
+    )
+"""
+
+_SQL_ENSURE_USER = f"""
+    INSERT OR IGNORE INTO users (user_id, messages_count, subscription_status, last_activity)
+    VALUES (?, 0, 'free', {SQL_NOW})
+"""
+
+_SQL_UPDATE_USER_ACTIVITY = f"""
+    INSERT INTO users (user_id, last_activity, subscription_status)
+    VALUES (?, {SQL_NOW}, 'free')
+    ON CONFLICT(user_id) DO UPDATE SET last_activity = excluded.last_activity, active = 1
+"""
+
+_SQL_FLUSH_MESSAGE_COUNTS = f"""
+    INSERT INTO users (user_id, messages_count, subscription_status, last_activity)
+    VALUES (?, ?, 'free', {SQL_NOW})
+    ON CONFLICT(user_id) DO UPDATE SET
+        messages_count = messages_count + excluded.messages_count,
+        last_activity = excluded.last_activity,
+        active = 1
+"""
+
+_SQL_SELECT_MESSAGE_COUNT = "SELECT messages_count FROM users WHERE user_id = ?"
+_SQL_COUNT_CHAT_HISTORY = "SELECT COUNT(*) FROM chat_history WHERE user_id = ?"
+
+_SQL_RESET_MESSAGE_COUNT = f"""
+    INSERT OR REPLACE INTO users
+    (user_id, messages_count, subscription_status, last_activity)
+    VALUES (?, ?,
+        COALESCE((SELECT subscription_status FROM users WHERE user_id = ?), 'free'),
+        {SQL_NOW}
+    )
+"""
+
+_SQL_SELECT_SUBSCRIPTION = "SELECT subscription_status, message_limit FROM users WHERE user_id = ?"
+
+# Счетчик, подписка и признак истекшей premium-подписки одним запросом (get_user_limits_snapshot)
+_SQL_SELECT_LIMITS_SNAPSHOT = f"""
+    SELECT messages_count, subscription_status, message_limit,
+        subscription_status = 'premium' AND subscription_expiry < {SQL_NOW} AS expired
+    FROM users WHERE user_id = ?
+"""
+
+_SQL_CHECK_SUBSCRIPTION_EXPIRY = f"""
+    SELECT subscription_status, subscription_expiry < {SQL_NOW} AS expired
+    FROM users WHERE user_id = ?
+"""
+
+_SQL_EXPIRE_SUBSCRIPTION = "UPDATE users SET subscription_status = 'free', message_limit = NULL WHERE user_id = ?"
+
 class AsyncDBManager:
     """Asynchronous database manager class for handling SQL operations, реализован как синглтон"""
 
@@ -32,7 +137,27 @@ class AsyncDBManager:
 
         # Инициализация атрибутов
         self.db_path = db_path or config.DB_PATH
+        # Единственное соединение для записи
         self.conn = None
+        # Пул read-only соединений: в режиме WAL чтения не ждут записи
+        self._readers = None
+        self._reader_conns = []
+        self._optimize_task = None
+        # Накопленные, но еще не записанные приращения счетчика сообщений: {user_id: delta}
+        self._pending_increments = defaultdict(int)
+        self._flush_task = None
+        # Отложенные запросы на запись (query, params): результат не нужен вызывающему
+        # коду, фоновая задача _write_loop выполняет их пачками в одной транзакции
+        self._write_queue = asyncio.Queue(maxsize=WRITE_QUEUE_SIZE)
+        self._write_task = None
+        # Сериализует запись через общее соединение, чтобы коммит одной корутины
+        # не закрыл чужую транзакцию (см. record_user_turn)
+        self._write_lock = asyncio.Lock()
+        # Кэш подписки: {user_id: (status, limit)}. Ограничен по размеру,
+        # истекшие записи вытесняются, а не копятся для каждого пользователя
+        self._sub_cache = TTLCache(config.SUBSCRIPTION_CACHE_SIZE, config.SUBSCRIPTION_CACHE_TTL)
+        # Блокировки по пользователю: при промахе кэша в БД идет только один запрос
+        self._sub_locks = defaultdict(asyncio.Lock)
         self.initialized = True
         logger.info(f"AsyncDBManager initialized with database path: {self.db_path}")
 
@@ -48,89 +173,278 @@ class AsyncDBManager:
                 os.makedirs(db_dir)
                 logger.info(f"Created directory for database: {db_dir}")
             
-            # Устанавливаем соединение
-            self.conn = await aiosqlite.connect(self.db_path)
-            
+            # Устанавливаем соединение. sqlite3 кэширует подготовленные запросы
+            # по тексту SQL, поэтому повторные вызовы execute_query не парсят SQL заново
+            # isolation_level=None - режим autocommit: одиночные запросы не обрастают
+            # неявными BEGIN/COMMIT, транзакции открываются явно через BEGIN IMMEDIATE
+            self.conn = await aiosqlite.connect(
+                self.db_path,
+                isolation_level=None,
+                cached_statements=config.SQLITE_CACHED_STATEMENTS
+            )
+
             # Включаем режим WAL и другие настройки
-            await self.conn.execute("PRAGMA journal_mode=WAL")
-            await self.conn.execute("PRAGMA synchronous=NORMAL")
-            await self.conn.execute("PRAGMA foreign_keys=ON")
-            
+            await self._apply_pragmas(self.conn)
+
             # Настройка соединения для поддержки возврата словарей
             self.conn.row_factory = aiosqlite.Row
-            
+
+            # Открываем read-only соединения после писателя: файл БД и WAL уже созданы.
+            # При переподключении писателя пул читателей остается прежним
+            if self._readers is None:
+                await self._open_readers()
+
+            # Периодически обновляем статистику планировщика запросов
+            if self._optimize_task is None:
+                self._optimize_task = asyncio.create_task(self._optimize_loop())
+
+            # Периодически записываем накопленные счетчики сообщений
+            if self._flush_task is None:
+                self._flush_task = asyncio.create_task(self._flush_loop())
+
+            # Выполняем отложенные запросы на запись
+            if self._write_task is None:
+                self._write_task = asyncio.create_task(self._write_loop())
+
             logger.info(f"Connected to database: {self.db_path} with WAL mode")
         except Exception as e:
             logger.error(f"Failed to connect to database: {e}")
             raise
 
-    async def execute_query(self, query, params=(), fetch=False):
-        """Execute an SQL query"""
+    async def _apply_pragmas(self, conn, readonly=False):
+        """Apply SQLite performance PRAGMAs to a connection"""
+        for pragma in connection_pragmas(readonly):
+            await conn.execute(pragma)
+
+    async def _open_readers(self):
+        """Открывает пул read-only соединений для запросов на чтение"""
+        uri = f"file:{quote(os.path.abspath(self.db_path))}?mode=ro"
+        self._readers = asyncio.Queue()
+        self._reader_conns = []
+        for _ in range(config.SQLITE_READ_CONNECTIONS):
+            reader = await aiosqlite.connect(
+                uri,
+                uri=True,
+                cached_statements=config.SQLITE_CACHED_STATEMENTS
+            )
+            await self._apply_pragmas(reader, readonly=True)
+            reader.row_factory = aiosqlite.Row
+            self._reader_conns.append(reader)
+            self._readers.put_nowait(reader)
+        logger.info(f"Opened {len(self._reader_conns)} read-only database connections")
+
+    @asynccontextmanager
+    async def _acquire_reader(self):
+        """Берет свободное read-only соединение из пула и возвращает его после запроса"""
+        readers = self._readers
+        reader = await readers.get()
+        try:
+            yield reader
+        finally:
+            readers.put_nowait(reader)
+
+    async def _optimize_loop(self):
+        """Фоновая задача: периодически выполняет PRAGMA optimize"""
+        while True:
+            await asyncio.sleep(config.SQLITE_OPTIMIZE_INTERVAL)
+            try:
+                if self.conn is not None:
+                    # Не вклиниваемся в открытую транзакцию другой корутины
+                    async with self._write_lock:
+                        await self.conn.execute("PRAGMA optimize")
+            except Exception as e:
+                logger.error(f"Error running PRAGMA optimize: {e}")
+
+    async def _flush_loop(self):
+        """Фоновая задача: периодически записывает накопленные счетчики сообщений"""
+        while True:
+            await asyncio.sleep(config.MESSAGE_COUNT_FLUSH_INTERVAL)
+            await self.flush_message_counts()
+
+    async def enqueue_write(self, query, params=()):
+        """Ставит запрос на запись в очередь, не дожидаясь его выполнения"""
         if self.conn is None:
             await self.connect()
-            
+        await self._write_queue.put((query, params))
+
+    async def flush_writes(self):
+        """Ждет выполнения всех запросов, поставленных в очередь enqueue_write"""
+        if self._write_task is not None:
+            await self._write_queue.join()
+
+    async def _write_loop(self):
+        """
+        Фоновая задача: забирает запросы из очереди и выполняет накопившиеся
+        (до WRITE_BATCH_SIZE) одной транзакцией - один коммит на пачку.
+        Под нагрузкой очередь заполняется, пока идет предыдущий коммит
+        """
+        while True:
+            batch = [await self._write_queue.get()]
+            while len(batch) < WRITE_BATCH_SIZE and not self._write_queue.empty():
+                batch.append(self._write_queue.get_nowait())
+            try:
+                await self._write_batch(batch)
+            finally:
+                for _ in batch:
+                    self._write_queue.task_done()
+
+    async def _write_batch(self, batch):
+        """Выполняет пачку запросов в одной транзакции"""
+        async with self._write_lock:
+            try:
+                await self.conn.execute("BEGIN IMMEDIATE")
+                for query, params in batch:
+                    # Ошибка одного запроса откатывает только его (SAVEPOINT), а не всю пачку
+                    await self.conn.execute("SAVEPOINT batch_item")
+                    try:
+                        await self.conn.execute(query, params)
+                    except Exception as e:
+                        logger.error(f"Database error: {e} Query: {query} Params: {params}")
+                        await self.conn.execute("ROLLBACK TO batch_item")
+                    await self.conn.execute("RELEASE batch_item")
+                await self.conn.execute("COMMIT")
+            except Exception as e:
+                logger.error(f"Failed to commit write batch of {len(batch)} queries: {e}")
+                try:
+                    await self.conn.rollback()
+                except Exception as e2:
+                    logger.error(f"Failed to rollback write batch: {e2}")
+
+    async def flush_message_counts(self):
+        """Записывает накопленные приращения messages_count одной транзакцией"""
+        if not self._pending_increments or self.conn is None:
+            return
+        deltas = self._pending_increments
+        self._pending_increments = defaultdict(int)
+
+        async with self._write_lock:
+            try:
+                await self.conn.execute("BEGIN IMMEDIATE")
+                await self.conn.executemany(
+                    _SQL_FLUSH_MESSAGE_COUNTS,
+                    deltas.items()
+                )
+                await self.conn.execute("COMMIT")
+                logger.debug("Flushed message counts for %s users", len(deltas))
+            except Exception as e:
+                logger.error(f"Error flushing message counts: {e}")
+                try:
+                    await self.conn.rollback()
+                except Exception as e2:
+                    logger.error(f"Failed to rollback message counts flush: {e2}")
+                # Возвращаем приращения, чтобы записать их при следующей попытке
+                for user_id, delta in deltas.items():
+                    self._pending_increments[user_id] += delta
+
+    async def execute_query(self, query, params=(), fetch=False, autocommit=True, rowcount=False, tuples=False,
+                            lastrowid=False):
+        """
+        Execute an SQL query.
+        Соединение для записи работает в режиме autocommit, одиночный запрос
+        фиксируется сразу. При autocommit=False блокировка записи не берется:
+        вызывающий код сам открыл транзакцию (BEGIN IMMEDIATE) и удерживает self._write_lock.
+        При rowcount=True запрос на запись возвращает число измененных строк вместо True.
+        При tuples=True строки выборки возвращаются обычными кортежами, а не aiosqlite.Row.
+        При lastrowid=True INSERT возвращает rowid добавленной строки.
+        """
+        if self.conn is None:
+            await self.connect()
+
+        if fetch:
+            return await self._fetch(query, params, tuples)
+        if autocommit:
+            async with self._write_lock:
+                return await self._execute(query, params, rowcount, lastrowid)
+        return await self._execute(query, params, rowcount, lastrowid)
+
+    async def _fetch(self, query, params, tuples=False):
+        """Выполняет запрос на чтение через пул read-only соединений"""
+        try:
+            async with self._acquire_reader() as reader:
+                async with reader.execute(query, params) as cursor:
+                    if tuples:
+                        # Фабрика строк применяется при fetch, поэтому ее можно сменить после execute
+                        cursor.row_factory = None
+                    # aiosqlite.Row поддерживает и row['col'], и row[0],
+                    # поэтому строки возвращаются без копирования в dict
+                    return await cursor.fetchall()
+        except Exception as e:
+            logger.error(f"Database error: {e} Query: {query} Params: {params}")
+            return None
+
+    async def _execute(self, query, params, rowcount=False, lastrowid=False):
+        """Выполняет запрос на запись без захвата блокировки записи"""
         try:
             async with self.conn.execute(query, params) as cursor:
-                if fetch:
-                    results = await cursor.fetchall()
-                    return [dict(row) for row in results]
-                await self.conn.commit()
-                return True
+                if lastrowid:
+                    return cursor.lastrowid
+                return cursor.rowcount if rowcount else True
         except Exception as e:
             logger.error(f"Database error: {e} Query: {query} Params: {params}")
-            # Попытка переподключения в случае ошибки
+            # Попытка переподключения писателя в случае ошибки
             try:
-                await self.close()
+                await self.conn.close()
+                self.conn = None
                 await self.connect()
                 logger.warning("Reconnected after error, but query was not re-executed.")
             except Exception as e2:
                 logger.error(f"Failed to reconnect after error: {e2}")
             return None
 
+    async def fetchone_scalar(self, query, params=()):
+        """Возвращает первую колонку первой строки результата или None"""
+        if self.conn is None:
+            await self.connect()
+
+        try:
+            async with self._acquire_reader() as reader:
+                async with reader.execute(query, params) as cursor:
+                    row = await cursor.fetchone()
+                    return row[0] if row else None
+        except Exception as e:
+            logger.error(f"Database error: {e} Query: {query} Params: {params}")
+            return None
+
     async def setup_database(self):
         """Create the database tables if they don't exist and ensure columns exist."""
-        # Таблица для истории чата
-        await self.execute_query('''
-        CREATE TABLE IF NOT EXISTS chat_history (
-            user_id INTEGER,
-            message TEXT,
-            response TEXT,
-            timestamp DATETIME,
-            PRIMARY KEY (user_id, timestamp)
-        )
-        ''')
-
-        # Таблица для данных пользователя
-        await self.execute_query('''
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            subscription_status TEXT DEFAULT 'free',
-            messages_count INTEGER DEFAULT 0,
-            message_limit INTEGER DEFAULT NULL,
-            last_activity DATETIME,
-            subscription_expiry DATETIME DEFAULT NULL
-        )
-        ''')
+        # Схема общая с синхронным DBManager (bot/database/schema.py)
+        for statement in SCHEMA_STATEMENTS:
+            await self.execute_query(statement)
 
         # Проверка и добавление колонок
-        await self.check_and_add_column('subscription_expiry', 'DATETIME DEFAULT NULL')
-        await self.check_and_add_column('message_limit', 'INTEGER DEFAULT NULL')
-
-        # Таблица для платежей
-        await self.execute_query('''
-        CREATE TABLE IF NOT EXISTS payments (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            payment_id TEXT NOT NULL,
-            subscription_type TEXT NOT NULL,
-            amount REAL NOT NULL,
-            status TEXT DEFAULT 'pending',
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        for column_name, column_type in USERS_ADDED_COLUMNS:
+            await self.check_and_add_column(column_name, column_type)
+
+        # Переводим время из TEXT в INTEGER в базах, созданных до этого изменения
+        if await self.execute_query(TIMESTAMP_MIGRATION_CHECK, fetch=True):
+            await self.migrate_timestamps()
+
+        # Собираем статистику для планировщика при первом запуске,
+        # дальше ее поддерживает периодический PRAGMA optimize
+        stats = await self.execute_query(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'",
+            fetch=True
         )
-        ''')
+        if not stats:
+            await self.execute_query("ANALYZE")
 
         logger.info("Database tables successfully set up")
 
+    async def migrate_timestamps(self):
+        """Перестраивает chat_history и users с INTEGER-временем в одной транзакции"""
+        logger.info("Migrating chat_history and users timestamps to INTEGER")
+        async with self._write_lock:
+            try:
+                await self.conn.execute("BEGIN IMMEDIATE")
+                for statement in TIMESTAMP_MIGRATION:
+                    await self.conn.execute(statement)
+                await self.conn.execute("COMMIT")
+                logger.info("Timestamps migrated to INTEGER")
+            except Exception as e:
+                logger.error(f"Failed to migrate timestamps: {e}")
+                await self.conn.rollback()
+                raise
+
     async def check_and_add_column(self, column_name, column_type):
         """Check if a column exists and add it if it doesn't"""
         try:
@@ -150,86 +464,123 @@ class AsyncDBManager:
         except Exception as e:
             logger.error(f"Error checking/adding column '{column_name}': {e}")
 
-    async def get_chat_history(self, user_id, limit=10):
-        """Get the chat history for a specific user, исключая записи с NULL ответами"""
+    async def get_chat_history(self, user_id, limit=None):
+        """
+        Get the chat history for a specific user: последние limit пар (message, response)
+        от старых к новым, без записей с NULL. По умолчанию limit = config.GPT_HISTORY_TURNS
+        """
+        if limit is None:
+            limit = config.GPT_HISTORY_TURNS
         results = await self.execute_query(
-            """
-            SELECT message, response FROM chat_history
-            WHERE user_id = ? AND response IS NOT NULL
-            ORDER BY timestamp DESC
-            LIMIT ?
-            """,
+            _SQL_SELECT_CHAT_HISTORY,
             (user_id, limit),
-            True
+            True,
+            tuples=True
         )
-        
-        # Преобразуем результат в формат, совместимый с предыдущим форматом
-        if results:
-            return [(item['message'], item['response']) for item in results]
-        return []
+        # Строки уже в нужном формате (message, response), без повторного копирования
+        return results or []
 
     async def save_chat_message(self, user_id, message, response=None):
         """
         Save a chat message and optionally a response to the database.
         Если response=None, сохраняется только сообщение пользователя.
+        Возвращает rowid записи (для update_chat_response) или None/False при ошибке.
         """
         try:
-            current_time = datetime.datetime.now()
-            # Используем отдельный SQL запрос в зависимости от наличия ответа
-            if response is None:
-                return await self.execute_query(
-                    "INSERT INTO chat_history (user_id, message, timestamp) VALUES (?, ?, ?)",
-                    (user_id, message, current_time)
-                )
-            else:
-                return await self.execute_query(
-                    "INSERT INTO chat_history (user_id, message, response, timestamp) VALUES (?, ?, ?, ?)",
-                    (user_id, message, response, current_time)
-                )
+            # Время записи вычисляет SQLite, без datetime и его адаптера в Python
+            return await self.execute_query(
+                _SQL_INSERT_CHAT,
+                (user_id, message, response),
+                lastrowid=True
+            )
         except Exception as e:
             logger.error(f"Error saving chat message for user {user_id}: {e}")
             return False
 
-    async def update_chat_response(self, user_id, message, response):
+    async def record_user_turn(self, user_id, message, response=None):
+        """
+        Сохраняет сообщение пользователя и создает его запись в users в одной
+        транзакции. Счетчик сообщений и активность обновляются отложенно
+        через increment_message_count.
+        Возвращает rowid сохраненного сообщения (передается в update_chat_response)
+        или False при ошибке.
+        """
+        if self.conn is None:
+            await self.connect()
+
+        async with self._write_lock:
+            try:
+                # BEGIN IMMEDIATE сразу берет блокировку записи и не дает
+                # транзакции упасть с SQLITE_BUSY при повышении уровня блокировки
+                await self.conn.execute("BEGIN IMMEDIATE")
+                rowid = await self.execute_query(
+                    _SQL_INSERT_CHAT,
+                    (user_id, message, response),
+                    autocommit=False,
+                    lastrowid=True
+                )
+                # Запись пользователя нужна сразу (get_user_message_count не должен
+                # пересчитывать счетчик по истории), для существующей это no-op
+                created = rowid and await self.execute_query(
+                    _SQL_ENSURE_USER,
+                    (user_id,),
+                    autocommit=False
+                )
+                if not created:
+                    # При ошибке execute_query уже переподключился, транзакция откатена
+                    logger.error(f"Failed to record message turn for user {user_id}")
+                    return False
+                await self.conn.execute("COMMIT")
+            except Exception as e:
+                logger.error(f"Error recording message turn for user {user_id}: {e}")
+                try:
+                    await self.conn.rollback()
+                except Exception as e2:
+                    logger.error(f"Failed to rollback message turn for user {user_id}: {e2}")
+                return False
+
+        if not await self.increment_message_count(user_id):
+            return False
+        return rowid
+
+    async def update_chat_response(self, user_id, message, response, rowid=None):
         """
         Update the response for a previously saved message.
         Используется для обновления записи, созданной с response=None.
+        rowid - значение, которое вернул record_user_turn/save_chat_message; без него
+        ищется последнее сообщение пользователя без ответа.
         """
         try:
             if response is None:
                 logger.warning(f"Attempted to update chat response with NULL for user {user_id}")
                 return False  # Не позволяем устанавливать NULL значения для ответа
                 
-            # Находим самое последнее сообщение от пользователя без ответа
-            result = await self.execute_query(
-                """
-                SELECT rowid FROM chat_history 
-                WHERE user_id = ? AND message = ? AND response IS NULL
-                ORDER BY timestamp DESC LIMIT 1
-                """,
-                (user_id, message),
-                True
-            )
-            
-            if not result:
-                logger.warning(f"No matching message found to update response for user {user_id}")
-                # Если запись не найдена, создаем новую запись с сообщением и ответом
-                return await self.save_chat_message(user_id, message, response)
-            
-            # Обновляем найденную запись
-            rowid = result[0]['rowid']
-            update_success = await self.execute_query(
-                "UPDATE chat_history SET response = ? WHERE rowid = ?",
-                (response, rowid)
-            )
+            if rowid:
+                updated = await self.execute_query(
+                    _SQL_UPDATE_RESPONSE_BY_ROWID,
+                    (response, rowid, user_id),
+                    rowcount=True
+                )
+            else:
+                # Обновляем самое последнее сообщение от пользователя без ответа одним
+                # запросом: подзапрос - поиск по индексу idx_chat_pending, и между поиском
+                # и обновлением не может вклиниться другая запись
+                updated = await self.execute_query(
+                    _SQL_UPDATE_PENDING_RESPONSE,
+                    (response, user_id, message),
+                    rowcount=True
+                )
             
-            if update_success:
-                logger.debug(f"Successfully updated chat response for message rowid {rowid}")
+            if updated:
+                logger.debug("Successfully updated chat response for user %s", user_id)
                 return True
+            
+            if updated == 0:
+                logger.warning(f"No matching message found to update response for user {user_id}")
             else:
-                logger.error(f"Failed to update chat response for message rowid {rowid}")
-                # Если обновление не удалось, пробуем создать новую запись
-                return await self.save_chat_message(user_id, message, response)
+                logger.error(f"Failed to update chat response for user {user_id}")
+            # Если запись не найдена или обновление не удалось, создаем новую запись с сообщением и ответом
+            return await self.save_chat_message(user_id, message, response)
         except Exception as e:
             logger.error(f"Error updating chat response for user {user_id}: {e}")
             # В случае ошибки, пробуем создать новую запись
@@ -240,75 +591,27 @@ class AsyncDBManager:
                 return False
 
     async def update_user_activity(self, user_id):
-        """Update or create a user's activity timestamp"""
-        current_time = datetime.datetime.now()
-        
-        # Проверяем, существует ли пользователь
-        user = await self.execute_query(
-            "SELECT 1 FROM users WHERE user_id = ?",
-            (user_id,),
-            True
-        )
-        
-        if not user:
-            # Если пользователя нет, создаем запись
-            return await self.execute_query(
-                "INSERT INTO users (user_id, last_activity, subscription_status) VALUES (?, ?, 'free')",
-                (user_id, current_time)
-            )
-        else:
-            # Обновляем существующую запись
-            return await self.execute_query(
-                "UPDATE users SET last_activity = ? WHERE user_id = ?",
-                (current_time, user_id)
-            )
+        """Update or create a user's activity timestamp (запись отложенная, через enqueue_write)"""
+        await self.enqueue_write(_SQL_UPDATE_USER_ACTIVITY, (user_id,))
+        return True
+
+    async def queue_chat_response(self, user_id, rowid, response):
+        """
+        Записывает ответ на сообщение с известным rowid (из record_user_turn) через
+        очередь записи, не дожидаясь выполнения
+        """
+        await self.enqueue_write(_SQL_UPDATE_RESPONSE_BY_ROWID, (response, rowid, user_id))
 
     async def increment_message_count(self, user_id):
         """
-        Increment the message count for a user using INSERT OR REPLACE.
-        Также убедимся, что запись пользователя создается, если она не существует.
+        Increment the message count for a user.
+        Приращение накапливается в памяти и записывается flush_message_counts раз
+        в MESSAGE_COUNT_FLUSH_INTERVAL секунд: K сообщений - один UPSERT вместо K.
+        Запись пользователя создается при сбросе, если она не существует.
         """
-        try:
-            # Определяем, существует ли запись для пользователя
-            user_exists = await self.execute_query(
-                "SELECT 1 FROM users WHERE user_id = ? LIMIT 1",
-                (user_id,),
-                True
-            )
-            current_time = datetime.datetime.now()
-            
-            # Если записи нет, создаем её с messages_count = 1
-            if not user_exists:
-                logger.info(f"Creating new user record for user_id {user_id}")
-                success = await self.execute_query(
-                    """
-                    INSERT INTO users 
-                    (user_id, messages_count, subscription_status, last_activity) 
-                    VALUES (?, 1, 'free', ?)
-                    """,
-                    (user_id, current_time)
-                )
-                if success:
-                    return True
-                else:
-                    logger.error(f"Failed to create new user record for user_id {user_id}")
-                    return False
-            
-            # Если запись существует, увеличиваем счетчик
-            success = await self.execute_query(
-                "UPDATE users SET messages_count = messages_count + 1, last_activity = ? WHERE user_id = ?",
-                (current_time, user_id)
-            )
-            
-            if success:
-                logger.debug(f"Successfully incremented count for user {user_id}")
-                return True
-            else:
-                logger.error(f"Failed to increment message count for user {user_id}")
-                return False
-        except Exception as e:
-            logger.error(f"Error incrementing message count for user {user_id}: {e}")
-            return False
+        self._pending_increments[user_id] += 1
+        logger.debug("Queued message count increment for user %s", user_id)
+        return True
 
     async def get_user_message_count(self, user_id):
         """
@@ -317,42 +620,33 @@ class AsyncDBManager:
         """
         try:
             # Получаем счетчик из таблицы users
-            result = await self.execute_query(
-                "SELECT messages_count FROM users WHERE user_id = ?",
-                (user_id,),
-                True
+            count = await self.fetchone_scalar(
+                _SQL_SELECT_MESSAGE_COUNT,
+                (user_id,)
             )
             
             # Если записи в users нет или счетчик NULL
-            if not result or result[0]['messages_count'] is None:
+            if count is None:
+                # Счетчик по истории уже включает еще не записанные приращения
+                self._pending_increments.pop(user_id, None)
                 # Подсчитываем сообщения из истории чата
-                count_from_history = await self.execute_query(
-                    "SELECT COUNT(*) as count FROM chat_history WHERE user_id = ?",
-                    (user_id,),
-                    True
-                )
-                
-                count = count_from_history[0]['count'] if count_from_history else 0
-                logger.debug(f"Got message count from chat_history for user {user_id}: {count}")
+                count = await self.fetchone_scalar(
+                    _SQL_COUNT_CHAT_HISTORY,
+                    (user_id,)
+                ) or 0
+                logger.debug("Got message count from chat_history for user %s: %s", user_id, count)
                 
                 # Создаем запись пользователя или обновляем счетчик, если есть расхождение
                 await self.execute_query(
-                    """
-                    INSERT OR REPLACE INTO users 
-                    (user_id, messages_count, subscription_status, last_activity) 
-                    VALUES (?, ?, 
-                        COALESCE((SELECT subscription_status FROM users WHERE user_id = ?), 'free'), 
-                        CURRENT_TIMESTAMP
-                    )
-                    """,
+                    _SQL_RESET_MESSAGE_COUNT,
                     (user_id, count, user_id)
                 )
                 
                 return count
             
-            # Возвращаем счетчик из таблицы users
-            count = result[0]['messages_count']
-            logger.debug(f"Got message count from users table for user {user_id}: {count}")
+            # Возвращаем счетчик из таблицы users с учетом еще не записанных приращений
+            count += self._pending_increments.get(user_id, 0)
+            logger.debug("Got message count from users table for user %s: %s", user_id, count)
             return count
         except Exception as e:
             logger.error(f"Error getting message count for user {user_id}: {e}")
@@ -360,24 +654,86 @@ class AsyncDBManager:
 
     async def get_subscription_status(self, user_id):
         """Get a user's subscription status"""
-        # Проверяем срок действия подписки
-        await self.check_subscription_expiry(user_id)
-        
+        status, _ = await self._get_subscription(user_id)
+        return status
+
+    async def _get_subscription(self, user_id):
+        """Возвращает (status, limit) пользователя из кэша, при промахе - из БД"""
+        entry = self._sub_cache.get(user_id)
+        if entry:
+            return entry
+
+        lock = self._sub_locks[user_id]
+        async with lock:
+            # Пока ждали блокировку, кэш мог заполнить другой запрос
+            entry = self._sub_cache.get(user_id)
+            if entry:
+                return entry
+
+            # Проверяем срок действия подписки
+            await self.check_subscription_expiry(user_id)
+
+            result = await self.execute_query(
+                _SQL_SELECT_SUBSCRIPTION,
+                (user_id,),
+                True
+            )
+            status, limit = self._resolve_subscription(
+                user_id,
+                result[0]['subscription_status'] if result else None,
+                result[0]['message_limit'] if result else None,
+                # Ошибку БД (None) не кэшируем
+                cache=result is not None
+            )
+        if not lock.locked():
+            self._sub_locks.pop(user_id, None)
+        return status, limit
+
+    def _resolve_subscription(self, user_id, status, limit, cache=True):
+        """Подставляет значения по умолчанию для строки users и кладет (status, limit) в кэш"""
+        status = status or 'free'
+        # Если индивидуальный лимит не установлен, берем лимит из настроек по статусу
+        if limit is None:
+            limit = config.SUBSCRIPTION_LIMITS.get(status, config.SUBSCRIPTION_LIMITS['free'])
+        if cache:
+            self._sub_cache.set(user_id, (status, limit))
+        return status, limit
+
+    async def get_user_limits_snapshot(self, user_id):
+        """
+        Возвращает (message_count, subscription_status, message_limit) для проверки лимита.
+        При промахе кэша подписки все три значения читаются одним запросом вместо трех.
+        Редкие случаи (нет строки users, истекшая подписка) обрабатывают обычные методы
+        """
+        entry = self._sub_cache.get(user_id)
+        if entry:
+            return await self.get_user_message_count(user_id), entry[0], entry[1]
+
         result = await self.execute_query(
-            "SELECT subscription_status FROM users WHERE user_id = ?",
+            _SQL_SELECT_LIMITS_SNAPSHOT,
             (user_id,),
             True
         )
-        
-        if result:
-            return result[0]['subscription_status']
-        return 'free'
+        if not result or result[0]['messages_count'] is None or result[0]['expired']:
+            status, limit = await self._get_subscription(user_id)
+            return await self.get_user_message_count(user_id), status, limit
+
+        row = result[0]
+        status, limit = self._resolve_subscription(user_id, row['subscription_status'], row['message_limit'])
+        # Учитываем еще не записанные приращения, как get_user_message_count
+        count = row['messages_count'] + self._pending_increments.get(user_id, 0)
+        return count, status, limit
+
+    def invalidate_subscription_cache(self, user_id):
+        """Сбрасывает кэш подписки пользователя после изменения его статуса или лимита"""
+        self._sub_cache.pop(user_id, None)
     
     async def check_subscription_expiry(self, user_id):
         """Проверяет и обновляет статус подписки, если срок истек"""
         try:
+            # Срок подписки сравнивает SQLite, без разбора даты в Python
             result = await self.execute_query(
-                "SELECT subscription_status, subscription_expiry FROM users WHERE user_id = ?",
+                _SQL_CHECK_SUBSCRIPTION_EXPIRY,
                 (user_id,),
                 True
             )
@@ -385,29 +741,18 @@ class AsyncDBManager:
             if not result:
                 return
             
-            status = result[0]['subscription_status']
-            expiry = result[0]['subscription_expiry']
-            
             # Если статус не premium или нет даты окончания, ничего не делаем
-            if status != 'premium' or not expiry:
+            # (для NULL срока expired тоже NULL)
+            if result[0]['subscription_status'] != 'premium' or not result[0]['expired']:
                 return
             
-            # Преобразуем строку в datetime объект, если это строка
-            if isinstance(expiry, str):
-                try:
-                    expiry = datetime.datetime.fromisoformat(expiry)
-                except ValueError:
-                    # Если формат даты некорректный, считаем что подписка действительна
-                    return
-            
-            # Проверяем, не истек ли срок подписки
-            if expiry and datetime.datetime.now() > expiry:
-                # Обновляем статус на бесплатный
-                await self.execute_query(
-                    "UPDATE users SET subscription_status = 'free', message_limit = NULL WHERE user_id = ?",
-                    (user_id,)
-                )
-                logger.info(f"Subscription expired for user {user_id}, changed to free")
+            # Срок подписки истек: обновляем статус на бесплатный
+            await self.execute_query(
+                _SQL_EXPIRE_SUBSCRIPTION,
+                (user_id,)
+            )
+            self.invalidate_subscription_cache(user_id)
+            logger.info(f"Subscription expired for user {user_id}, changed to free")
         except Exception as e:
             logger.error(f"Error checking subscription expiry for user {user_id}: {e}")
     
@@ -415,6 +760,9 @@ class AsyncDBManager:
         """Обновляет статус подписки пользователя"""
         try:
             if expiry_date:
+                # subscription_expiry хранится в секундах Unix
+                if isinstance(expiry_date, datetime.datetime):
+                    expiry_date = int(expiry_date.timestamp())
                 await self.execute_query(
                     "UPDATE users SET subscription_status = ?, subscription_expiry = ? WHERE user_id = ?",
                     (status, expiry_date, user_id)
@@ -424,6 +772,7 @@ class AsyncDBManager:
                     "UPDATE users SET subscription_status = ? WHERE user_id = ?",
                     (status, user_id)
                 )
+            self.invalidate_subscription_cache(user_id)
             return True
         except Exception as e:
             logger.error(f"Error updating subscription for user {user_id}: {e}")
@@ -431,37 +780,58 @@ class AsyncDBManager:
     
     async def get_message_limit(self, user_id):
         """Получает лимит сообщений для пользователя"""
-        result = await self.execute_query(
-            "SELECT message_limit FROM users WHERE user_id = ?",
-            (user_id,),
-            True
-        )
-        
-        # Если у пользователя установлен индивидуальный лимит
-        if result and result[0]['message_limit'] is not None:
-            return result[0]['message_limit']
-        
-        # Иначе берем лимит из настроек по статусу подписки
-        subscription = await self.get_subscription_status(user_id)
-        return config.SUBSCRIPTION_LIMITS.get(subscription, 50)
+        _, limit = await self._get_subscription(user_id)
+        return limit
 
     async def cleanup_inactive_chats(self, days=None):
         """Delete chat history and users who haven't been active for a while"""
         days = days or config.INACTIVE_CHAT_CLEANUP_DAYS
-        cutoff_date = datetime.datetime.now() - datetime.timedelta(days=days)
+        # Граница неактивности вычисляется в SQL, сравнение - целочисленное
+        cutoff = "CAST(strftime('%s', 'now', ?) AS INTEGER)"
+        offset = f'-{days} days'
 
         try:
-            # Delete chat history for inactive users
-            await self.execute_query(
-                "DELETE FROM chat_history WHERE user_id IN (SELECT user_id FROM users WHERE last_activity < ?)",
-                (cutoff_date,)
-            )
-            # Delete inactive users
-            await self.execute_query(
-                "DELETE FROM users WHERE last_activity < ?",
-                (cutoff_date,)
+            rows = await self.execute_query(
+                f"SELECT user_id FROM users WHERE last_activity < {cutoff}",
+                (offset,),
+                True
             )
-            logger.info(f"Cleaned up inactive chats older than {days} days")
+            if rows is None:
+                return False
+
+            # Удаляем пачками по CLEANUP_BATCH_SIZE пользователей: каждая пачка - своя
+            # короткая транзакция, между ними блокировка записи отпускается для
+            # обработчиков сообщений, а WAL не разрастается на всю очистку.
+            # Активность перепроверяется при удалении: пользователь мог написать
+            # боту уже после выборки
+            for start in range(0, len(rows), CLEANUP_BATCH_SIZE):
+                batch = [(row[0], offset) for row in rows[start:start + CLEANUP_BATCH_SIZE]]
+                async with self._write_lock:
+                    try:
+                        await self.conn.execute("BEGIN IMMEDIATE")
+                        # Delete chat history for inactive users
+                        await self.conn.executemany(
+                            f"""
+                            DELETE FROM chat_history WHERE user_id = ?
+                            AND (SELECT last_activity FROM users WHERE users.user_id = chat_history.user_id) < {cutoff}
+                            """,
+                            batch
+                        )
+                        # Delete inactive users
+                        await self.conn.executemany(
+                            f"DELETE FROM users WHERE user_id = ? AND last_activity < {cutoff}",
+                            batch
+                        )
+                        await self.conn.execute("COMMIT")
+                    except Exception:
+                        await self.conn.rollback()
+                        raise
+
+            # Возвращаем место, занятое WAL-файлом после массового удаления
+            async with self._write_lock:
+                await self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+            logger.info(f"Cleaned up {len(rows)} inactive users older than {days} days")
             return True
         except Exception as e:
             logger.error(f"Error during cleanup of inactive chats: {e}")
@@ -519,7 +889,29 @@ class AsyncDBManager:
 
     async def close(self):
         """Close the database connection"""
+        # Дописываем отложенные запросы до закрытия соединения
+        await self.flush_writes()
+        if self._write_task is not None:
+            self._write_task.cancel()
+            self._write_task = None
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        # Записываем накопленные счетчики, чтобы не потерять их при остановке
+        await self.flush_message_counts()
+        if self._optimize_task is not None:
+            self._optimize_task.cancel()
+            self._optimize_task = None
+        for reader in self._reader_conns:
+            await reader.close()
+        self._reader_conns = []
+        self._readers = None
         if self.conn:
+            # Рекомендация SQLite: перед закрытием обновить статистику там, где она устарела
+            try:
+                await self.conn.execute("PRAGMA optimize")
+            except Exception as e:
+                logger.warning(f"PRAGMA optimize failed on close: {e}")
             await self.conn.close()
             self.conn = None
             logger.info("Database connection closed") 
\ No newline at end of file
@@ -2,15 +2,83 @@
 Database manager module for handling database operations
 """
 import sqlite3
+import asyncio
 import logging
 import datetime
 import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import quote
 from bot.config import config
+from bot.utils.ttl_cache import TTLCache
+from bot.database.schema import (
+    SCHEMA_STATEMENTS, SQL_CHAT_TIMESTAMP, SQL_NOW, TIMESTAMP_MIGRATION, TIMESTAMP_MIGRATION_CHECK,
+    USERS_ADDED_COLUMNS, connection_pragmas
+)
 
 logger = logging.getLogger(__name__)
 
 # Синглтон для DBManager
 _instance = None
+# Защищает создание и инициализацию синглтона, если DBManager() вызывают из нескольких потоков
+_instance_lock = threading.Lock()
+
+# Сколько запросов из очереди фонового писателя фиксируется одним коммитом
+WRITE_BATCH_SIZE = 64
+
+# Размер пачки user_id при обходе пользователей (рассылка)
+USER_IDS_BATCH_SIZE = 500
+
+# timestamp в chat_history - миллисекунды Unix, уникальные в пределах пользователя
+_SQL_INSERT_CHAT = f"""
+    INSERT INTO chat_history (user_id, message, response, timestamp)
+    VALUES (?1, ?2, ?3, {SQL_CHAT_TIMESTAMP})
+"""
+
+# UPSERT вместо INSERT OR REPLACE: REPLACE удалял строку целиком и сбрасывал
+# messages_count, subscription_status и остальные колонки к значениям по умолчанию
+_SQL_UPDATE_USER_ACTIVITY = """
+    INSERT INTO users (user_id, last_activity) VALUES (?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET last_activity = excluded.last_activity, active = 1
+"""
+
+# Один UPSERT вместо SELECT + INSERT/UPDATE: один запрос и один коммит
+_SQL_INCREMENT_MESSAGE_COUNT = """
+    INSERT INTO users (user_id, messages_count, subscription_status, last_activity)
+    VALUES (?, 1, 'free', ?)
+    ON CONFLICT(user_id) DO UPDATE SET
+        messages_count = messages_count + 1,
+        last_activity = excluded.last_activity,
+        active = 1
+"""
+
+
+# Счетчик сообщений; если записи в users нет или счетчик NULL - число сообщений в истории.
+# missing = 1, когда счетчик нужно восстановить
+_SQL_SELECT_MESSAGE_COUNT = """
+    SELECT COALESCE(
+               (SELECT messages_count FROM users WHERE user_id = ?1),
+               (SELECT COUNT(*) FROM chat_history WHERE user_id = ?1)
+           ),
+           (SELECT messages_count FROM users WHERE user_id = ?1) IS NULL
+"""
+
+# Восстановление счетчика по истории. Если счетчик успел появиться (инкремент
+# выполнился раньше этой записи), он не перезаписывается
+_SQL_REPAIR_MESSAGE_COUNT = f"""
+    INSERT INTO users (user_id, messages_count, subscription_status, last_activity)
+    VALUES (?, ?, 'free', {SQL_NOW})
+    ON CONFLICT(user_id) DO UPDATE SET messages_count = excluded.messages_count
+    WHERE messages_count IS NULL
+"""
+
+
+def _set_future_result(future, result):
+    """Завершает future в его цикле событий (вызывается через call_soon_threadsafe)"""
+    if not future.done():
+        future.set_result(result)
 
 class DBManager:
     """Database manager class for handling SQL operations, реализован как синглтон"""
@@ -19,29 +87,62 @@ class DBManager:
         """Обеспечивает, что существует только один экземпляр класса"""
         global _instance
         if _instance is None:
-            logger.info("Creating new DBManager instance")
-            _instance = super(DBManager, cls).__new__(cls)
-            _instance.initialized = False  # Флаг для предотвращения повторной инициализации
+            with _instance_lock:
+                # Повторная проверка: другой поток мог создать экземпляр, пока мы ждали
+                if _instance is None:
+                    logger.info("Creating new DBManager instance")
+                    instance = super(DBManager, cls).__new__(cls)
+                    instance.initialized = False  # Флаг для предотвращения повторной инициализации
+                    _instance = instance
         return _instance
 
     def __init__(self, db_path=None):
         """Initialize the database manager with a connection to the database"""
         # Предотвращаем повторную инициализацию
-        if getattr(self, "initialized", False):
+        if self.initialized:
             return
+        # Второй поток ждет, пока первый закончит подключение и создание схемы
+        with _instance_lock:
+            if self.initialized:
+                return
 
-        # Инициализация атрибутов
-        self.db_path = db_path or config.DB_PATH
-        self.conn = None
-        self._connect()
-        self.setup_database()
-        
-        # Отмечаем, что экземпляр инициализирован
-        self.initialized = True
-        logger.info(f"DBManager initialized with database path: {self.db_path}")
+            # Инициализация атрибутов
+            self.db_path = db_path or config.DB_PATH
+            self.conn = None
+            # Основное соединение используют и цикл событий, и потоки asyncio.to_thread:
+            # запросы, транзакции и переподключение выполняются под этой блокировкой.
+            # RLock - внутри transaction() можно вызывать execute_query
+            self._conn_lock = threading.RLock()
+            # Поток, который сейчас держит transaction() (его SELECT должны видеть свои изменения)
+            self._tx_thread = None
+            # Пул read-only соединений: в WAL чтение идет параллельно с записью
+            self._readers = None
+            self._reader_conns = []
+            self._checkpoint_stop = threading.Event()
+            self._checkpoint_thread = None
+            # Очередь фонового писателя: (query, params, future, loop), None - остановка
+            self._write_queue = queue.Queue()
+            self._writer_thread = None
+            # Кэш подписки: {user_id: (status, limit, subscription_expiry)}, ограничен по размеру
+            self._sub_cache = TTLCache(config.SUBSCRIPTION_CACHE_SIZE, config.SUBSCRIPTION_CACHE_TTL)
+            self._connect()
+            self.setup_database()
+            # Читатели открываются после создания схемы: mode=ro не создает файл БД
+            self._open_readers()
+            self._start_checkpoint_thread()
+            self._start_writer_thread()
+
+            # Отмечаем, что экземпляр инициализирован
+            self.initialized = True
+            logger.info(f"DBManager initialized with database path: {self.db_path}")
 
     def _connect(self):
         """Establish a connection to the database"""
+        with self._conn_lock:
+            self._connect_locked()
+
+    def _connect_locked(self):
+        """Открывает основное соединение; вызывается под self._conn_lock"""
         try:
             # Создаем директорию для БД, если она не существует
             db_dir = os.path.dirname(self.db_path)
@@ -53,133 +154,327 @@ class DBManager:
             if self.conn:
                 self.conn.close()
                 
-            # Добавляем cached_statements=0 как workaround для бага Python 3.12+
+            # Кэш подготовленных запросов: одни и те же ~20 запросов не компилируются
+            # заново на каждый вызов (cached_statements=0 обходил падение при закрытии
+            # соединения в ранних Python 3.12, исправлено в 3.12.1)
             self.conn = sqlite3.connect(
                 self.db_path, 
                 check_same_thread=False, 
                 isolation_level=None, # Устанавливаем autocommit
-                cached_statements=0   # Отключаем кеширование стейтментов
+                cached_statements=config.SQLITE_CACHED_STATEMENTS
             )
-            self.conn.execute("PRAGMA journal_mode=WAL;") # Включаем WAL режим для лучшей конкурентности
-            logger.info(f"Connected to database: {self.db_path} with WAL mode and statement caching disabled")
+            # Те же PRAGMA, что и у AsyncDBManager: WAL, размер кэша, mmap и т.д.
+            for pragma in connection_pragmas():
+                self.conn.execute(pragma)
+            logger.info(f"Connected to database: {self.db_path} with WAL mode")
         except sqlite3.Error as e:
             logger.error(f"Failed to connect to database: {e}")
             raise
 
-    def execute_query(self, query, params=(), fetch=False):
-        """Execute an SQL query using the persistent connection, creating a new cursor each time."""
-        cursor = None # Инициализируем курсор как None
+    def _open_readers(self):
+        """Открывает пул read-only соединений для запросов на чтение"""
+        uri = f"file:{quote(os.path.abspath(self.db_path))}?mode=ro"
+        self._readers = queue.Queue()
+        self._reader_conns = []
+        try:
+            for _ in range(config.SQLITE_READ_CONNECTIONS):
+                reader = sqlite3.connect(
+                    uri,
+                    uri=True,
+                    check_same_thread=False,
+                    cached_statements=config.SQLITE_CACHED_STATEMENTS
+                )
+                for pragma in connection_pragmas(readonly=True):
+                    reader.execute(pragma)
+                self._reader_conns.append(reader)
+                self._readers.put_nowait(reader)
+            logger.info(f"Opened {len(self._reader_conns)} read-only database connections")
+        except sqlite3.Error as e:
+            # Без пула чтение идет через основное соединение
+            logger.error(f"Failed to open read-only connections: {e}")
+            self._close_readers()
+
+    def _close_readers(self):
+        """Закрывает пул read-only соединений"""
+        for reader in self._reader_conns:
+            try:
+                reader.close()
+            except sqlite3.Error as e:
+                logger.warning(f"Failed to close read-only connection: {e}")
+        self._reader_conns = []
+        self._readers = None
+
+    def _read(self, query, params=()):
+        """Выполняет SELECT на свободном read-only соединении из пула"""
+        readers = self._readers
+        reader = readers.get()
+        try:
+            return reader.execute(query, params).fetchall()
+        except sqlite3.Error as e:
+            logger.error(f"Database error: {e} Query: {query} Params: {params}")
+            return None
+        finally:
+            readers.put(reader)
+
+    def _start_checkpoint_thread(self):
+        """Запускает фоновый поток с периодическим PRAGMA wal_checkpoint(TRUNCATE)"""
+        if self._checkpoint_thread is not None:
+            return
+        self._checkpoint_thread = threading.Thread(
+            target=self._checkpoint_loop, name="sqlite-checkpoint", daemon=True
+        )
+        self._checkpoint_thread.start()
+
+    def _checkpoint_loop(self):
+        """
+        Переносит WAL в основной файл по расписанию, чтобы автоматический чекпоинт
+        не срабатывал посреди коммита обработчика сообщений и WAL не рос без границ.
+        Использует собственное соединение: чекпоинт действует на весь файл БД
+        """
+        conn = None
+        try:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            conn.execute(f"PRAGMA busy_timeout={config.SQLITE_BUSY_TIMEOUT_MS}")
+            while not self._checkpoint_stop.wait(config.SQLITE_CHECKPOINT_INTERVAL):
+                try:
+                    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                except sqlite3.Error as e:
+                    logger.warning(f"WAL checkpoint failed: {e}")
+        except sqlite3.Error as e:
+            logger.error(f"Failed to open checkpoint connection: {e}")
+        finally:
+            if conn:
+                conn.close()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Выполняет несколько запросов в одной транзакции (BEGIN IMMEDIATE ... COMMIT).
+        Соединение работает в autocommit, поэтому без этого каждый запрос коммитится отдельно.
+        Внутри блока используйте self.conn.execute: execute_query перехватывает ошибки
+        и переподключается, что оборвало бы транзакцию
+        """
+        with self._conn_lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self._tx_thread = threading.get_ident()
+            try:
+                yield self.conn
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            else:
+                self.conn.execute("COMMIT")
+            finally:
+                self._tx_thread = None
+
+    def _start_writer_thread(self):
+        """Запускает фоновый поток, выполняющий запросы из aexecute"""
+        if self._writer_thread is not None:
+            return
+        self._writer_thread = threading.Thread(
+            target=self._writer_loop, name="sqlite-writer", daemon=True
+        )
+        self._writer_thread.start()
+
+    def _writer_loop(self):
+        """
+        Забирает запросы из очереди и выполняет накопившиеся (до WRITE_BATCH_SIZE)
+        одной транзакцией: один коммит на пачку, и ожидание диска не блокирует
+        цикл событий aiogram. Ждать новые запросы для пачки не нужно: под нагрузкой
+        очередь заполняется, пока идет предыдущий коммит
+        """
+        conn = None
+        try:
+            conn = sqlite3.connect(
+                self.db_path,
+                check_same_thread=False,
+                isolation_level=None,
+                cached_statements=config.SQLITE_CACHED_STATEMENTS
+            )
+            for pragma in connection_pragmas():
+                conn.execute(pragma)
+        except sqlite3.Error as e:
+            logger.error(f"Failed to open writer connection: {e}")
+            conn = None
+
+        stopping = False
+        while not stopping:
+            item = self._write_queue.get()
+            if item is None:
+                break
+            batch = [item]
+            while len(batch) < WRITE_BATCH_SIZE:
+                try:
+                    item = self._write_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._write_batch(conn, batch)
+
+        if conn:
+            conn.close()
+
+    def _write_batch(self, conn, batch):
+        """Выполняет пачку запросов в одной транзакции и передает результаты в future"""
+        results = []
+        try:
+            if conn is None:
+                raise sqlite3.OperationalError("writer connection is not available")
+            conn.execute("BEGIN IMMEDIATE")
+            for query, params, future, loop in batch:
+                # Ошибка одного запроса откатывает только его (SAVEPOINT), а не всю пачку
+                conn.execute("SAVEPOINT batch_item")
+                try:
+                    conn.execute(query, params)
+                    results.append((future, loop, True))
+                except sqlite3.Error as e:
+                    logger.error(f"Database error: {e} Query: {query} Params: {params}")
+                    conn.execute("ROLLBACK TO batch_item")
+                    results.append((future, loop, None))
+                conn.execute("RELEASE batch_item")
+            conn.execute("COMMIT")
+        except sqlite3.Error as e:
+            logger.error(f"Failed to commit write batch of {len(batch)} queries: {e}")
+            if conn is not None and conn.in_transaction:
+                conn.execute("ROLLBACK")
+            results = [(future, loop, None) for _, _, future, loop in batch]
+
+        for future, loop, result in results:
+            if future is None:
+                # Запрос из enqueue_write, результат никто не ждет
+                continue
+            try:
+                loop.call_soon_threadsafe(_set_future_result, future, result)
+            except RuntimeError:
+                # Цикл событий уже закрыт, результат некому передать
+                pass
+
+    async def aexecute(self, query, params=()):
+        """
+        Выполняет запрос на запись в фоновом потоке, не блокируя цикл событий.
+        Возвращает True при успехе или None при ошибке, как execute_query
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._write_queue.put((query, params, future, loop))
+        return await future
+
+    def enqueue_write(self, query, params=()):
+        """Ставит запрос на запись в очередь фонового потока, не дожидаясь выполнения"""
+        self._write_queue.put((query, params, None, None))
+
+    def execute_query(self, query, params=(), fetch=False, rowcount=False, lastrowid=False):
+        """
+        Execute an SQL query using the persistent connection.
+        При rowcount=True запрос на запись возвращает число измененных строк вместо True.
+        При lastrowid=True INSERT возвращает rowid добавленной строки.
+        """
+        # SELECT идет в пул читателей: read-only соединение не может выполнить запись
+        # (в т.ч. INSERT ... RETURNING), а внутри своей транзакции нужно видеть свои изменения.
+        # Транзакцию проверяем по потоку: состояние общего соединения меняют и другие потоки
+        if (fetch and self._readers is not None and self._tx_thread != threading.get_ident()
+                and query.lstrip()[:6].upper() == "SELECT"):
+            return self._read(query, params)
+
+        with self._conn_lock:
+            return self._execute_locked(query, params, fetch, rowcount, lastrowid)
+
+    def _execute_locked(self, query, params, fetch, rowcount, lastrowid):
+        """Выполняет запрос на основном соединении; вызывается под self._conn_lock"""
         try:
             # Проверяем соединение перед выполнением
             if not self.conn:
                 logger.warning("Connection lost. Reconnecting...")
-                self._connect()
+                self._connect_locked()
                 if not self.conn:
                     logger.error("Failed to reconnect permanently.")
                     return None # Не удалось переподключиться
 
-            # Создаем новый курсор для этого запроса
-            cursor = self.conn.cursor()
-            cursor.execute(query, params)
-            # self.conn.commit() # Убираем явный коммит, так как используем autocommit (isolation_level=None)
+            # Connection.execute создает курсор сам; явный cursor()/close() для одного
+            # запроса не нужен - курсор освобождается сразу после возврата.
+            # Коммит не нужен: соединение в режиме autocommit (isolation_level=None)
+            cursor = self.conn.execute(query, params)
             if fetch:
-                results = cursor.fetchall()
-                return results
-            return True
+                return cursor.fetchall()
+            if lastrowid:
+                return cursor.lastrowid
+            # По умолчанию True: вызывающий код проверяет результат на истинность, а
+            # UPDATE без совпадений (rowcount 0) не ошибка
+            return cursor.rowcount if rowcount else True
         except (sqlite3.Error, AttributeError) as e:
             logger.error(f"Database error: {e} Query: {query} Params: {params}")
             # Попытка переподключения в случае ошибки
             try:
-                self._connect()
+                self._connect_locked()
                 logger.warning("Reconnected after error, but query was not re-executed.")
             except sqlite3.Error as e2:
                 logger.error(f"Failed to reconnect after error: {e2}")
             return None # Возвращаем None в случае ошибки
-        finally:
-            # Закрываем курсор, если он был создан
-            if cursor:
-                try:
-                    cursor.close()
-                except sqlite3.Error as e:
-                    logger.warning(f"Failed to close cursor: {e}")
 
     def setup_database(self):
         """Create the database tables if they don't exist and ensure columns exist."""
-        # Table for chat history
-        self.execute_query('''
-        CREATE TABLE IF NOT EXISTS chat_history (
-            user_id INTEGER,
-            message TEXT,
-            response TEXT,
-            timestamp DATETIME,
-            PRIMARY KEY (user_id, timestamp)
-        )
-        ''')
-
-        # Table for user data
-        self.execute_query('''
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            subscription_status TEXT DEFAULT 'free',
-            messages_count INTEGER DEFAULT 0,
-            message_limit INTEGER DEFAULT NULL,
-            last_activity DATETIME,
-            subscription_expiry DATETIME DEFAULT NULL
-        )
-        ''')
+        # Схема общая с AsyncDBManager (bot/database/schema.py), все DDL - одним коммитом
+        try:
+            with self.transaction() as conn:
+                for statement in SCHEMA_STATEMENTS:
+                    conn.execute(statement)
 
-        # Function to check and add column using a temporary connection
-        def check_and_add_column(column_name, column_type):
-            conn_check = None
-            try:
-                conn_check = sqlite3.connect(self.db_path, timeout=10)
-                cursor_check = conn_check.cursor()
-                cursor_check.execute(f"PRAGMA table_info(users)")
-                columns = [column[1] for column in cursor_check.fetchall()]
-                if column_name not in columns:
-                    logger.info(f"Adding missing column '{column_name}' to 'users' table.")
-                    # Use execute_query for the ALTER TABLE operation
-                    add_success = self.execute_query(f"ALTER TABLE users ADD COLUMN {column_name} {column_type};")
-                    if add_success:
-                        logger.info(f"Column '{column_name}' added successfully.")
-                    else:
-                        logger.error(f"Failed to add column '{column_name}' using execute_query.")
-            except Exception as e:
-                logger.error(f"Error checking/adding column '{column_name}': {e}")
-            finally:
-                if conn_check:
-                    try:
-                        conn_check.close()
-                    except Exception as close_e:
-                        logger.error(f"Error closing check connection for {column_name}: {close_e}")
-
-        # Проверка и добавление колонок
-        check_and_add_column('subscription_expiry', 'DATETIME DEFAULT NULL')
-        check_and_add_column('message_limit', 'INTEGER DEFAULT NULL')
-
-        # Table for payments
-        self.execute_query('''
-        CREATE TABLE IF NOT EXISTS payments (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            payment_id TEXT NOT NULL,
-            subscription_type TEXT NOT NULL,
-            amount REAL NOT NULL,
-            status TEXT DEFAULT 'pending',
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                # Проверка и добавление колонок: список колонок читаем один раз
+                # через основное соединение, в той же транзакции
+                columns = {row[1] for row in conn.execute("PRAGMA table_info(users)")}
+                for column_name, column_type in USERS_ADDED_COLUMNS:
+                    if column_name not in columns:
+                        logger.info(f"Adding missing column '{column_name}' to 'users' table.")
+                        conn.execute(f"ALTER TABLE users ADD COLUMN {column_name} {column_type}")
+        except sqlite3.Error as e:
+            logger.error(f"Failed to create database tables: {e}")
+            raise
+
+        # Переводим время из TEXT в INTEGER в базах, созданных до этого изменения
+        if self.execute_query(TIMESTAMP_MIGRATION_CHECK, fetch=True):
+            self.migrate_timestamps()
+
+        # Собираем статистику для планировщика при первом запуске (как AsyncDBManager)
+        stats = self.execute_query(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'",
+            fetch=True
         )
-        ''')
+        if not stats:
+            self.execute_query("ANALYZE")
 
         logger.info("Database tables successfully set up")
 
-    def get_chat_history(self, user_id, limit=10):
-        """Get the chat history for a specific user, исключая записи с NULL ответами"""
+    def migrate_timestamps(self):
+        """Перестраивает chat_history и users с INTEGER-временем в одной транзакции"""
+        logger.info("Migrating chat_history and users timestamps to INTEGER")
+        try:
+            with self.transaction() as conn:
+                for statement in TIMESTAMP_MIGRATION:
+                    conn.execute(statement)
+            logger.info("Timestamps migrated to INTEGER")
+        except sqlite3.Error as e:
+            logger.error(f"Failed to migrate timestamps: {e}")
+            raise
+
+    def get_chat_history(self, user_id, limit=None):
+        """
+        Get the chat history for a specific user: последние limit пар (message, response)
+        от старых к новым, без записей с NULL. По умолчанию limit = config.GPT_HISTORY_TURNS
+        """
+        if limit is None:
+            limit = config.GPT_HISTORY_TURNS
         results = self.execute_query(
             """
-            SELECT message, response FROM chat_history
-            WHERE user_id = ? AND response IS NOT NULL
-            ORDER BY timestamp DESC
-            LIMIT ?
+            SELECT message, response FROM (
+                SELECT message, response, timestamp FROM chat_history
+                WHERE user_id = ? AND message IS NOT NULL AND response IS NOT NULL
+                ORDER BY timestamp DESC
+                LIMIT ?
+            )
+            ORDER BY timestamp
             """,
             (user_id, limit),
             True
@@ -190,64 +485,81 @@ class DBManager:
         """
         Save a chat message and optionally a response to the database.
         Если response=None, сохраняется только сообщение пользователя.
+        Возвращает rowid записи (для update_chat_response) или None/False при ошибке.
         """
         try:
-            current_time = datetime.datetime.now()
-            # Используем отдельный SQL запрос в зависимости от наличия ответа
-            if response is None:
-                return self.execute_query(
-                    "INSERT INTO chat_history (user_id, message, timestamp) VALUES (?, ?, ?)",
-                    (user_id, message, current_time)
-                )
-            else:
-                return self.execute_query(
-                    "INSERT INTO chat_history (user_id, message, response, timestamp) VALUES (?, ?, ?, ?)",
-                    (user_id, message, response, current_time)
-                )
+            return self.execute_query(
+                _SQL_INSERT_CHAT,
+                (user_id, message, response),
+                lastrowid=True
+            )
         except Exception as e:
             logger.error(f"Error saving chat message for user {user_id}: {e}")
             return False
+
+    def save_chat_messages_many(self, rows):
+        """
+        Сохраняет несколько сообщений одним executemany в одной транзакции.
+        rows - последовательность кортежей (user_id, message, response).
+        Время каждой записи вычисляет SQLite, сообщения одного пользователя
+        в пачке получают возрастающие timestamp
+        """
+        rows = list(rows)
+        if not rows:
+            return True
+        try:
+            with self.transaction() as conn:
+                conn.executemany(_SQL_INSERT_CHAT, rows)
+            return True
+        except sqlite3.Error as e:
+            logger.error(f"Error saving {len(rows)} chat messages: {e}")
+            return False
     
-    def update_chat_response(self, user_id, message, response):
+    def update_chat_response(self, user_id, message, response, rowid=None):
         """
         Update the response for a previously saved message.
         Используется для обновления записи, созданной с response=None.
+        rowid - значение, которое вернул save_chat_message; без него ищется
+        последнее сообщение пользователя без ответа.
         """
         try:
             if response is None:
                 logger.warning(f"Attempted to update chat response with NULL for user {user_id}")
                 return False  # Не позволяем устанавливать NULL значения для ответа
-                
-            # Находим самое последнее сообщение от пользователя без ответа
-            result = self.execute_query(
-                """
-                SELECT rowid FROM chat_history 
-                WHERE user_id = ? AND message = ? AND response IS NULL
-                ORDER BY timestamp DESC LIMIT 1
-                """,
-                (user_id, message),
-                True
-            )
-            
-            if not result or not result[0]:
-                logger.warning(f"No matching message found to update response for user {user_id}")
-                # Если запись не найдена, создаем новую запись с сообщением и ответом
-                return self.save_chat_message(user_id, message, response)
-            
-            # Обновляем найденную запись
-            rowid = result[0][0]
-            update_success = self.execute_query(
-                "UPDATE chat_history SET response = ? WHERE rowid = ?",
-                (response, rowid)
-            )
-            
-            if update_success:
-                logger.debug(f"Successfully updated chat response for message rowid {rowid}")
+
+            if rowid:
+                # Известная запись: поиск по rowid, без перебора истории пользователя
+                updated = self.execute_query(
+                    "UPDATE chat_history SET response = ? WHERE rowid = ? AND user_id = ? AND response IS NULL",
+                    (response, rowid, user_id),
+                    rowcount=True
+                )
+            else:
+                # Самое последнее сообщение от пользователя без ответа: подзапрос -
+                # поиск по частичному индексу idx_chat_pending
+                updated = self.execute_query(
+                    """
+                    UPDATE chat_history SET response = ?
+                    WHERE rowid = (
+                        SELECT rowid FROM chat_history
+                        WHERE user_id = ? AND message = ? AND response IS NULL
+                        ORDER BY timestamp DESC LIMIT 1
+                    )
+                    """,
+                    (response, user_id, message),
+                    rowcount=True
+                )
+
+            if updated:
+                logger.debug(f"Successfully updated chat response for user {user_id}")
                 return True
+
+            if updated == 0:
+                logger.warning(f"No matching message found to update response for user {user_id}")
             else:
-                logger.error(f"Failed to update chat response for message rowid {rowid}")
-                # Если обновление не удалось, пробуем создать новую запись
-                return self.save_chat_message(user_id, message, response)
+                logger.error(f"Failed to update chat response for user {user_id}")
+            # Если запись не найдена или обновление не удалось, создаем новую запись с сообщением и ответом
+            return self.save_chat_message(user_id, message, response)
         except Exception as e:
             logger.error(f"Error updating chat response for user {user_id}: {e}")
             # В случае ошибки, пробуем создать новую запись
@@ -259,48 +571,21 @@ class DBManager:
 
     def update_user_activity(self, user_id):
         """Update or create a user's activity timestamp"""
-        current_time = datetime.datetime.now()
-        return self.execute_query(
-            "INSERT OR REPLACE INTO users (user_id, last_activity) VALUES (?, ?)",
-            (user_id, current_time)
-        )
+        current_time = int(time.time())
+        return self.execute_query(_SQL_UPDATE_USER_ACTIVITY, (user_id, current_time))
+
+    async def update_user_activity_async(self, user_id):
+        """update_user_activity через фоновый поток записи (для обработчиков aiogram)"""
+        return await self.aexecute(_SQL_UPDATE_USER_ACTIVITY, (user_id, int(time.time())))
 
     def increment_message_count(self, user_id):
         """
-        Increment the message count for a user using INSERT OR REPLACE.
-        Также убедимся, что запись пользователя создается, если она не существует.
+        Increment the message count for a user.
+        Запись пользователя создается с messages_count = 1, если она не существует
         """
         try:
-            # Определяем, существует ли запись для пользователя
-            user_exists = self.execute_query(
-                "SELECT 1 FROM users WHERE user_id = ? LIMIT 1",
-                (user_id,),
-                True
-            )
-            current_time = datetime.datetime.now()
-            
-            # Если записи нет, создаем её с messages_count = 1
-            if not user_exists:
-                logger.info(f"Creating new user record for user_id {user_id}")
-                success = self.execute_query(
-                    """
-                    INSERT INTO users 
-                    (user_id, messages_count, subscription_status, last_activity) 
-                    VALUES (?, 1, 'free', ?)
-                    """,
-                    (user_id, current_time)
-                )
-                if success:
-                    return True
-                else:
-                    logger.error(f"Failed to create new user record for user_id {user_id}")
-                    return False
-            
-            # Если запись существует, увеличиваем счетчик
-            success = self.execute_query(
-                "UPDATE users SET messages_count = messages_count + 1, last_activity = ? WHERE user_id = ?",
-                (current_time, user_id)
-            )
+            current_time = int(time.time())
+            success = self.execute_query(_SQL_INCREMENT_MESSAGE_COUNT, (user_id, current_time))
             
             if success:
                 logger.debug(f"Successfully incremented count for user {user_id}")
@@ -312,65 +597,178 @@ class DBManager:
             logger.error(f"Error incrementing message count for user {user_id}: {e}")
             return False
 
+    async def increment_message_count_async(self, user_id):
+        """increment_message_count через фоновый поток записи (для обработчиков aiogram)"""
+        success = await self.aexecute(_SQL_INCREMENT_MESSAGE_COUNT, (user_id, int(time.time())))
+        if not success:
+            logger.error(f"Failed to increment message count for user {user_id}")
+            return False
+        return True
+
     def get_user_message_count(self, user_id):
         """
         Get the number of messages a user has sent.
         Если запись в таблице users отсутствует, считаем сообщения из истории чата.
         """
         try:
-            # Получаем счетчик из таблицы users
-            result = self.execute_query(
-                "SELECT messages_count FROM users WHERE user_id = ?",
-                (user_id,),
-                True
-            )
-            
-            # Если записи в users нет или счетчик NULL
-            if not result or not result[0] or result[0][0] is None:
-                # Подсчитываем сообщения из истории чата
-                count_from_history = self.execute_query(
-                    "SELECT COUNT(*) FROM chat_history WHERE user_id = ?",
-                    (user_id,),
-                    True
-                )
-                
-                count = count_from_history[0][0] if count_from_history and count_from_history[0] else 0
+            # Один запрос: COALESCE вычисляет COUNT(*) по истории, только если счетчика нет
+            result = self.execute_query(_SQL_SELECT_MESSAGE_COUNT, (user_id,), True)
+            if not result:
+                return 0
+            count, missing = result[0]
+
+            if missing:
+                # Записываем восстановленный счетчик в фоне, чтение остается одним запросом
                 logger.debug(f"Got message count from chat_history for user {user_id}: {count}")
-                
-                # Создаем запись пользователя или обновляем счетчик, если есть расхождение
-                self.execute_query(
-                    """
-                    INSERT OR REPLACE INTO users 
-                    (user_id, messages_count, subscription_status, last_activity) 
-                    VALUES (?, ?, 
-                        (SELECT subscription_status FROM users WHERE user_id = ? UNION ALL SELECT 'free' LIMIT 1), 
-                        CURRENT_TIMESTAMP
-                    )
-                    """,
-                    (user_id, count, user_id)
-                )
-                
-                return count
-            
-            # Возвращаем счетчик из таблицы users
-            count = result[0][0]
-            logger.debug(f"Got message count from users table for user {user_id}: {count}")
+                self.enqueue_write(_SQL_REPAIR_MESSAGE_COUNT, (user_id, count))
+            else:
+                logger.debug(f"Got message count from users table for user {user_id}: {count}")
             return count
         except Exception as e:
             logger.error(f"Error getting message count for user {user_id}: {e}")
             return 0
 
+    def iter_user_ids(self, batch_size=USER_IDS_BATCH_SIZE, broadcast_id=None):
+        """
+        Генератор списков user_id пачками по batch_size, без загрузки всей таблицы в память.
+        Каждая пачка - отдельный запрос с продолжением по первичному ключу (user_id > последний),
+        поэтому между пачками не держится открытый курсор: соединение из пула освобождается,
+        а долгая рассылка не удерживает снимок WAL и не мешает чекпоинтам.
+        Пользователи, заблокировавшие бота (active = 0), пропускаются.
+        С broadcast_id пропускаются и пользователи, которым эта рассылка уже доставлена
+        """
+        delivered_filter = ""
+        filter_params = ()
+        if broadcast_id is not None:
+            delivered_filter = (
+                " AND NOT EXISTS (SELECT 1 FROM broadcast_deliveries d"
+                " WHERE d.broadcast_id = ? AND d.user_id = users.user_id)"
+            )
+            filter_params = (broadcast_id,)
+
+        last_id = None
+        while True:
+            if last_id is None:
+                rows = self.execute_query(
+                    f"SELECT user_id FROM users WHERE active = 1{delivered_filter} ORDER BY user_id LIMIT ?",
+                    filter_params + (batch_size,),
+                    fetch=True
+                )
+            else:
+                rows = self.execute_query(
+                    f"SELECT user_id FROM users WHERE user_id > ? AND active = 1{delivered_filter} "
+                    "ORDER BY user_id LIMIT ?",
+                    (last_id,) + filter_params + (batch_size,),
+                    fetch=True
+                )
+            if not rows:
+                return
+            yield [row[0] for row in rows]
+            if len(rows) < batch_size:
+                return
+            last_id = rows[-1][0]
+
+    def create_broadcast(self, message, from_chat_id, message_id):
+        """
+        Сохраняет новую рассылку исходного сообщения (from_chat_id, message_id),
+        возвращает ее broadcast_id или None при ошибке
+        """
+        return self.execute_query(
+            "INSERT INTO broadcasts (message, from_chat_id, message_id, created_at) "
+            f"VALUES (?, ?, ?, {SQL_NOW})",
+            (message, from_chat_id, message_id),
+            lastrowid=True
+        )
+
+    def get_unfinished_broadcast(self):
+        """Последняя незавершенная рассылка: (broadcast_id, from_chat_id, message_id) или None"""
+        rows = self.execute_query(
+            "SELECT broadcast_id, from_chat_id, message_id FROM broadcasts WHERE status = 'running' "
+            "ORDER BY broadcast_id DESC LIMIT 1",
+            fetch=True
+        )
+        return rows[0] if rows else None
+
+    def count_broadcast_recipients(self, broadcast_id):
+        """Сколько пользователей еще не получили рассылку"""
+        rows = self.execute_query(
+            """
+            SELECT COUNT(*) FROM users WHERE active = 1 AND NOT EXISTS (
+                SELECT 1 FROM broadcast_deliveries d
+                WHERE d.broadcast_id = ? AND d.user_id = users.user_id
+            )
+            """,
+            (broadcast_id,),
+            fetch=True
+        )
+        return rows[0][0] if rows else 0
+
+    def mark_broadcast_delivered(self, broadcast_id, user_id):
+        """
+        Отмечает доставку рассылки пользователю. Запись идет через фоновый писатель
+        пачками по WRITE_BATCH_SIZE: при падении процесса теряются только последние
+        отметки, и повторно сообщение получат лишь несколько пользователей
+        """
+        self.enqueue_write(
+            "INSERT OR IGNORE INTO broadcast_deliveries (broadcast_id, user_id) VALUES (?, ?)",
+            (broadcast_id, user_id)
+        )
+
+    def deactivate_users(self, user_ids):
+        """
+        Помечает пользователей неактивными (бот заблокирован): рассылки их пропускают.
+        Один UPDATE на каждые USER_IDS_BATCH_SIZE пользователей; запросы идут через
+        фоновый писатель и фиксируются общим коммитом
+        """
+        user_ids = list(user_ids)
+        for start in range(0, len(user_ids), USER_IDS_BATCH_SIZE):
+            chunk = user_ids[start:start + USER_IDS_BATCH_SIZE]
+            placeholders = ", ".join("?" * len(chunk))
+            self.enqueue_write(f"UPDATE users SET active = 0 WHERE user_id IN ({placeholders})", chunk)
+
+    def finish_broadcast(self, broadcast_id):
+        """Помечает рассылку завершенной (после всех отметок о доставке в очереди писателя)"""
+        self.enqueue_write(
+            "UPDATE broadcasts SET status = 'done' WHERE broadcast_id = ?",
+            (broadcast_id,)
+        )
+
     def get_subscription_status(self, user_id):
         """Get a user's subscription status"""
-        # Проверяем срок действия подписки
-        self.check_subscription_expiry(user_id)
-        
+        status, _ = self._get_subscription(user_id)
+        return status
+
+    def _get_subscription(self, user_id):
+        """Возвращает (status, limit) пользователя из кэша, при промахе - из БД"""
+        entry = self._sub_cache.get(user_id)
+        # Кэш действителен TTL секунд и не дольше срока самой подписки
+        if entry and not (entry[2] and time.time() > entry[2]):
+            return entry[0], entry[1]
+
+        # Статус, лимит и срок - одним запросом; истекшую подписку переводим на free
         result = self.execute_query(
-            "SELECT subscription_status FROM users WHERE user_id = ?",
+            "SELECT subscription_status, message_limit, subscription_expiry FROM users WHERE user_id = ?",
             (user_id,),
             True
         )
-        return result[0][0] if result and result[0] else 'free'
+        status, limit, expiry = result[0] if result else (None, None, None)
+        status = status or 'free'
+        if status == 'premium' and expiry and time.time() > expiry:
+            self._expire_subscription(user_id)
+            status, limit, expiry = 'free', None, None
+
+        # Если индивидуальный лимит не установлен, берем лимит из настроек по статусу
+        if not limit:
+            limit = config.SUBSCRIPTION_LIMITS.get(status, config.SUBSCRIPTION_LIMITS['free'])
+
+        # Ошибку БД (None) не кэшируем
+        if result is not None:
+            self._sub_cache.set(user_id, (status, limit, expiry))
+        return status, limit
+
+    def invalidate_subscription_cache(self, user_id):
+        """Сбрасывает кэш подписки пользователя после изменения его статуса или лимита"""
+        self._sub_cache.pop(user_id, None)
     
     def check_subscription_expiry(self, user_id):
         """Проверяет и обновляет статус подписки, если срок истек"""
@@ -390,29 +788,28 @@ class DBManager:
             if status != 'premium' or not expiry:
                 return
             
-            # Преобразуем строку в datetime объект, если это строка
-            if isinstance(expiry, str):
-                try:
-                    expiry = datetime.datetime.fromisoformat(expiry)
-                except ValueError:
-                    # Если формат даты некорректный, считаем что подписка действительна
-                    return
-            
-            # Проверяем, не истек ли срок подписки
-            if expiry and datetime.datetime.now() > expiry:
-                # Обновляем статус на бесплатный
-                self.execute_query(
-                    "UPDATE users SET subscription_status = 'free', message_limit = NULL WHERE user_id = ?",
-                    (user_id,)
-                )
-                logger.info(f"Subscription expired for user {user_id}, changed to free")
+            # Проверяем, не истек ли срок подписки (срок хранится в секундах Unix)
+            if time.time() > expiry:
+                self._expire_subscription(user_id)
         except Exception as e:
             logger.error(f"Error checking subscription expiry for user {user_id}: {e}")
+
+    def _expire_subscription(self, user_id):
+        """Переводит пользователя с истекшей подпиской на бесплатный тариф"""
+        self.execute_query(
+            "UPDATE users SET subscription_status = 'free', message_limit = NULL WHERE user_id = ?",
+            (user_id,)
+        )
+        self.invalidate_subscription_cache(user_id)
+        logger.info(f"Subscription expired for user {user_id}, changed to free")
     
     def update_subscription(self, user_id, status, expiry_date=None):
         """Обновляет статус подписки пользователя"""
         try:
             if expiry_date:
+                # subscription_expiry хранится в секундах Unix
+                if isinstance(expiry_date, datetime.datetime):
+                    expiry_date = int(expiry_date.timestamp())
                 self.execute_query(
                     "UPDATE users SET subscription_status = ?, subscription_expiry = ? WHERE user_id = ?",
                     (status, expiry_date, user_id)
@@ -422,6 +819,7 @@ class DBManager:
                     "UPDATE users SET subscription_status = ? WHERE user_id = ?",
                     (status, user_id)
                 )
+            self.invalidate_subscription_cache(user_id)
             return True
         except Exception as e:
             logger.error(f"Error updating subscription for user {user_id}: {e}")
@@ -429,36 +827,29 @@ class DBManager:
     
     def get_message_limit(self, user_id):
         """Получает лимит сообщений для пользователя"""
-        result = self.execute_query(
-            "SELECT message_limit FROM users WHERE user_id = ?",
-            (user_id,),
-            True
-        )
-        
-        # Если у пользователя установлен индивидуальный лимит
-        if result and result[0] and result[0][0]:
-            return result[0][0]
-        
-        # Иначе берем лимит из настроек по статусу подписки
-        subscription = self.get_subscription_status(user_id)
-        return config.SUBSCRIPTION_LIMITS.get(subscription, 50)
+        _, limit = self._get_subscription(user_id)
+        return limit
 
     def cleanup_inactive_chats(self, days=None):
         """Delete chat history and users who haven't been active for a while"""
         days = days or config.INACTIVE_CHAT_CLEANUP_DAYS
-        cutoff_date = datetime.datetime.now() - datetime.timedelta(days=days)
+        cutoff_date = int(time.time()) - days * 86400
 
         try:
-            # Delete chat history for inactive users
-            self.execute_query(
-                "DELETE FROM chat_history WHERE user_id IN (SELECT user_id FROM users WHERE last_activity < ?)",
-                (cutoff_date,)
-            )
-            # Delete inactive users
-            self.execute_query(
-                "DELETE FROM users WHERE last_activity < ?",
-                (cutoff_date,)
-            )
+            # Оба DELETE в одной транзакции: один коммит вместо двух, и история не
+            # удаляется без пользователя (или наоборот), если второй запрос упадет.
+            # Подзапрос идет по idx_users_last_activity, удаление истории - по первичному ключу
+            with self.transaction() as conn:
+                # Delete chat history for inactive users
+                conn.execute(
+                    "DELETE FROM chat_history WHERE user_id IN (SELECT user_id FROM users WHERE last_activity < ?)",
+                    (cutoff_date,)
+                )
+                # Delete inactive users
+                conn.execute(
+                    "DELETE FROM users WHERE last_activity < ?",
+                    (cutoff_date,)
+                )
             logger.info(f"Cleaned up inactive chats older than {days} days")
             return True
         except Exception as e:
@@ -517,7 +908,23 @@ class DBManager:
 
     def close(self):
         """Close the database connection"""
-        if self.conn:
-            self.conn.close()
-            self.conn = None
-            logger.info("Database connection closed")
+        if self._checkpoint_thread is not None:
+            self._checkpoint_stop.set()
+            self._checkpoint_thread.join(timeout=5)
+            self._checkpoint_thread = None
+        if self._writer_thread is not None:
+            # Писатель выполнит запросы, поставленные в очередь до остановки
+            self._write_queue.put(None)
+            self._writer_thread.join(timeout=5)
+            self._writer_thread = None
+        self._close_readers()
+        with self._conn_lock:
+            if self.conn:
+                # Рекомендация SQLite: перед закрытием обновить статистику там, где она устарела
+                try:
+                    self.conn.execute("PRAGMA optimize")
+                except sqlite3.Error as e:
+                    logger.warning(f"PRAGMA optimize failed on close: {e}")
+                self.conn.close()
+                self.conn = None
+                logger.info("Database connection closed")
@@ -0,0 +1,208 @@
+"""
+Общая схема базы данных и настройки SQLite для DBManager и AsyncDBManager
+"""
+from bot.config import config
+
+# Время хранится в INTEGER: users.* - секунды Unix, chat_history.timestamp - миллисекунды
+# (секунд недостаточно для первичного ключа (user_id, timestamp)).
+# unixepoch() появился только в SQLite 3.38, поэтому используем strftime/julianday
+SQL_NOW = "CAST(strftime('%s', 'now') AS INTEGER)"
+SQL_NOW_MS = "CAST((julianday('now') - 2440587.5) * 86400000 AS INTEGER)"
+
+# Время новой записи chat_history. timestamp входит в первичный ключ: если у пользователя
+# уже есть запись с этой же миллисекундой (несколько сообщений подряд), берем следующую.
+# Параметр ?1 - user_id, MAX(timestamp) по пользователю - поиск по первичному ключу
+SQL_CHAT_TIMESTAMP = (
+    f"MAX({SQL_NOW_MS}, "
+    "COALESCE((SELECT MAX(timestamp) FROM chat_history WHERE user_id = ?1) + 1, 0))"
+)
+
+# Таблица для истории чата
+CHAT_HISTORY_TABLE = '''
+    CREATE TABLE IF NOT EXISTS chat_history (
+        user_id INTEGER,
+        message TEXT,
+        response TEXT,
+        timestamp INTEGER,
+        PRIMARY KEY (user_id, timestamp)
+    )
+    '''
+
+# Частичный индекс по сообщениям без ответа: поиск последнего такого
+# сообщения в update_chat_response становится поиском по индексу.
+# Для выборки истории по (user_id, timestamp DESC) хватает первичного ключа
+CHAT_PENDING_INDEX = '''
+    CREATE INDEX IF NOT EXISTS idx_chat_pending
+    ON chat_history(user_id, timestamp DESC) WHERE response IS NULL
+    '''
+
+# Таблица для данных пользователя
+USERS_TABLE = '''
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        subscription_status TEXT DEFAULT 'free',
+        messages_count INTEGER DEFAULT 0,
+        message_limit INTEGER DEFAULT NULL,
+        last_activity INTEGER,
+        subscription_expiry INTEGER DEFAULT NULL,
+        active INTEGER NOT NULL DEFAULT 1
+    )
+    '''
+
+# Индекс для очистки неактивных пользователей (last_activity < ?).
+# Отдельный индекс chat_history(user_id) не нужен: user_id - префикс первичного ключа
+USERS_ACTIVITY_INDEX = '''
+    CREATE INDEX IF NOT EXISTS idx_users_last_activity ON users(last_activity)
+    '''
+
+# Таблица для платежей
+PAYMENTS_TABLE = '''
+    CREATE TABLE IF NOT EXISTS payments (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        payment_id TEXT NOT NULL,
+        subscription_type TEXT NOT NULL,
+        amount REAL NOT NULL,
+        status TEXT DEFAULT 'pending',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    '''
+
+# Последний платеж пользователя (get_last_payment): поиск по индексу вместо
+# сканирования и сортировки всех платежей
+PAYMENTS_USER_INDEX = '''
+    CREATE INDEX IF NOT EXISTS idx_payments_user_created
+    ON payments(user_id, created_at DESC)
+    '''
+
+# Глобальные счетчики бота: {k: v}. /stats читает их по первичному ключу
+# вместо агрегации по всей таблице users
+GLOBAL_STATS_TABLE = '''
+    CREATE TABLE IF NOT EXISTS global_stats (
+        k TEXT PRIMARY KEY,
+        v INTEGER NOT NULL DEFAULT 0
+    )
+    '''
+
+# Начальное значение счетчика сообщений для существующей базы (один раз).
+# COUNT(*) в подзапросе: агрегат во внешнем SELECT вернул бы строку и при ложном WHERE
+GLOBAL_STATS_SEED = '''
+    INSERT INTO global_stats (k, v)
+    SELECT 'total_messages', (SELECT COUNT(*) FROM chat_history)
+    WHERE NOT EXISTS (SELECT 1 FROM global_stats WHERE k = 'total_messages')
+    '''
+
+# Каждая новая запись истории увеличивает общий счетчик сообщений.
+# Триггер только на INSERT: очистка истории не уменьшает число обработанных сообщений
+CHAT_HISTORY_COUNT_TRIGGER = '''
+    CREATE TRIGGER IF NOT EXISTS trg_chat_history_total
+    AFTER INSERT ON chat_history
+    BEGIN
+        INSERT INTO global_stats (k, v) VALUES ('total_messages', 1)
+        ON CONFLICT(k) DO UPDATE SET v = v + 1;
+    END
+    '''
+
+# Рассылки администратора. Получателям копируется исходное сообщение
+# (from_chat_id, message_id), message - его текст для предпросмотра и логов.
+# status: 'running' пока рассылка не завершена - такую рассылку после
+# перезапуска бота можно продолжить командой /resume_broadcast
+BROADCASTS_TABLE = '''
+    CREATE TABLE IF NOT EXISTS broadcasts (
+        broadcast_id INTEGER PRIMARY KEY,
+        message TEXT NOT NULL,
+        from_chat_id INTEGER NOT NULL,
+        message_id INTEGER NOT NULL,
+        status TEXT NOT NULL DEFAULT 'running',
+        created_at INTEGER NOT NULL
+    )
+    '''
+
+# Кому сообщение рассылки уже доставлено: при продолжении эти пользователи пропускаются.
+# WITHOUT ROWID - таблица состоит только из первичного ключа
+BROADCAST_DELIVERIES_TABLE = '''
+    CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+        broadcast_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        PRIMARY KEY (broadcast_id, user_id)
+    ) WITHOUT ROWID
+    '''
+
+# Таблицы и индексы, создаваемые при запуске (выполняются по порядку)
+SCHEMA_STATEMENTS = (
+    CHAT_HISTORY_TABLE,
+    CHAT_PENDING_INDEX,
+    USERS_TABLE,
+    USERS_ACTIVITY_INDEX,
+    PAYMENTS_TABLE,
+    PAYMENTS_USER_INDEX,
+    GLOBAL_STATS_TABLE,
+    GLOBAL_STATS_SEED,
+    CHAT_HISTORY_COUNT_TRIGGER,
+    BROADCASTS_TABLE,
+    BROADCAST_DELIVERIES_TABLE,
+)
+
+# Колонки users, появившиеся после первой версии схемы: (имя, тип)
+USERS_ADDED_COLUMNS = (
+    ('subscription_expiry', 'INTEGER DEFAULT NULL'),
+    ('message_limit', 'INTEGER DEFAULT NULL'),
+    # 0 - пользователь заблокировал бота или удалил аккаунт: рассылка его пропускает.
+    # Любое новое действие пользователя снова делает его активным
+    ('active', 'INTEGER NOT NULL DEFAULT 1'),
+)
+
+# Старые базы хранят время как TEXT (DATETIME, локальное время из datetime.now())
+TIMESTAMP_MIGRATION_CHECK = (
+    "SELECT 1 FROM pragma_table_info('chat_history') WHERE name = 'timestamp' AND type = 'DATETIME'"
+)
+
+# Перевод старых таблиц на INTEGER-время. Выполняется в одной транзакции;
+# модификатор 'utc' переводит сохраненное локальное время в UTC
+TIMESTAMP_MIGRATION = (
+    "ALTER TABLE chat_history RENAME TO chat_history_old",
+    CHAT_HISTORY_TABLE,
+    '''
+    INSERT OR IGNORE INTO chat_history (user_id, message, response, timestamp)
+    SELECT user_id, message, response,
+        CAST((julianday(timestamp, 'utc') - 2440587.5) * 86400000 AS INTEGER)
+    FROM chat_history_old
+    ''',
+    "DROP TABLE chat_history_old",
+    CHAT_PENDING_INDEX,
+    # Триггер удаляется вместе со старой таблицей
+    CHAT_HISTORY_COUNT_TRIGGER,
+    "ALTER TABLE users RENAME TO users_old",
+    USERS_TABLE,
+    '''
+    INSERT INTO users (user_id, subscription_status, messages_count, message_limit,
+                       last_activity, subscription_expiry)
+    SELECT user_id, subscription_status, messages_count, message_limit,
+        CAST(strftime('%s', last_activity, 'utc') AS INTEGER),
+        CAST(strftime('%s', subscription_expiry, 'utc') AS INTEGER)
+    FROM users_old
+    ''',
+    "DROP TABLE users_old",
+    USERS_ACTIVITY_INDEX,
+)
+
+
+def connection_pragmas(readonly=False):
+    """Возвращает список PRAGMA для нового соединения с БД"""
+    pragmas = []
+    if not readonly:
+        # Режим журнала и чекпоинты настраивает только соединение для записи
+        pragmas += [
+            "PRAGMA journal_mode=WAL",
+            "PRAGMA synchronous=NORMAL",
+            f"PRAGMA wal_autocheckpoint={config.SQLITE_WAL_AUTOCHECKPOINT}",
+        ]
+    pragmas += [
+        # Отрицательное значение cache_size задается в KiB, а не в страницах
+        f"PRAGMA cache_size=-{config.SQLITE_CACHE_KB}",
+        f"PRAGMA mmap_size={config.SQLITE_MMAP_BYTES}",
+        "PRAGMA temp_store=MEMORY",
+        f"PRAGMA busy_timeout={config.SQLITE_BUSY_TIMEOUT_MS}",
+        "PRAGMA foreign_keys=ON",
+    ]
+    return pragmas
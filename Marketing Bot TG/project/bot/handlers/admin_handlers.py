@@ -3,22 +3,48 @@
 """
 import logging
 import asyncio
-from datetime import datetime, timedelta
+import html
+import time
 from aiogram import types, F
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
 from aiogram.filters.command import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from bot.config import config
 from bot.database import DBManager
+from bot.database.db_manager import USER_IDS_BATCH_SIZE
+from bot.utils.rate_limiter import RateLimiter
 
 logger = logging.getLogger(__name__)
 db = DBManager()
 
+# Сколько сообщений рассылки отправляется одновременно (число воркеров)
+BROADCAST_CONCURRENCY = 30
+# Глобальный лимит Telegram - около 30 сообщений в секунду для бота
+BROADCAST_RATE_LIMIT = 30
+# Сколько раз повторять отправку пользователю после ответа 429 (TelegramRetryAfter)
+BROADCAST_MAX_RETRIES = 3
+# Как часто обновлять сообщение о ходе рассылки (в секундах)
+BROADCAST_STATUS_INTERVAL = 2
+
+# Общий для всех рассылок: две одновременные рассылки не превысят лимит вдвоем
+broadcast_limiter = RateLimiter(BROADCAST_RATE_LIMIT, 1)
+# broadcast_id рассылок, которые выполняются в этом процессе (чтобы не продолжить их дважды)
+_active_broadcasts = set()
+
 class BroadcastStates(StatesGroup):
     """Состояния для рассылки сообщений"""
     waiting_for_message = State()
     confirm_broadcast = State()
 
+# Имена состояний рассылки для /cancel
+_BROADCAST_STATES = frozenset(s.state for s in BroadcastStates.__states__)
+
+def format_percent(done, total):
+    """Процент с одним знаком после запятой в целочисленной арифметике (без float)"""
+    tenths = done * 1000 // total
+    return f"{tenths // 10}.{tenths % 10}"
+
 # Проверка прав администратора
 def is_admin(user_id):
     """Проверить, является ли пользователь администратором"""
@@ -37,17 +63,22 @@ async def stats_command(message: types.Message):
 
     # Получаем статистику из базы данных
     try:
-        # Общая статистика
-        total_users = db.execute_query("SELECT COUNT(*) FROM users", fetch=True)[0][0]
-        active_users = db.execute_query(
-            "SELECT COUNT(*) FROM users WHERE last_activity > ?",
-            (datetime.now() - timedelta(days=7),),
+        # Вся статистика одним запросом: общий счетчик сообщений поддерживает триггер
+        # на chat_history (см. bot/database/schema.py), активные пользователи
+        # считаются по индексу idx_users_last_activity. Синхронные запросы DBManager
+        # в обработчиках выполняются в отдельном потоке, не блокируя цикл событий
+        total_users, active_users, total_messages, pdf_count = (await asyncio.to_thread(
+            db.execute_query,
+            """
+            SELECT
+                (SELECT COUNT(*) FROM users),
+                (SELECT COUNT(*) FROM users WHERE last_activity > ?),
+                (SELECT COALESCE(MAX(v), 0) FROM global_stats WHERE k = 'total_messages'),
+                (SELECT COUNT(*) FROM knowledge_base_docs)
+            """,
+            (int(time.time()) - 7 * 86400,),
             fetch=True
-        )[0][0]
-        total_messages = db.execute_query("SELECT SUM(message_count) FROM users", fetch=True)[0][0] or 0
-
-        # Статистика по PDF файлам
-        pdf_count = db.execute_query("SELECT COUNT(*) FROM knowledge_base_docs", fetch=True)[0][0]
+        ))[0]
 
         # Формируем сообщение со статистикой
         stats_message = (
@@ -96,8 +127,15 @@ async def process_broadcast_message(message: types.Message, state: FSMContext):
     """
     Обработчик для получения сообщения для рассылки
     """
-    # Сохраняем сообщение в состоянии
-    await state.update_data(broadcast_message=message.html_text)
+    # Текст для предпросмотра; у фото или видео без подписи текста нет
+    preview = message.html_text if (message.text or message.caption) else "(медиа без подписи)"
+
+    # Сохраняем сообщение в состоянии: получателям рассылается его копия
+    await state.update_data(
+        broadcast_message=preview,
+        from_chat_id=message.chat.id,
+        message_id=message.message_id
+    )
 
     # Переходим в состояние подтверждения рассылки
     await state.set_state(BroadcastStates.confirm_broadcast)
@@ -111,20 +149,164 @@ async def process_broadcast_message(message: types.Message, state: FSMContext):
     ])
 
     # Получаем количество пользователей
-    total_users = db.execute_query("SELECT COUNT(*) FROM users", fetch=True)[0][0]
+    total_users = (await asyncio.to_thread(
+        db.execute_query, "SELECT COUNT(*) FROM users WHERE active = 1", fetch=True
+    ))[0][0]
 
     await message.answer(
         f"📣 <b>Подтверждение рассылки</b>\n\n"
         f"Ваше сообщение будет отправлено <b>{total_users}</b> пользователям.\n\n"
         f"<b>Предпросмотр сообщения:</b>\n"
         f"➖➖➖➖➖➖➖➖➖➖\n"
-        f"{message.html_text}\n"
+        f"{preview}\n"
         f"➖➖➖➖➖➖➖➖➖➖\n\n"
         f"Подтвердите отправку или отмените рассылку.",
         reply_markup=keyboard,
         parse_mode="HTML"
     )
 
+async def run_broadcast(bot, status_message, broadcast_id, from_chat_id, message_id, total_users):
+    """
+    Рассылает копию сообщения (from_chat_id, message_id) пользователям, которым
+    рассылка broadcast_id еще не доставлена. copy_message копирует сообщение на стороне
+    Telegram: в запросе только идентификаторы, а не текст, и поддерживаются медиа.
+    Каждая доставка сохраняется в БД, поэтому после падения бота рассылку можно
+    продолжить (/resume_broadcast) без повторной отправки. Если часть отправок не удалась
+    из-за временных ошибок, рассылка остается незавершенной: /resume_broadcast отправит
+    сообщение только этим пользователям. Вызывающий код заранее добавляет broadcast_id
+    в _active_broadcasts. Возвращает число успешных отправок
+    """
+    success_count = 0
+    # Пользователи, которым не удалось доставить сообщение из-за временной ошибки
+    # (повторяется лимит, сеть): им сообщение отправит /resume_broadcast
+    failed_user_ids = []
+    # Заблокировавшие бота: помечаются неактивными одним запросом после рассылки
+    inactive_user_ids = []
+
+    async def send_to_user(user_id):
+        """Отправляет сообщение одному пользователю, возвращает True при успехе"""
+        for attempt in range(BROADCAST_MAX_RETRIES + 1):
+            try:
+                async with broadcast_limiter:
+                    await bot.copy_message(
+                        chat_id=user_id,
+                        from_chat_id=from_chat_id,
+                        message_id=message_id
+                    )
+                db.mark_broadcast_delivered(broadcast_id, user_id)
+                return True
+            except TelegramRetryAfter as e:
+                # Ждет только этот воркер, остальные продолжают рассылку
+                logger.warning(f"Flood limit on broadcast to user {user_id}, retry in {e.retry_after}s")
+                if attempt < BROADCAST_MAX_RETRIES:
+                    await asyncio.sleep(e.retry_after)
+            except TelegramForbiddenError as e:
+                # Пользователь заблокировал бота или удалил аккаунт: следующие рассылки его пропустят
+                logger.info(f"User {user_id} is unreachable, marking inactive: {e}")
+                inactive_user_ids.append(user_id)
+                return False
+            except TelegramBadRequest as e:
+                # Чат не найден - тоже постоянная ошибка
+                if "chat not found" in e.message.lower():
+                    logger.info(f"Chat {user_id} not found, marking user inactive")
+                    inactive_user_ids.append(user_id)
+                    return False
+                logger.error(f"Error sending broadcast to user {user_id}: {e}")
+                break
+            except Exception as e:
+                logger.error(f"Error sending broadcast to user {user_id}: {e}")
+                break
+        failed_user_ids.append(user_id)
+        return False
+
+    # Чтение пользователей из БД идет параллельно с отправкой: producer заполняет
+    # ограниченную очередь пачками из db.iter_user_ids, BROADCAST_CONCURRENCY воркеров
+    # (темп задает broadcast_limiter) забирают из нее. None - сигнал воркеру завершиться
+    user_queue = asyncio.Queue(maxsize=USER_IDS_BATCH_SIZE)
+
+    async def produce_user_ids():
+        # Каждая пачка читается в отдельном потоке
+        batches = db.iter_user_ids(broadcast_id=broadcast_id)
+        try:
+            while (user_ids := await asyncio.to_thread(next, batches, None)) is not None:
+                for user_id in user_ids:
+                    await user_queue.put(user_id)
+        finally:
+            for _ in range(BROADCAST_CONCURRENCY):
+                await user_queue.put(None)
+
+    async def broadcast_worker():
+        nonlocal success_count
+        while (user_id := await user_queue.get()) is not None:
+            if await send_to_user(user_id):
+                success_count += 1
+
+    # Статус обновляется отдельной задачей раз в BROADCAST_STATUS_INTERVAL секунд:
+    # редактирование сообщения не тормозит отправку и не расходует лимит на каждые 10 сообщений
+    done = asyncio.Event()
+
+    async def report_progress():
+        last_text = None
+        while True:
+            try:
+                await asyncio.wait_for(done.wait(), BROADCAST_STATUS_INTERVAL)
+                return
+            except asyncio.TimeoutError:
+                pass
+            text = (
+                "📣 <b>Рассылка выполняется</b>\n\n"
+                f"Отправлено: {success_count}/{total_users}\n"
+                f"Прогресс: {format_percent(success_count, total_users)}%"
+            )
+            # Telegram отклоняет редактирование без изменений
+            if text == last_text:
+                continue
+            try:
+                await status_message.edit_text(text, parse_mode="HTML")
+                last_text = text
+            except Exception as e:
+                logger.warning(f"Failed to update broadcast status: {e}")
+
+    progress_task = asyncio.create_task(report_progress())
+    try:
+        # Отправляем сообщения всем пользователям
+        await asyncio.gather(
+            produce_user_ids(),
+            *(broadcast_worker() for _ in range(BROADCAST_CONCURRENCY))
+        )
+    finally:
+        done.set()
+        await progress_task
+        # И при прерванной рассылке сохраняем уже найденных неактивных пользователей
+        db.deactivate_users(inactive_user_ids)
+
+    if failed_user_ids:
+        # Рассылка остается незавершенной: /resume_broadcast пропустит тех, кому
+        # она доставлена, и неактивных пользователей, то есть отправит только этим
+        logger.warning(f"Broadcast {broadcast_id} was not delivered to {len(failed_user_ids)} users: {failed_user_ids}")
+        await status_message.edit_text(
+            "⚠️ <b>Рассылка завершена с ошибками</b>\n\n"
+            f"Отправлено успешно: {success_count}/{total_users}\n"
+            f"Не доставлено из-за временных ошибок: {len(failed_user_ids)}\n\n"
+            "Повторить отправку этим пользователям: /resume_broadcast",
+            parse_mode="HTML"
+        )
+        return success_count
+
+    # Рассылка прошла по всем пользователям
+    db.finish_broadcast(broadcast_id)
+
+    # Отправляем сообщение о завершении рассылки
+    await status_message.edit_text(
+        "✅ <b>Рассылка завершена</b>\n\n"
+        f"Отправлено успешно: {success_count}/{total_users}\n"
+        f"Процент успешных отправок: {format_percent(success_count, total_users)}%",
+        parse_mode="HTML"
+    )
+
+    logger.info(f"Broadcast {broadcast_id} completed: {success_count}/{total_users} messages sent")
+    return success_count
+
 async def confirm_broadcast_callback(callback_query: types.CallbackQuery, state: FSMContext):
     """
     Обработчик подтверждения рассылки
@@ -134,63 +316,108 @@ async def confirm_broadcast_callback(callback_query: types.CallbackQuery, state:
     # Получаем сообщение из состояния
     state_data = await state.get_data()
     broadcast_message = state_data.get('broadcast_message')
+    from_chat_id = state_data.get('from_chat_id')
+    message_id = state_data.get('message_id')
 
-    if not broadcast_message:
+    if not broadcast_message or message_id is None:
         await callback_query.message.edit_text("❌ Ошибка: сообщение для рассылки не найдено")
         await state.clear()
         return
 
-    # Получаем список всех пользователей
-    users = db.execute_query("SELECT user_id FROM users", fetch=True)
-    total_users = len(users)
-    success_count = 0
+    # Список пользователей читаем пачками (db.iter_user_ids), в памяти только текущая пачка
+    total_users = (await asyncio.to_thread(
+        db.execute_query, "SELECT COUNT(*) FROM users WHERE active = 1", fetch=True
+    ))[0][0]
 
-    # Отправляем сообщение о начале рассылки
-    status_message = await callback_query.message.edit_text(
-        "📣 <b>Рассылка начата</b>\n\n"
-        f"Отправка сообщения {total_users} пользователям...\n"
-        "Это может занять некоторое время.",
-        parse_mode="HTML"
-    )
+    if not total_users:
+        await callback_query.message.edit_text("❌ Нет пользователей для рассылки")
+        await state.clear()
+        return
 
-    # Отправляем сообщения всем пользователям
-    for user in users:
-        user_id = user[0]
-        try:
-            await callback_query.bot.send_message(
-                chat_id=user_id,
-                text=broadcast_message,
-                parse_mode="HTML"
-            )
-            success_count += 1
+    # Пробная отправка администратору: если Telegram не может скопировать сообщение
+    # (например, оно удалено), рассылка не начинается, вместо одинаковой ошибки
+    # на каждом получателе
+    try:
+        await callback_query.bot.copy_message(
+            chat_id=callback_query.from_user.id,
+            from_chat_id=from_chat_id,
+            message_id=message_id
+        )
+    except TelegramBadRequest as e:
+        logger.warning(f"Broadcast message rejected by Telegram: {e}")
+        await callback_query.message.edit_text(
+            f"❌ Telegram не принял сообщение: {html.escape(e.message)}\n"
+            "Начните рассылку заново (/broadcast)"
+        )
+        await state.clear()
+        return
 
-            # Обновляем статус каждые 10 отправленных сообщений
-            if success_count % 10 == 0:
-                await status_message.edit_text(
-                    "📣 <b>Рассылка выполняется</b>\n\n"
-                    f"Отправлено: {success_count}/{total_users}\n"
-                    f"Прогресс: {success_count/total_users*100:.1f}%",
-                    parse_mode="HTML"
-                )
+    broadcast_id = await asyncio.to_thread(db.create_broadcast, broadcast_message, from_chat_id, message_id)
+    if broadcast_id is None:
+        await callback_query.message.edit_text("❌ Не удалось сохранить рассылку")
+        await state.clear()
+        return
 
-            # Добавляем небольшую задержку, чтобы избежать блокировки API
-            await asyncio.sleep(0.1)
+    # Рассылка уже сохранена как незавершенная: отмечаем ее выполняемой до следующего
+    # await, иначе /resume_broadcast в этот момент запустил бы вторую отправку
+    _active_broadcasts.add(broadcast_id)
+    try:
+        # Отправляем сообщение о начале рассылки
+        status_message = await callback_query.message.edit_text(
+            "📣 <b>Рассылка начата</b>\n\n"
+            f"Отправка сообщения {total_users} пользователям...\n"
+            "Это может занять некоторое время.",
+            parse_mode="HTML"
+        )
 
-        except Exception as e:
-            logger.error(f"Error sending broadcast to user {user_id}: {e}")
+        # Очищаем состояние
+        await state.clear()
 
-    # Отправляем сообщение о завершении рассылки
-    await status_message.edit_text(
-        "✅ <b>Рассылка завершена</b>\n\n"
-        f"Отправлено успешно: {success_count}/{total_users}\n"
-        f"Процент успешных отправок: {success_count/total_users*100:.1f}%",
-        parse_mode="HTML"
-    )
+        await run_broadcast(callback_query.bot, status_message, broadcast_id, from_chat_id, message_id, total_users)
+    finally:
+        _active_broadcasts.discard(broadcast_id)
 
-    # Очищаем состояние
-    await state.clear()
+async def resume_broadcast_command(message: types.Message):
+    """
+    Обработчик команды /resume_broadcast - продолжает прерванную рассылку
+    для пользователей, которые ее еще не получили
+    """
+    user_id = message.from_user.id
+
+    # Проверяем, является ли пользователь администратором
+    if not is_admin(user_id):
+        await message.answer("⛔ У вас нет прав для выполнения этой команды")
+        return
+
+    broadcast = await asyncio.to_thread(db.get_unfinished_broadcast)
+    if not broadcast:
+        await message.answer("❓ Нет незавершенных рассылок")
+        return
+
+    broadcast_id, from_chat_id, message_id = broadcast
+    if broadcast_id in _active_broadcasts:
+        await message.answer("⏳ Эта рассылка еще выполняется")
+        return
+
+    # Отмечаем до первого await: повторная /resume_broadcast не запустит вторую отправку
+    _active_broadcasts.add(broadcast_id)
+    try:
+        total_users = await asyncio.to_thread(db.count_broadcast_recipients, broadcast_id)
+        if not total_users:
+            db.finish_broadcast(broadcast_id)
+            await message.answer("✅ Рассылка уже доставлена всем пользователям")
+            return
+
+        status_message = await message.answer(
+            "📣 <b>Рассылка продолжена</b>\n\n"
+            f"Отправка сообщения оставшимся {total_users} пользователям...",
+            parse_mode="HTML"
+        )
 
-    logger.info(f"Broadcast completed: {success_count}/{total_users} messages sent")
+        logger.info(f"Admin {user_id} resumed broadcast {broadcast_id}")
+        await run_broadcast(message.bot, status_message, broadcast_id, from_chat_id, message_id, total_users)
+    finally:
+        _active_broadcasts.discard(broadcast_id)
 
 async def cancel_broadcast_callback(callback_query: types.CallbackQuery, state: FSMContext):
     """
@@ -207,7 +434,7 @@ async def cancel_command(message: types.Message, state: FSMContext):
     Обработчик команды /cancel для отмены операций
     """
     current_state = await state.get_state()
-    if current_state in [BroadcastStates.waiting_for_message, BroadcastStates.confirm_broadcast]:
+    if current_state in _BROADCAST_STATES:
         await state.clear()
         await message.answer("❌ Рассылка отменена")
         logger.info(f"Broadcast cancelled by admin {message.from_user.id}")
@@ -226,6 +453,7 @@ def register_handlers(dp):
     dp.message.register(process_broadcast_message, BroadcastStates.waiting_for_message)
     dp.callback_query.register(confirm_broadcast_callback, F.data == "confirm_broadcast")
     dp.callback_query.register(cancel_broadcast_callback, F.data == "cancel_broadcast")
+    dp.message.register(resume_broadcast_command, Command("resume_broadcast"))
 
     # Регистрируем обработчик отмены
     dp.message.register(cancel_command, Command("cancel"))
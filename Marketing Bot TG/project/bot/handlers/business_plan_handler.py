@@ -3,11 +3,13 @@
 """
 import logging
 import asyncio
+import json
 import re
 from aiogram import types, F
 from aiogram.filters.command import Command
 from aiogram.fsm.context import FSMContext
-from bot.utils.ai_client import generate_gpt_response
+from bot.utils.ai_client import generate_gpt_response, stream_gpt_response
+from bot.utils.rate_limiter import chat_limiter
 from bot.states.states import BusinessPlanStates
 from bot.utils.text_utils import format_business_plan, split_message, split_response_into_sections
 from bot.database import DBManager
@@ -15,6 +17,110 @@ from bot.config.prompts import BUSINESS_PLAN_PROMPT, BUSINESS_PLAN_GENERATION_PR
 
 logger = logging.getLogger(__name__)
 
+# Заголовок раздела в ответе GPT: номер с точкой в начале строки ("3. Ценность ...")
+_SECTION_HEADER_RE = re.compile(r'^\s*(\d{1,2})\.(?:\s+|$)(.*)')
+
+def _parse_sections(text, count=10):
+    """
+    Разбирает ответ GPT на нумерованные разделы за один проход по строкам.
+    Возвращает {индекс раздела: текст без номера}. Номер считается заголовком,
+    только если он больше номера текущего раздела: нумерованные списки внутри
+    раздела ("1. ...", "2. ...") остаются его текстом
+    """
+    sections = {}
+    current = None
+    buf = []
+    for line in text.splitlines():
+        match = _SECTION_HEADER_RE.match(line)
+        if match:
+            num = int(match.group(1))
+            if 1 <= num <= count and (current is None or num - 1 > current):
+                if current is not None:
+                    sections[current] = "\n".join(buf).strip()
+                current = num - 1
+                buf = [match.group(2)]
+                continue
+        if current is not None:
+            buf.append(line)
+    if current is not None:
+        sections[current] = "\n".join(buf).strip()
+    return sections
+
+# Ответ GPT запрашивается в виде JSON-объекта
+_JSON_RESPONSE_FORMAT = {"type": "json_object"}
+
+def _section_entry(section, count=10):
+    """Объект раздела {"n": ..., "body": ...} -> (индекс, текст) или None, если он некорректен"""
+    try:
+        num = int(section["n"])
+        body = str(section.get("body") or "").strip()
+    except (ValueError, TypeError, KeyError, AttributeError):
+        return None
+    if 1 <= num <= count and body:
+        return num - 1, body
+    return None
+
+def _parse_json_sections(text, count=10):
+    """
+    Разбирает ответ GPT вида {"sections": [{"n": 1, "title": "...", "body": "..."}, ...]}.
+    Возвращает {индекс раздела: текст}. Если ответ не JSON, разбирает его
+    как текст с нумерованными разделами
+    """
+    try:
+        sections = {}
+        for section in json.loads(text)["sections"]:
+            entry = _section_entry(section, count)
+            if entry and entry[0] not in sections:
+                sections[entry[0]] = entry[1]
+        return sections
+    except (ValueError, TypeError, KeyError) as e:
+        logger.warning(f"Ответ GPT не удалось разобрать как JSON: {e}")
+        return _parse_sections(text, count)
+
+class _JsonSectionStream:
+    """
+    Разбор потокового JSON-ответа {"sections": [{...}, {...}, ...]}: feed() возвращает
+    разделы, объекты которых уже пришли целиком, не дожидаясь конца ответа
+    """
+
+    def __init__(self, count=10):
+        self.count = count
+        self.text = ""
+        # Позиция в массиве sections, с которой начинается следующий объект
+        self._pos = None
+        self._decoder = json.JSONDecoder()
+
+    def feed(self, chunk):
+        """Добавляет фрагмент ответа, возвращает список (индекс, текст) завершенных разделов"""
+        self.text += chunk
+        if self._pos is None:
+            start = self.text.find("[")
+            if start == -1:
+                return []
+            self._pos = start + 1
+        elif "}" not in chunk:
+            # Объект раздела не мог завершиться в этом фрагменте
+            return []
+
+        entries = []
+        text = self.text
+        while True:
+            pos = self._pos
+            # Пропускаем разделители между объектами массива
+            while pos < len(text) and text[pos] in " \t\r\n,":
+                pos += 1
+            self._pos = pos
+            if pos >= len(text) or text[pos] != "{":
+                return entries
+            try:
+                section, self._pos = self._decoder.raw_decode(text, pos)
+            except ValueError:
+                # Объект еще не пришел целиком
+                return entries
+            entry = _section_entry(section, self.count)
+            if entry:
+                entries.append(entry)
+
 async def business_plan_callback(callback_query: types.CallbackQuery, state: FSMContext):
     """
     Обработчик для кнопки "Создать бизнес-план"
@@ -53,11 +159,13 @@ async def handle_business_info(message: types.Message, state: FSMContext):
 
     try:
         # Импортируем здесь, чтобы избежать циклических импортов
-        from bot.knowledge_base.vector_kb_manager import VectorKnowledgeBaseManager
-        
-        # Получаем контент из базы знаний по запросу
-        kb_manager = VectorKnowledgeBaseManager()
-        knowledge_content = kb_manager.get_content_for_query(business_info)
+        from bot.knowledge_base.vector_kb_manager import get_vector_kb_manager
+
+        # Получаем контент из базы знаний по запросу. Менеджер общий (индекс загружается
+        # один раз), а поиск с запросом embeddings выполняется в отдельном потоке,
+        # чтобы не блокировать цикл событий
+        kb_manager = get_vector_kb_manager()
+        knowledge_content = await asyncio.to_thread(kb_manager.get_content_for_query, business_info)
         
         # Добавляем дополнительный контекст из базы знаний, если он найден
         kb_context = ""
@@ -108,12 +216,11 @@ async def handle_business_info(message: types.Message, state: FSMContext):
 Четкая структура – Каждая секция должна быть 1-3 кратких абзаца, список или таблица.
 
 ФОРМАТ ОТВЕТА
-Отправляй каждый пункт отдельным сообщением. Ты должен создать 10 ОТДЕЛЬНЫХ И САМОСТОЯТЕЛЬНЫХ разделов, которые будут отправлены мной как отдельные сообщения.
-Вместо одного длинного сообщения, раздели сообщение на заголовки.
-Каждый раздел должен начинаться с номера и точки (например, "1.", "2.", "3." и т.д.).
-Сначала отправь раздел "1. Целевая аудитория", затем "2. Проблема" и так далее до "10. Масштабирование".
-
-Каждый раздел должен начинаться с номера и точки (например, "1. ")."""
+Ты должен создать 10 ОТДЕЛЬНЫХ И САМОСТОЯТЕЛЬНЫХ разделов, которые будут отправлены мной как отдельные сообщения.
+Ответ - только JSON-объект без пояснений:
+{"sections": [{"n": 1, "title": "Целевая аудитория", "body": "текст раздела"}, {"n": 2, "title": "Проблема", "body": "текст раздела"}, ...]}
+В массиве sections ровно 10 элементов по порядку, от "1. Целевая аудитория" до "10. Масштабирование".
+n - номер раздела, body - только текст раздела без номера и заголовка, абзацы разделяй переводом строки."""
 
         # Создаем сообщения для запроса
         messages = [
@@ -121,192 +228,127 @@ async def handle_business_info(message: types.Message, state: FSMContext):
             {"role": "user", "content": prompt}
         ]
 
-        # Генерируем бизнес-план
-        response = await generate_gpt_response(messages=messages)
+        def format_section(i, section_content):
+            return f"<b>{i + 1}. {section_titles[i]}</b>\n\n{section_content}"
 
-        # Удаляем сообщение о генерации
-        await processing_msg.delete()
+        started = False
+
+        async def send_text(text):
+            """Отправляет сообщение; ошибка Telegram логируется и не прерывает отправку остальных. True - отправлено"""
+            try:
+                # Вместо фиксированной паузы между сообщениями темп задает лимит на чат.
+                # Отправка по одному (а не gather) сохраняет порядок разделов в чате
+                async with chat_limiter(message.chat.id):
+                    await message.answer(text)
+                return True
+            except Exception as send_error:
+                logger.error(f"Ошибка при отправке части бизнес-плана: {send_error}")
+                return False
+
+        async def start(with_intro):
+            """Перед первым сообщением убирает сообщение о генерации и, если ответ разбит на разделы, отправляет вступление"""
+            nonlocal started
+            if started:
+                return
+            started = True
+            try:
+                # Удаляем сообщение о генерации
+                await processing_msg.delete()
+            except Exception as delete_error:
+                logger.warning(f"Не удалось удалить сообщение о генерации: {delete_error}")
+            if with_intro:
+                # Отправляем сообщение о структуре бизнес-плана
+                await send_text("<b>Бизнес-план</b>\n\nНиже будут отправлены 10 разделов бизнес-плана:")
+
+        # Разделы, уже полученные от GPT, и разделы, доставленные пользователю.
+        # Раздел, который не удалось отправить, не считается отправленным и
+        # генерируется заново вместе с недостающими
+        received = set()
+        sent = set()
+
+        async def send_section(i, section_content):
+            await start(with_intro=True)
+            if await send_text(format_section(i, section_content)):
+                sent.add(i)
+
+        # Генерируем бизнес-план потоком: каждый раздел отправляется, как только его
+        # объект в JSON-ответе пришел целиком, не дожидаясь генерации остальных.
+        # except перехватывает только ошибки потока: send_section ошибок не пропускает
+        stream = _JsonSectionStream()
+        response_stream = stream_gpt_response(messages=messages, response_format=_JSON_RESPONSE_FORMAT)
+        try:
+            async for chunk in response_stream:
+                for i, section_content in stream.feed(chunk):
+                    if i not in received:
+                        received.add(i)
+                        await send_section(i, section_content)
+        except Exception as stream_error:
+            # Пока ничего не отправлено, ошибку обработает общий обработчик ниже
+            if not started:
+                raise
+            logger.error(f"Поток ответа GPT прерван: {stream_error}")
+        finally:
+            # Закрываем HTTP-поток сразу, а не при сборке мусора
+            await response_stream.aclose()
+        response = stream.text
 
-        # Отправляем сообщение о структуре бизнес-плана
-        intro_msg = await message.answer("<b>Бизнес-план</b>\n\nНиже будут отправлены 10 разделов бизнес-плана:")
-        
-        # Прямой запрос для конкретного формата данных
-        # Запрашиваем строго 10 разделов с тегами
         try:
-            # Новый подход - ищем разделы по нумерации
-            contents = {}
-            
-            # Используем регулярное выражение для поиска разделов по номеру (например, "1.", "2.", ..., "10.")
-            for i, title in enumerate(section_titles):
-                current_num = i + 1
-                
-                # Ищем раздел по номеру и точке в начале строки (с возможными пробелами)
-                # Ищем текст от текущего номера до следующего номера или до конца текста
-                if current_num < 10:
-                    next_num = current_num + 1
-                    # Ищем начало текущего раздела и текст до начала следующего
-                    pattern = rf"^\s*{current_num}\.\s*(.*?)(?=^\s*{next_num}\.\s*|\Z)"
-                else: # Для последнего раздела (10.)
-                    pattern = rf"^\s*{current_num}\.\s*(.*)"
-                
-                # Ищем с флагами MULTILINE и DOTALL
-                match = re.search(pattern, response, re.MULTILINE | re.DOTALL)
-                
-                if match:
-                    # Нашли текст раздела (без номера и точки)
-                    section_content = match.group(1).strip()
-                    # Форматируем заголовок жирным с номером
-                    section_text = f"<b>{current_num}. {title}</b>\n\n{section_content}"
-                    contents[i] = section_text
-                else:
-                     logger.warning(f"Не удалось найти раздел {current_num}. с помощью regex.")
-
-            # Если не удалось найти все 10 разделов с помощью regex, пробуем разбить по номерам
-            if len(contents) < 10:
-                logger.warning(f"Нашли только {len(contents)} разделов с помощью regex, пробуем разбить по номерам.")
-                
-                # Разбиваем текст по номерам "1.", "2.", ... "10." в начале строки
-                split_pattern = r'^\s*(?=\d{1,2}\.\s)'
-                all_sections = re.split(split_pattern, response, flags=re.MULTILINE)
-                
-                # Убираем пустые строки и пробелы
-                all_sections = [s.strip() for s in all_sections if s.strip()]
-
-                # Пытаемся сопоставить найденные части с номерами
-                temp_sections = {}
-                for section_part in all_sections:
-                    match_num = re.match(r'^(\d{1,2})\.\s*(.*)', section_part, re.DOTALL)
-                    if match_num:
-                        num = int(match_num.group(1))
-                        content_part = match_num.group(2).strip()
-                        if 1 <= num <= 10:
-                            idx = num - 1
-                            if idx not in contents: # Добавляем только если еще не найден
-                                title = section_titles[idx]
-                                temp_sections[idx] = f"<b>{num}. {title}</b>\n\n{content_part}"
-                
-                # Обновляем основной словарь найденных разделов
-                contents.update(temp_sections)
-
-            # Если все еще не удалось найти все разделы, попробуем прямую генерацию недостающих разделов
-            if len(contents) < 10:
-                logger.warning(f"После двух попыток разбора нашли только {len(contents)} разделов, генерируем недостающие.")
-                
+            if not received:
+                # Разделы не удалось выделить по ходу потока: разбираем ответ целиком
+                # (JSON или текст с нумерованными разделами)
+                for i, section_content in sorted(_parse_json_sections(response).items()):
+                    received.add(i)
+                    await send_section(i, section_content)
+
+            if not received:
+                # В ответе нет ни JSON, ни нумерованных разделов: отправляем его как есть,
+                # частями в пределах лимита Telegram, а не 10 заглушек и без вступления о разделах
+                logger.warning(f"Разделы в ответе GPT не найдены, отправляем ответ целиком: {response[:500]}...")
+                await start(with_intro=False)
+                for part in split_message(response):
+                    await send_text(part)
+            elif len(sent) < 10:
+                # Если нашли не все разделы, генерируем недостающие одним дополнительным запросом
+                missing = {}
                 # Логируем, какие разделы не найдены
-                missing_indices = [i for i in range(10) if i not in contents]
-                logger.info(f"Отсутствуют разделы (индексы): {missing_indices}")
+                missing_indices = [i for i in range(10) if i not in sent]
+                logger.warning(f"Нашли только {len(sent)} разделов, генерируем недостающие: {missing_indices}")
                 # Логируем ответ от GPT для диагностики
                 logger.info(f"Ответ GPT для диагностики: {response[:500]}...")
-                
+
                 # Отправляем запрос на генерацию недостающих разделов
                 missing_titles_with_nums = [f"{i+1}. {section_titles[i]}" for i in missing_indices]
-                if missing_titles_with_nums:
-                    try:
-                        # Создаем запрос на генерацию только недостающих разделов с нумерацией
-                        missing_prompt = f"Создай следующие недостающие разделы бизнес-плана для этого бизнеса, начиная каждый раздел с номера и точки (например, '3. Ценность'):\n" + "\n".join(missing_titles_with_nums)
-                        missing_messages = [
-                            {"role": "system", "content": system_prompt}, # Используем обновленный system_prompt
-                            {"role": "user", "content": prompt},
-                            {"role": "assistant", "content": "Я создал некоторые разделы бизнес-плана, но некоторые отсутствуют."},
-                            {"role": "user", "content": missing_prompt}
-                        ]
-                        
-                        # Генерируем недостающие разделы
-                        missing_response = await generate_gpt_response(messages=missing_messages)
-                        logger.info(f"Ответ GPT на запрос недостающих разделов: {missing_response[:500]}...")
-                        
-                        # Повторяем процесс поиска разделов в новом ответе по нумерации
-                        for i in missing_indices:
-                            current_num = i + 1
-                            if current_num < 10:
-                                next_num = current_num + 1
-                                pattern = rf"^\s*{current_num}\.\s*(.*?)(?=^\s*{next_num}\.\s*|\Z)"
-                            else:
-                                pattern = rf"^\s*{current_num}\.\s*(.*)"
-                            
-                            match = re.search(pattern, missing_response, re.MULTILINE | re.DOTALL)
-                            if match:
-                                section_content = match.group(1).strip()
-                                title = section_titles[i]
-                                section_text = f"<b>{current_num}. {title}</b>\n\n{section_content}"
-                                contents[i] = section_text
-                            else:
-                                logger.warning(f"Не удалось найти недостающий раздел {current_num}. в ответе на доп. запрос.")
-
-                    except Exception as gen_error:
-                        logger.error(f"Ошибка при генерации недостающих разделов: {gen_error}")
-
-            # Отправляем каждый раздел по порядку
-            for i in range(10):
-                current_num = i + 1
-                title = section_titles[i] # Заголовок без эмодзи
-
-                if i in contents:
-                    # Раздел найден и уже отформатирован
-                    section_text = contents[i]
-                    # Дополнительная проверка на наличие номера и жирного шрифта
-                    if not re.match(rf"<b>{current_num}\.", section_text):
-                         # Если форматирование неверное, переформатируем
-                         content_match = re.search(r'\n\n(.*)', section_text, re.DOTALL)
-                         section_content = content_match.group(1) if content_match else section_text # Берем все после \n\n или весь текст
-                         section_text = f"<b>{current_num}. {title}</b>\n\n{section_content.strip()}"
-                    await message.answer(section_text)
-                else:
-                    # Раздел не был найден или сгенерирован, генерируем его отдельно
-                    logger.warning(f"Раздел {current_num}. не найден, генерируем отдельно.")
-                    section_prompt = f"Создай раздел '{current_num}. {title}' для бизнес-плана. Информация о бизнесе: {business_info}"
-                    
-                    try:
-                        # Генерируем содержимое для одного конкретного раздела
-                        section_messages = [
-                            {"role": "system", "content": f"Ты - эксперт по бизнес-планам. Создай короткий раздел '{current_num}. {title}' для бизнес-плана (3-5 предложений). Начни ответ с '{current_num}.'."},
-                            {"role": "user", "content": section_prompt}
-                        ]
-                        
-                        section_content_raw = await generate_gpt_response(messages=section_messages, max_tokens=300)
-                        
-                        # Убираем номер из начала ответа, если он есть, и форматируем
-                        section_content = re.sub(rf"^\s*{current_num}\.\s*", "", section_content_raw).strip()
-                        full_text = f"<b>{current_num}. {title}</b>\n\n{section_content}"
-                        await message.answer(full_text)
-                    except Exception as section_error:
-                        logger.error(f"Ошибка при генерации отдельного раздела {current_num}. {title}: {section_error}")
-                        # Отправляем заглушку, если генерация не удалась
-                        await message.answer(f"<b>{current_num}. {title}</b>\n\nНе удалось сгенерировать этот раздел.")
-                
-                # Небольшая пауза между сообщениями
-                await asyncio.sleep(0.5)
-                
-        except Exception as parsing_error:
-            logger.error(f"Ошибка при разборе разделов: {parsing_error}")
-            
-            # Запасной вариант - разбиваем на равные секции
-            try:
-                # Делим на 10 равных частей
-                total_len = len(response)
-                section_len = total_len // 10
-                
-                for i in range(10):
-                    start = i * section_len
-                    end = start + section_len if i < 9 else total_len
-                    
-                    # Находим ближайший конец предложения
-                    if i < 9:
-                        next_period = response.find('. ', end - 50, end + 50)
-                        if next_period != -1:
-                            end = next_period + 1
-                    
-                    section_text = response[start:end].strip()
-                    
-                    # Добавляем заголовок
-                    full_text = f"<b>{section_titles[i]}</b>\n\n{section_text}"
-                    
-                    # Отправляем раздел
-                    await message.answer(full_text)
-                    await asyncio.sleep(0.5)
-            except Exception as final_error:
-                logger.error(f"Критическая ошибка при обработке бизнес-плана: {final_error}")
-                await message.answer("Произошла ошибка при формировании бизнес-плана. Пожалуйста, попробуйте еще раз.")
+                try:
+                    # Создаем запрос на генерацию только недостающих разделов в том же формате JSON
+                    missing_prompt = "Создай следующие недостающие разделы бизнес-плана для этого бизнеса в том же формате JSON:\n" + "\n".join(missing_titles_with_nums)
+                    missing_messages = [
+                        {"role": "system", "content": system_prompt},
+                        {"role": "user", "content": prompt},
+                        {"role": "assistant", "content": "Я создал некоторые разделы бизнес-плана, но некоторые отсутствуют."},
+                        {"role": "user", "content": missing_prompt}
+                    ]
+
+                    # Генерируем недостающие разделы
+                    missing_response = await generate_gpt_response(
+                        messages=missing_messages, response_format=_JSON_RESPONSE_FORMAT
+                    )
+                    logger.info(f"Ответ GPT на запрос недостающих разделов: {missing_response[:500]}...")
+                    missing = _parse_json_sections(missing_response)
+
+                except Exception as gen_error:
+                    logger.error(f"Ошибка при генерации недостающих разделов: {gen_error}")
+
+                for i in missing_indices:
+                    if i in missing:
+                        await send_section(i, missing[i])
+                    else:
+                        # Раздела нет и после дополнительного запроса - отправляем заглушку
+                        logger.warning(f"Раздел {i + 1}. не найден в ответах GPT.")
+                        await send_section(i, "Не удалось сгенерировать этот раздел.")
+
+        except Exception as sending_error:
+            logger.error(f"Ошибка при отправке разделов бизнес-плана: {sending_error}")
+            await message.answer("Произошла ошибка при формировании бизнес-плана. Пожалуйста, попробуйте еще раз.")
 
         # Очищаем состояние
         await state.clear()
@@ -9,6 +9,11 @@ from bot.states.states import BusinessPlanStates, ValuePropositionStates, Knowle
 
 logger = logging.getLogger(__name__)
 
+# Имена состояний каждой группы, вычисляются один раз при импорте
+_BUSINESS_PLAN_STATES = frozenset(s.state for s in BusinessPlanStates.__states__)
+_VALUE_PROPOSITION_STATES = frozenset(s.state for s in ValuePropositionStates.__states__)
+_KNOWLEDGE_BASE_STATES = frozenset(s.state for s in KnowledgeBaseStates.__states__)
+
 async def cancel_command(message: types.Message, state: FSMContext):
     """
     Обработчик команды /cancel - отменяет текущую операцию пользователя
@@ -18,27 +23,26 @@ async def cancel_command(message: types.Message, state: FSMContext):
 
     # Если состояния нет, значит нечего отменять
     if current_state is None:
-        await message.answer("🤔 У вас нет активных операций для отмены.")
-        return
+        return message.answer("🤔 У вас нет активных операций для отмены.")
 
     # Определяем, какая операция отменяется
     cancel_message = "❌ Операция отменена."
 
-    if current_state in [s.state for s in BusinessPlanStates.__states__]:
+    if current_state in _BUSINESS_PLAN_STATES:
         cancel_message = "❌ Создание бизнес-плана отменено."
-    elif current_state in [s.state for s in ValuePropositionStates.__states__]:
+    elif current_state in _VALUE_PROPOSITION_STATES:
         cancel_message = "❌ Создание ценностного предложения отменено."
-    elif current_state in [s.state for s in KnowledgeBaseStates.__states__]:
+    elif current_state in _KNOWLEDGE_BASE_STATES:
         cancel_message = "❌ Работа с базой знаний отменена."
 
     # Очищаем состояние
     await state.clear()
 
-    # Отправляем сообщение об отмене
-    await message.answer(cancel_message)
-
     logger.info(f"User {message.from_user.id} canceled operation in state {current_state}")
 
+    # Сообщение об отмене не ждем, а возвращаем - его отправит диспетчер
+    return message.answer(cancel_message)
+
 def register_handlers(dp):
     """
     Регистрация обработчика команды /cancel
@@ -1,17 +1,59 @@
 """
 Обработчик команды /feedback для отправки обратной связи
 """
+import asyncio
+import html
 import logging
 from aiogram import types, Bot
 from aiogram.filters.command import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from bot.utils.rate_limiter import chat_limiter
 
 logger = logging.getLogger(__name__)
 
 # ID администратора для получения обратной связи
 ADMIN_ID = 780848273
 
+# Шаблон сообщения администратору, собирается один раз при импорте
+ADMIN_FEEDBACK_TEMPLATE = (
+    "📬 <b>Получена обратная связь!</b>\n\n"
+    "👤 <b>От пользователя:</b>\n"
+    "ID: {user_id}\n"
+    "Имя: {first_name} {last_name}\n"
+    "Username: @{username}\n\n"
+    "💬 <b>Сообщение:</b>\n"
+    "{feedback_text}"
+)
+
+# Очередь сообщений администратору: пользователь не ждет их доставки,
+# одна задача-отправитель (_admin_forwarder) отправляет их по очереди
+_admin_queue = asyncio.Queue()
+_forwarder_task = None
+
+async def _admin_forwarder(bot: Bot):
+    """Отправляет сообщения из очереди администратору с учетом лимита на чат"""
+    while True:
+        admin_text, user_id = await _admin_queue.get()
+        try:
+            async with chat_limiter(ADMIN_ID):
+                await bot.send_message(
+                    chat_id=ADMIN_ID,
+                    text=admin_text,
+                    parse_mode="HTML"
+                )
+            logger.info(f"Feedback from user {user_id} sent to admin {ADMIN_ID}")
+        except Exception as e:
+            logger.error(f"Error sending feedback from user {user_id} to admin: {e}")
+        finally:
+            _admin_queue.task_done()
+
+def _ensure_forwarder(bot: Bot):
+    """Запускает отправителя при первой обратной связи (bot доступен только в обработчике)"""
+    global _forwarder_task
+    if _forwarder_task is None or _forwarder_task.done():
+        _forwarder_task = asyncio.create_task(_admin_forwarder(bot))
+
 # Определение состояний для FSM
 class FeedbackStates(StatesGroup):
     """Состояния для обработки обратной связи"""
@@ -23,14 +65,14 @@ async def feedback_command(message: types.Message, state: FSMContext):
     """
     # Устанавливаем состояние ожидания текста обратной связи
     await state.set_state(FeedbackStates.waiting_for_feedback)
-    
-    # Отправляем сообщение с инструкцией
-    await message.answer(
+
+    logger.info(f"User {message.from_user.id} started feedback process")
+
+    # Сообщение с инструкцией не ждем, а возвращаем - его отправит диспетчер
+    return message.answer(
         "Пожалуйста, напишите ваши комментарии, пожелания или замечания по работе бота. "
         "Это сообщение будет отправлено разработчикам."
     )
-    
-    logger.info(f"User {message.from_user.id} started feedback process")
 
 async def handle_feedback_message(message: types.Message, bot: Bot, state: FSMContext):
     """
@@ -45,41 +87,28 @@ async def handle_feedback_message(message: types.Message, bot: Bot, state: FSMCo
     first_name = message.from_user.first_name or "Неизвестно"
     last_name = message.from_user.last_name or "Неизвестно"
     
-    # Формируем текст для администратора
-    admin_text = (
-        f"📬 <b>Получена обратная связь!</b>\n\n"
-        f"👤 <b>От пользователя:</b>\n"
-        f"ID: {user_id}\n"
-        f"Имя: {first_name} {last_name}\n"
-        f"Username: @{username}\n\n"
-        f"💬 <b>Сообщение:</b>\n"
-        f"{feedback_text}"
+    # Формируем текст для администратора. Данные пользователя экранируются:
+    # символы < и & в тексте или имени ломали HTML-разметку и отправку сообщения
+    admin_text = ADMIN_FEEDBACK_TEMPLATE.format(
+        user_id=user_id,
+        first_name=html.escape(first_name),
+        last_name=html.escape(last_name),
+        username=html.escape(username),
+        feedback_text=html.escape(feedback_text or "")
     )
     
-    try:
-        # Отправляем сообщение администратору
-        await bot.send_message(
-            chat_id=ADMIN_ID,
-            text=admin_text,
-            parse_mode="HTML"
-        )
-        
-        # Подтверждаем получение обратной связи пользователю
-        await message.answer(
-            "Спасибо за вашу обратную связь! Ваше сообщение отправлено разработчикам."
-        )
-        
-        logger.info(f"Feedback from user {user_id} sent to admin {ADMIN_ID}")
-        
-    except Exception as e:
-        logger.error(f"Error sending feedback to admin: {e}")
-        await message.answer(
-            "Произошла ошибка при отправке обратной связи. Пожалуйста, попробуйте позже."
-        )
-    
+    # Ставим сообщение администратору в очередь: ответ пользователю не ждет его отправки
+    _ensure_forwarder(bot)
+    _admin_queue.put_nowait((admin_text, user_id))
+
     # Очищаем состояние
     await state.clear()
 
+    # Подтверждаем получение обратной связи пользователю
+    await message.answer(
+        "Спасибо за вашу обратную связь! Ваше сообщение отправлено разработчикам."
+    )
+
 def register_handlers(dp):
     """
     Регистрация обработчиков для обратной связи
@@ -37,11 +37,12 @@ async def help_command(message: types.Message):
     """
     Обработчик команды /help
     """
-    # Отправляем сообщение с помощью
-    await message.answer(HELP_TEXT, parse_mode="HTML")
-
     logger.info(f"User {message.from_user.id} requested help")
 
+    # Возвращаем метод SendMessage вместо await: диспетчер выполнит его сам,
+    # а в режиме webhook может отправить его прямо в ответе на апдейт
+    return message.answer(HELP_TEXT, parse_mode="HTML")
+
 async def help_button_callback(callback_query: types.CallbackQuery):
     """
     Обработчик нажатия на кнопку помощи
@@ -2,82 +2,77 @@
 Обработчик для инлайн-режима Telegram
 """
 import logging
-import uuid
 import asyncio
-import time
+from typing import NamedTuple
 from aiogram import types
 from aiogram.types import InlineQueryResultArticle, InputTextMessageContent
 from bot.utils.ai_client import generate_gpt_response
 from bot.utils.text_utils import remove_asterisks
-from bot.knowledge_base.vector_kb_manager import VectorKnowledgeBaseManager
+from bot.utils.ttl_cache import TTLCache
+from bot.knowledge_base.vector_kb_manager import get_vector_kb_manager
 from bot.database import DBManager
 
 logger = logging.getLogger(__name__)
 db = DBManager()
 
-# Инициализируем менеджер базы знаний
-try:
-    kb_manager = VectorKnowledgeBaseManager()
-except Exception as e:
-    logger.error(f"Error initializing KnowledgeBaseManager for inline mode: {e}")
-    kb_manager = None
-
-# Кэш для хранения последних ответов (чтобы не генерировать заново при повторном запросе)
-RESPONSE_CACHE = {}
+# Кэш для хранения последних ответов (чтобы не генерировать заново при повторном запросе).
+# Размер ограничен: при переполнении вытесняются давно не использованные ответы,
+# истекшие записи удаляются при чтении, отдельная задача очистки не нужна
 CACHE_EXPIRATION = 600  # Время жизни кэша в секундах (10 минут)
-CACHE_TIMESTAMPS = {}  # Время добавления в кэш
-
-# Тип инлайн-ответов
-MARKETING_TYPES = [
-    {
-        "id": "quick_advice",
-        "title": "💡 Быстрый совет",
-        "description": "Краткий ответ на ваш вопрос по маркетингу",
-        "thumb_url": "https://cdn-icons-png.flaticon.com/512/1048/1048953.png"
-    },
-    {
-        "id": "content_idea",
-        "title": "📝 Идея контента",
-        "description": "Идея для поста в социальных сетях",
-        "thumb_url": "https://cdn-icons-png.flaticon.com/512/1048/1048945.png"
-    },
-    {
-        "id": "customer_message",
-        "title": "💬 Сообщение клиенту",
-        "description": "Профессиональный ответ клиенту",
-        "thumb_url": "https://cdn-icons-png.flaticon.com/512/1048/1048950.png"
-    }
+CACHE_MAX_SIZE = 10000
+RESPONSE_CACHE = TTLCache(CACHE_MAX_SIZE, CACHE_EXPIRATION)
+
+# Генерации, которые выполняются прямо сейчас: {query_text: asyncio.Task}.
+# Одинаковые запросы разных пользователей ждут одну генерацию вместо трех новых запросов к GPT
+_INFLIGHT = {}
+
+class MarketingType(NamedTuple):
+    """Тип инлайн-ответа"""
+    id: str
+    title: str
+    description: str
+    thumb_url: str
+
+# Типы инлайн-ответов
+MARKETING_TYPES = (
+    MarketingType(
+        id="quick_advice",
+        title="💡 Быстрый совет",
+        description="Краткий ответ на ваш вопрос по маркетингу",
+        thumb_url="https://cdn-icons-png.flaticon.com/512/1048/1048953.png"
+    ),
+    MarketingType(
+        id="content_idea",
+        title="📝 Идея контента",
+        description="Идея для поста в социальных сетях",
+        thumb_url="https://cdn-icons-png.flaticon.com/512/1048/1048945.png"
+    ),
+    MarketingType(
+        id="customer_message",
+        title="💬 Сообщение клиенту",
+        description="Профессиональный ответ клиенту",
+        thumb_url="https://cdn-icons-png.flaticon.com/512/1048/1048950.png"
+    ),
+)
+
+# Подсказка для пустого или слишком короткого запроса - одинакова для всех
+SHORT_QUERY_RESULTS = [
+    InlineQueryResultArticle(
+        id="short_query_hint",
+        title="✍️ Введите запрос...",
+        description="Например: идея для поста о кофейне, как отвечать на негатив, маркетинг для салона красоты",
+        input_message_content=InputTextMessageContent(
+            message_text="Чтобы получить ответ, введите запрос длиной не менее 3-х символов."
+        ),
+        thumb_url="https://cdn-icons-png.flaticon.com/512/1048/1048967.png"
+    )
 ]
 
-async def clean_cache_task():
-    """
-    Фоновая задача для периодической очистки кэша
-    """
-    while True:
-        try:
-            current_time = time.time()
-            keys_to_delete = []
-
-            # Находим устаревшие записи
-            for key, timestamp in CACHE_TIMESTAMPS.items():
-                if current_time - timestamp > CACHE_EXPIRATION:
-                    keys_to_delete.append(key)
-
-            # Удаляем устаревшие записи
-            for key in keys_to_delete:
-                if key in RESPONSE_CACHE:
-                    del RESPONSE_CACHE[key]
-                if key in CACHE_TIMESTAMPS:
-                    del CACHE_TIMESTAMPS[key]
-
-            if keys_to_delete:
-                logger.info(f"Cleaned {len(keys_to_delete)} expired cache entries")
-
-        except Exception as e:
-            logger.error(f"Error cleaning cache: {e}")
-
-        # Ждем 5 минут перед следующей проверкой
-        await asyncio.sleep(300)
+# Системные сообщения генераторов создаются один раз при импорте и идут первыми
+# в каждом запросе, префикс запроса к модели не меняется от вызова к вызову
+_SYSTEM_QUICK_ADVICE = {"role": "system", "content": "Ты — эксперт по маркетингу. Давай краткие, полезные и конкретные советы. Используй максимум 3-4 предложения. Не начинай с фраз типа 'Вот мой совет' или 'Как маркетолог'."}
+_SYSTEM_CONTENT_IDEA = {"role": "system", "content": "Ты — креативный SMM-специалист. Предлагай интересные идеи для постов в соцсетях с конкретным форматом, структурой и хештегами. Не начинай с фраз типа 'Вот моя идея' или 'Как SMM-специалист'."}
+_SYSTEM_CUSTOMER_MESSAGE = {"role": "system", "content": "Ты — профессиональный менеджер по работе с клиентами. Пиши вежливые, эмпатичные и профессиональные ответы клиентам. Не используй шаблонные фразы. Не начинай с обращений 'Уважаемый клиент'."}
 
 async def inline_query_handler(inline_query: types.InlineQuery):
     """
@@ -88,54 +83,25 @@ async def inline_query_handler(inline_query: types.InlineQuery):
 
     # Если запрос пустой или слишком короткий, предлагаем примеры
     if len(query_text) < 3:
-        results = [
-            InlineQueryResultArticle(
-                id=str(uuid.uuid4()),
-                title="✍️ Введите запрос...",
-                description="Например: идея для поста о кофейне, как отвечать на негатив, маркетинг для салона красоты",
-                input_message_content=InputTextMessageContent(
-                    message_text="Чтобы получить ответ, введите запрос длиной не менее 3-х символов."
-                ),
-                thumb_url="https://cdn-icons-png.flaticon.com/512/1048/1048967.png"
-            )
-        ]
-        await inline_query.answer(results, cache_time=5)
+        await inline_query.answer(SHORT_QUERY_RESULTS, cache_time=5)
         return
 
     try:
-        # Проверяем кэш
-        cache_key = f"{user_id}:{query_text}"
-        if cache_key in RESPONSE_CACHE:
-            results = RESPONSE_CACHE[cache_key]
+        # Проверяем кэш. Ответы не зависят от пользователя, поэтому ключ - только текст запроса
+        results = RESPONSE_CACHE.get(query_text)
+        if results is not None:
             await inline_query.answer(results, cache_time=300)
             return
 
-        # Создаем заглушки для результатов
-        placeholder_results = []
-        for type_data in MARKETING_TYPES:
-            placeholder_results.append(
-                InlineQueryResultArticle(
-                    id=f"{type_data['id']}_{uuid.uuid4()}",
-                    title=f"{type_data['title']} (Генерация...)",
-                    description="Подождите, ответ создается...",
-                    input_message_content=InputTextMessageContent(
-                        message_text=f"🔄 Генерирую {type_data['title'].lower()} на запрос: {query_text}"
-                    ),
-                    thumb_url=type_data['thumb_url']
-                )
-            )
-
-        # Отвечаем заглушками сразу, чтобы пользователь видел прогресс
-        await inline_query.answer(placeholder_results, cache_time=5)
-
-        # Выполняем фактическую генерацию ответов в фоне
-        asyncio.create_task(generate_inline_results(inline_query, query_text, user_id))
+        # Отвечаем один раз, сразу настоящими результатами: повторный answerInlineQuery
+        # на тот же запрос Telegram не принимает, поэтому заглушки не отправляем
+        await generate_inline_results(inline_query, query_text, user_id)
 
     except Exception as e:
         logger.error(f"Error processing inline query: {e}")
         error_results = [
             InlineQueryResultArticle(
-                id=str(uuid.uuid4()),
+                id=f"error_{inline_query.id}",
                 title="❌ Произошла ошибка",
                 description=f"Не удалось обработать запрос: {str(e)[:100]}",
                 input_message_content=InputTextMessageContent(
@@ -147,7 +113,7 @@ async def inline_query_handler(inline_query: types.InlineQuery):
 
 async def generate_inline_results(inline_query: types.InlineQuery, query_text: str, user_id: int):
     """
-    Генерирует результаты для инлайн-запроса в фоновом режиме
+    Генерирует результаты для инлайн-запроса и отвечает на него
 
     Args:
         inline_query: Инлайн-запрос
@@ -156,51 +122,22 @@ async def generate_inline_results(inline_query: types.InlineQuery, query_text: s
     """
     try:
         # Обновляем активность пользователя
-        db.update_user_activity(user_id)
-
-        # Ищем релевантную информацию в базе знаний
-        knowledge_content = None
-        if kb_manager:
-            knowledge_content = kb_manager.get_content_for_query(query_text)
-
-        # Генерируем ответы для разных типов
-        results = []
-
-        for type_data in MARKETING_TYPES:
-            # Формируем запрос в зависимости от типа
-            if type_data["id"] == "quick_advice":
-                content = await generate_quick_advice(query_text, knowledge_content)
-            elif type_data["id"] == "content_idea":
-                content = await generate_content_idea(query_text, knowledge_content)
-            elif type_data["id"] == "customer_message":
-                content = await generate_customer_message(query_text, knowledge_content)
-            else:
-                content = "Неизвестный тип запроса"
-
-            # Добавляем в результаты
-            results.append(
-                InlineQueryResultArticle(
-                    id=f"{type_data['id']}_{uuid.uuid4()}",
-                    title=type_data['title'],
-                    description=content[:100] + "..." if len(content) > 100 else content,
-                    input_message_content=InputTextMessageContent(
-                        message_text=content,
-                        parse_mode="HTML"
-                    ),
-                    thumb_url=type_data['thumb_url']
-                )
-            )
+        await db.update_user_activity_async(user_id)
 
-        # Сохраняем в кэш
-        cache_key = f"{user_id}:{query_text}"
-        RESPONSE_CACHE[cache_key] = results
-        CACHE_TIMESTAMPS[cache_key] = time.time()  # Обновляем timestamp
+        # Если такой же запрос уже генерируется, ждем его результат.
+        # shield: отмена одного ожидающего не отменяет общую генерацию
+        task = _INFLIGHT.get(query_text)
+        if task is None:
+            task = asyncio.create_task(build_inline_results(query_text))
+            _INFLIGHT[query_text] = task
+            task.add_done_callback(lambda _: _INFLIGHT.pop(query_text, None))
+        results = await asyncio.shield(task)
 
         # Отправляем новые результаты
         await inline_query.answer(results, cache_time=300)
 
         # Увеличиваем счетчик сообщений пользователя
-        db.increment_message_count(user_id)
+        await db.increment_message_count_async(user_id)
 
     except Exception as e:
         logger.error(f"Error generating inline results: {e}")
@@ -208,7 +145,7 @@ async def generate_inline_results(inline_query: types.InlineQuery, query_text: s
         # Отправляем сообщение об ошибке
         error_results = [
             InlineQueryResultArticle(
-                id=str(uuid.uuid4()),
+                id=f"error_{inline_query.id}",
                 title="❌ Произошла ошибка",
                 description=f"Не удалось обработать запрос: {str(e)[:100]}",
                 input_message_content=InputTextMessageContent(
@@ -218,6 +155,75 @@ async def generate_inline_results(inline_query: types.InlineQuery, query_text: s
         ]
         await inline_query.answer(error_results, cache_time=5)
 
+def _find_knowledge_content(query_text):
+    """
+    Поиск в базе знаний для инлайн-запроса. Менеджер общий с остальными обработчиками
+    и берется при первом запросе, а не при импорте: к этому времени main.py уже
+    пересоздал векторный индекс
+    """
+    try:
+        kb_manager = get_vector_kb_manager()
+    except Exception as e:
+        logger.error(f"Error initializing KnowledgeBaseManager for inline mode: {e}")
+        return None
+    return kb_manager.get_content_for_query(query_text)
+
+async def build_inline_results(query_text: str) -> list:
+    """
+    Генерирует ответы всех типов на запрос и кэширует полный набор
+
+    Args:
+        query_text: Текст запроса
+
+    Returns:
+        list: Результаты для ответа на инлайн-запрос
+    """
+    # Ищем релевантную информацию в базе знаний (поиск синхронный - выполняем в потоке)
+    knowledge_content = await asyncio.to_thread(_find_knowledge_content, query_text)
+
+    # Генерируем ответы для всех типов параллельно: ждем самый долгий запрос, а не сумму.
+    # Ошибка одного типа не отменяет остальные
+    generators = {
+        "quick_advice": generate_quick_advice,
+        "content_idea": generate_content_idea,
+        "customer_message": generate_customer_message,
+    }
+    contents = await asyncio.gather(
+        *(generators[type_data.id](query_text, knowledge_content) for type_data in MARKETING_TYPES),
+        return_exceptions=True
+    )
+
+    results = []
+    for type_data, content in zip(MARKETING_TYPES, contents):
+        if isinstance(content, Exception):
+            logger.error(f"Error generating inline result {type_data.id}: {content}")
+            continue
+
+        # Добавляем в результаты
+        results.append(
+            InlineQueryResultArticle(
+                # Результаты общие для всех пользователей: id достаточно уникальности в ответе
+                id=type_data.id,
+                title=type_data.title,
+                description=content[:100] + "..." if len(content) > 100 else content,
+                input_message_content=InputTextMessageContent(
+                    message_text=content,
+                    parse_mode="HTML"
+                ),
+                thumb_url=type_data.thumb_url
+            )
+        )
+
+    if not results:
+        # Все генерации завершились ошибкой - вызывающий код ответит сообщением об ошибке
+        raise contents[0]
+
+    # Сохраняем в кэш только полный набор ответов, неполный сгенерируется заново
+    if len(results) == len(MARKETING_TYPES):
+        RESPONSE_CACHE.set(query_text, results)
+
+    return results
+
 async def generate_quick_advice(query_text: str, knowledge_content: str = None) -> str:
     """
     Генерирует быстрый совет по маркетингу
@@ -235,7 +241,7 @@ async def generate_quick_advice(query_text: str, knowledge_content: str = None)
         prompt += f"\n\nИспользуй эту информацию из базы знаний при ответе:\n{knowledge_content}"
 
     messages = [
-        {"role": "system", "content": "Ты — эксперт по маркетингу. Давай краткие, полезные и конкретные советы. Используй максимум 3-4 предложения. Не начинай с фраз типа 'Вот мой совет' или 'Как маркетолог'."},
+        _SYSTEM_QUICK_ADVICE,
         {"role": "user", "content": prompt}
     ]
 
@@ -266,7 +272,7 @@ async def generate_content_idea(query_text: str, knowledge_content: str = None)
         prompt += f"\n\nИспользуй эту информацию из базы знаний при ответе:\n{knowledge_content}"
 
     messages = [
-        {"role": "system", "content": "Ты — креативный SMM-специалист. Предлагай интересные идеи для постов в соцсетях с конкретным форматом, структурой и хештегами. Не начинай с фраз типа 'Вот моя идея' или 'Как SMM-специалист'."},
+        _SYSTEM_CONTENT_IDEA,
         {"role": "user", "content": prompt}
     ]
 
@@ -297,7 +303,7 @@ async def generate_customer_message(query_text: str, knowledge_content: str = No
         prompt += f"\n\nИспользуй эту информацию из базы знаний при ответе:\n{knowledge_content}"
 
     messages = [
-        {"role": "system", "content": "Ты — профессиональный менеджер по работе с клиентами. Пиши вежливые, эмпатичные и профессиональные ответы клиентам. Не используй шаблонные фразы. Не начинай с обращений 'Уважаемый клиент'."},
+        _SYSTEM_CUSTOMER_MESSAGE,
         {"role": "user", "content": prompt}
     ]
 
@@ -315,8 +321,5 @@ def register_handlers(dp):
     """
     Регистрация обработчиков инлайн-режима
     """
-    # Запускаем фоновую задачу очистки кэша
-    asyncio.create_task(clean_cache_task())
-
     # Регистрируем обработчик инлайн-запросов
     dp.inline_query.register(inline_query_handler)
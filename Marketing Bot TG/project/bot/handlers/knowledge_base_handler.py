@@ -3,6 +3,7 @@
 """
 import os
 import logging
+import asyncio
 import tempfile
 from aiogram import types, F
 from aiogram.filters.command import Command
@@ -19,6 +20,9 @@ kb_manager = KnowledgeBaseManager()
 TEMP_DIR = "temp_uploads"
 os.makedirs(TEMP_DIR, exist_ok=True)
 
+# Ссылки на фоновые задачи обработки документов: без них задача может быть собрана GC
+_background_tasks = set()
+
 async def kb_start_command(message: types.Message):
     """
     Обработчик команды /kb - основное меню базы знаний
@@ -107,8 +111,9 @@ async def process_pdf_upload(message: types.Message, state: FSMContext):
     # Создаем путь для временного файла
     temp_file_path = os.path.join(TEMP_DIR, message.document.file_name)
 
-    # Загружаем файл
-    await message.document.download(destination=temp_file_path)
+    # Загружаем файл: Bot.download пишет его на диск частями по мере получения,
+    # не держа весь PDF в памяти
+    await message.bot.download(message.document, destination=temp_file_path)
 
     # Сохраняем путь к файлу
     await state.update_data(file_path=temp_file_path)
@@ -140,9 +145,27 @@ async def process_pdf_title(message: types.Message, state: FSMContext):
     # Отправляем сообщение о начале обработки
     processing_msg = await message.answer("⏳ Обрабатываю PDF файл, это может занять некоторое время...")
 
+    # Очищаем состояние
+    await state.clear()
+
+    # Разбор PDF и построение индекса занимают до нескольких минут: выполняем их в потоке
+    # в фоновой задаче, обработчик сразу освобождается. Результат придет правкой processing_msg
+    task = asyncio.create_task(ingest_document(processing_msg, file_path, title))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+async def ingest_document(processing_msg: types.Message, file_path: str, title: str):
+    """
+    Добавляет загруженный PDF в базу знаний и сообщает администратору результат
+
+    Args:
+        processing_msg: Сообщение о начале обработки, в нем показывается результат
+        file_path: Путь к временному файлу
+        title: Название документа
+    """
     try:
         # Добавляем документ в базу знаний
-        result = kb_manager.add_document_to_knowledge_base(file_path, title)
+        result = await asyncio.to_thread(kb_manager.add_document_to_knowledge_base, file_path, title)
 
         if result['success']:
             await processing_msg.edit_text(
@@ -156,9 +179,6 @@ async def process_pdf_title(message: types.Message, state: FSMContext):
         logger.error(f"Error processing PDF: {str(e)}")
         await processing_msg.edit_text(f"❌ Произошла ошибка при обработке файла: {str(e)}")
 
-    # Очищаем состояние
-    await state.clear()
-
     # Удаляем временный файл
     try:
         if os.path.exists(file_path):
@@ -220,8 +240,8 @@ async def process_delete_choice(message: types.Message, state: FSMContext):
     doc = docs[doc_index]
     
     try:
-        # Удаляем документ из базы знаний
-        result = kb_manager.delete_document_from_knowledge_base(doc['doc_id'])
+        # Удаляем документ из базы знаний (синхронная работа с БД и файлами - в потоке)
+        result = await asyncio.to_thread(kb_manager.delete_document_from_knowledge_base, doc['doc_id'])
         
         if result['success']:
             await message.answer(f"✅ Документ \"{doc['title']}\" успешно удален из базы знаний!")
@@ -3,11 +3,12 @@ Handlers for general text messages
 """
 import logging
 import asyncio
+from collections import deque
 from aiogram import types, F
 from bot.config import config
 from bot.config.prompts import GPT_CONTEXT, KNOWLEDGE_BASE_CONTEXT
 from bot.database.async_db_manager import AsyncDBManager
-from bot.utils import remove_asterisks, split_message
+from bot.utils import TTLCache, remove_asterisks, split_message
 from bot.utils.ai_client import generate_gpt_response
 from bot.knowledge_base import KnowledgeBaseManager
 from aiogram.filters import Filter
@@ -16,6 +17,63 @@ logger = logging.getLogger(__name__)
 db = AsyncDBManager()
 kb_manager = KnowledgeBaseManager()
 
+# Ссылки на фоновые задачи записи в БД: без них задача может быть собрана GC до завершения
+_background_tasks = set()
+
+def _run_in_background(coro):
+    """Запускает запись в БД, не дожидаясь ее: пользователь не ждет результата"""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+# Готовая к отправке в GPT история пользователя: {user_id: deque из пар user/assistant}.
+# Строится из БД один раз, дальше новые ответы дописываются в конец,
+# а deque(maxlen) сам отбрасывает самые старые сообщения
+HISTORY_CACHE_SIZE = 2048
+HISTORY_CACHE_TTL = 3600  # 1 час: после очистки истории в БД кэш тоже устареет
+_history_cache = TTLCache(HISTORY_CACHE_SIZE, HISTORY_CACHE_TTL)
+
+async def _get_history_messages(user_id):
+    """Возвращает историю пользователя в формате messages (в хронологическом порядке)"""
+    history = _history_cache.get(user_id)
+    if history is None:
+        # Записи уже в хронологическом порядке и без NULL (отбор и сортировка в SQL)
+        chat_history = await db.get_chat_history(user_id, config.GPT_HISTORY_TURNS)
+        history = deque(maxlen=2 * config.GPT_HISTORY_TURNS)
+        for msg, resp in chat_history:
+            history.append({"role": "user", "content": msg})
+            history.append({"role": "assistant", "content": resp})
+        _history_cache.set(user_id, history)
+    return history
+
+def _append_history(user_id, message, response):
+    """Дописывает новую пару в кэш истории (если история пользователя уже в кэше)"""
+    history = _history_cache.get(user_id)
+    if history is not None:
+        history.append({"role": "user", "content": message})
+        history.append({"role": "assistant", "content": response})
+
+# Кнопка под сообщением о превышении лимита (одна на все сообщения)
+_LIMIT_KB = types.InlineKeyboardMarkup(inline_keyboard=[
+    [types.InlineKeyboardButton(
+        text="💎 Оформить подписку",
+        callback_data="open_subscription"
+    )]
+])
+
+async def _send_first_part(message, processing_task, text):
+    """
+    Заменяет текст сообщения "Обрабатываю..." первой частью ответа.
+    Если сообщение не отправилось или правка не удалась, часть отправляется новым сообщением
+    """
+    try:
+        processing_msg = await processing_task
+        await processing_msg.edit_text(text)
+    except Exception as e:
+        logger.warning(f"Failed to edit processing message, sending the first part separately: {e}")
+        await message.answer(text)
+
 async def handle_message(message: types.Message):
     """Handler for general text messages"""
     user_id = message.from_user.id
@@ -29,58 +87,38 @@ async def handle_message(message: types.Message):
         reply_to_message_text = message.reply_to_message.text
         logger.info(f"User {user_id} replied to bot message")
 
-    # Update last activity
-    await db.update_user_activity(user_id)
-    
-    # Сразу сохраняем входящее сообщение в историю чата
-    # Это гарантирует, что даже если инкремент счетчика не сработает,
-    # сообщение будет учтено при подсчете сообщений из истории
+    # Send processing message. Отправка идет параллельно с записью в БД, проверкой лимита
+    # и поиском в базе знаний: само сообщение нужно только когда его пора редактировать
+    processing_task = asyncio.create_task(message.answer("Обрабатываю ваш запрос..."))
+
+    # Increment message count immediately for any text message handled.
+    # Сохраняем входящее сообщение в историю чата (response будет заполнен позже)
+    # и увеличиваем счетчик сообщений (запись счетчика в БД отложенная, но
+    # get_user_message_count учитывает ее сразу)
     logger.info(f"Saving incoming message from user {user_id} to chat history")
-    message_saved = await db.save_chat_message(user_id, user_message, None)  # Response будет заполнен позже
-    if not message_saved:
-        logger.error(f"Failed to save message to chat history for user {user_id}")
-
-    # Increment message count immediately for any text message handled
-    # Читаем текущий счетчик ДО инкремента для лога
-    msg_count_before_increment = await db.get_user_message_count(user_id) 
-    logger.info(f"Attempting to increment message count for user {user_id} upon receiving message. Count before: {msg_count_before_increment}")
-    
-    # Увеличиваем счетчик сообщений
-    increment_success = await db.increment_message_count(user_id)
+    # record_user_turn возвращает rowid сообщения: по нему запишем ответ
+    turn_rowid = await db.record_user_turn(user_id, user_message)
     
     # Проверяем результат инкремента
-    if increment_success:
-        # Reading count again immediately to confirm increment
-        new_count_read = await db.get_user_message_count(user_id)
-        logger.info(f"Successfully incremented message count for user {user_id}. Count read after increment: {new_count_read}")
-        
-        # Дополнительная проверка, что счетчик действительно увеличился
-        if new_count_read <= msg_count_before_increment and msg_count_before_increment > 0:
-            logger.warning(f"Counter anomaly detected for user {user_id}: before={msg_count_before_increment}, after={new_count_read}")
-    else:
-        logger.error(f"Failed to increment message count for user {user_id}")
-
-    # Send processing message
-    processing_msg = await message.answer("Обрабатываю ваш запрос...")
+    if not turn_rowid:
+        logger.error(f"Failed to save message and increment message count for user {user_id}")
+    elif logger.isEnabledFor(logging.DEBUG):
+        # Счетчик нужен только для отладочного лога: без DEBUG чтения из БД нет.
+        # Приращение счетчика в памяти не может потеряться, поэтому сравнивать
+        # его со значением до инкремента не нужно
+        logger.debug("Incremented message count for user %s. Count now: %s", user_id, await db.get_user_message_count(user_id))
 
     try:
         # Check message limits (Проверка лимита остается здесь, но счетчик уже увеличен)
-        subscription = await db.get_subscription_status(user_id)
-        # Получаем актуальные значения прямо перед проверкой (счетчик уже должен быть инкрементирован)
-        msg_count = await db.get_user_message_count(user_id) 
-        limit = await db.get_message_limit(user_id)
+        # Получаем актуальные значения прямо перед проверкой (счетчик уже должен быть инкрементирован),
+        # счетчик, подписку и лимит - одним запросом
+        msg_count, subscription, limit = await db.get_user_limits_snapshot(user_id)
         logger.info(f"Checking limits for user {user_id}. Count: {msg_count}, Limit: {limit}, Subscription: {subscription}")
 
         if msg_count > limit: # Изменяем проверку на строгую > , т.к. инкремент был до проверки
             # Если пользователь превысил лимит (с учетом только что отправленного сообщения)
-            keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
-                [types.InlineKeyboardButton(
-                    text="💎 Оформить подписку",
-                    callback_data="open_subscription"
-                )]
-            ])
-            
             # Корректируем текст, чтобы он отражал, что лимит превышен *включая* текущее сообщение
+            processing_msg = await processing_task
             await processing_msg.edit_text(
                 "🔒 <b>Достигнут лимит сообщений</b>\n\n"
                 f"Вы использовали {msg_count} из {limit} доступных сообщений в вашем тарифе '{subscription}' (включая только что отправленное).\n\n"
@@ -88,13 +126,13 @@ async def handle_message(message: types.Message):
                 "• Оформить платную подписку\n"
                 "• Дождаться сброса лимита\n\n"
                 "Платная подписка открывает доступ к расширенным функциям и увеличивает лимит сообщений.",
-                reply_markup=keyboard,
+                reply_markup=_LIMIT_KB,
                 parse_mode="HTML"
             )
             return
 
-        # Поиск в базе знаний релевантного контента
-        knowledge_content = kb_manager.get_content_for_query(user_message)
+        # Поиск в базе знаний релевантного контента (синхронный, в отдельном потоке)
+        knowledge_content = await asyncio.to_thread(kb_manager.get_content_for_query, user_message)
 
         # Если это ответ на сообщение бота, добавляем контекст ответа
         if is_reply and reply_to_message_text:
@@ -109,20 +147,34 @@ async def handle_message(message: types.Message):
         # Remove formatting
         response = remove_asterisks(response)
 
-        # Update the message in history with the response
-        await db.update_chat_response(user_id, user_message, response)
-        logger.info(f"Updated chat history with response for user {user_id}")
-
-        # Delete processing message
-        await processing_msg.delete()
-
-        # Send response (respecting Telegram message limits)
-        message_parts = split_message(response)
-        for part in message_parts:
+        # Записываем ответ в историю в фоне: отправка ответа его не ждет.
+        # С известным rowid ответ уходит в общую очередь записи и коммитится пачкой
+        if turn_rowid:
+            await db.queue_chat_response(user_id, turn_rowid, response)
+        else:
+            _run_in_background(db.update_chat_response(user_id, user_message, response))
+        # В БД сохраняется исходное сообщение пользователя (без контекста ответа)
+        _append_history(user_id, user_message, response)
+        logger.info(f"Scheduled chat history update with response for user {user_id}")
+
+        # Send response (respecting Telegram message limits).
+        # Первая часть заменяет сообщение "Обрабатываю..." (одна правка вместо удаления
+        # и новой отправки), остальные отправляются по одной, чтобы сохранить порядок в чате.
+        # Остальные части ждут первую: если правка не удалась, первая часть уходит
+        # отдельным сообщением и все равно оказывается перед ними
+        first_part, *other_parts = split_message(response)
+        await _send_first_part(message, processing_task, first_part)
+        for part in other_parts:
             await message.answer(part)
 
     except Exception as e:
         logger.error(f"Error processing message: {str(e)}")
+        # Сообщение об ошибке заменяет "Обрабатываю...", только если оно было отправлено
+        try:
+            processing_msg = await processing_task
+        except Exception as send_error:
+            logger.error(f"Failed to send processing message: {send_error}")
+            return
         await processing_msg.edit_text(
             "Произошла ошибка при обработке вашего запроса. Пожалуйста, попробуйте позже."
         )
@@ -131,9 +183,6 @@ async def gpt_request(prompt, user_id, knowledge_content=None, max_retry=2):
     """Generate response from GPT with retry logic"""
     retry_count = 0
 
-    # Get chat history from database
-    chat_history = await db.get_chat_history(user_id)
-
     # Determine context based on knowledge content
     system_content = GPT_CONTEXT
     if knowledge_content:
@@ -142,18 +191,9 @@ async def gpt_request(prompt, user_id, knowledge_content=None, max_retry=2):
             knowledge_content=knowledge_content
         )
 
-    # Format messages for the GPT API
-    messages = [{"role": "system", "content": system_content}]
-
-    # Add reversed history (chronological order)
-    if chat_history:
-        for msg, resp in reversed(chat_history):
-            # Дополнительная проверка на случай, если в истории оказались записи с null
-            if msg is not None and resp is not None:
-                messages.append({"role": "user", "content": msg})
-                messages.append({"role": "assistant", "content": resp})
-            else:
-                logger.warning(f"Skipping null message or response in chat history for user {user_id}")
+    # Format messages for the GPT API: история берется из кэша уже отформатированной
+    history = await _get_history_messages(user_id)
+    messages = [{"role": "system", "content": system_content}, *history]
 
     # Add current user message
     messages.append({"role": "user", "content": prompt})
@@ -1,22 +1,25 @@
 """
 Модуль для обработки платежей и подписок в Telegram боте
 """
+import asyncio
 import logging
-from datetime import datetime, timedelta
+import time
+from datetime import datetime
 from aiogram import types, Router, F
 from aiogram.filters import Command
 from aiogram.types import Message
 from aiogram.fsm.context import FSMContext
 
 from bot.config import config
-from bot.database import DBManager
+from bot.database import DBManager, AsyncDBManager
 from bot.utils.yookassa_client import create_payment, check_payment_status
 
 # Инициализируем логгер
 logger = logging.getLogger(__name__)
 
-# Инициализируем базу данных
-db = DBManager()
+# Инициализируем базу данных: обработчики асинхронные, поэтому и запросы к БД
+# не должны блокировать цикл событий
+db = AsyncDBManager()
 
 # Настройки платежей
 CURRENCY = config.PAYMENT_CURRENCY
@@ -30,6 +33,36 @@ SUBSCRIPTION = {
     "messages_limit": 500  # Лимит сообщений
 }
 
+# Тексты и клавиатура /subscribe не зависят от пользователя: собираются один раз,
+# при вызове подставляются только дата окончания и счетчик сообщений
+_PREMIUM_TEXT_TEMPLATE = (
+    "🔹 <b>Информация о подписке</b>\n\n"
+    "У вас активна <b>Премиум подписка</b>\n"
+    "Действует до: <b>{expiry_str}</b>\n"
+    f"Использовано сообщений: <b>{{msg_count}}/{SUBSCRIPTION['messages_limit']}</b>\n\n"
+    "Хотите продлить подписку?"
+)
+_FREE_LIMIT = config.SUBSCRIPTION_LIMITS["free"]
+_FREE_TEXT_TEMPLATE = (
+    "🔹 <b>Информация о подписке</b>\n\n"
+    "У вас базовый тариф (бесплатный)\n"
+    f"Лимит сообщений: <b>{_FREE_LIMIT}</b>\n"
+    f"Использовано: <b>{{msg_count}}/{_FREE_LIMIT}</b>\n\n"
+    "Преимущества Премиум подписки:\n"
+    f"✅ Расширенный лимит сообщений: {SUBSCRIPTION['messages_limit']}\n"
+    "✅ Доступ ко всем функциям бота\n"
+    "✅ Приоритетная поддержка\n\n"
+    f"Стоимость: <b>{SUBSCRIPTION['price']} {CURRENCY}</b>\n"
+    f"Срок: <b>{SUBSCRIPTION['days']} дней</b>"
+)
+# Кнопка для оплаты
+_SUBSCRIPTION_KB = types.InlineKeyboardMarkup(inline_keyboard=[
+    [types.InlineKeyboardButton(
+        text=f"Оформить подписку за {SUBSCRIPTION['price']} {CURRENCY}",
+        callback_data="subscribe"
+    )]
+])
+
 async def subscription_command(message: Message):
     """
     Обработчик команды /subscribe - показывает информацию о подписке
@@ -44,13 +77,13 @@ async def subscription_command(message: Message):
     
     # Получаем информацию о текущем статусе подписки пользователя
     user_id = message.from_user.id
-    subscription_status = db.get_subscription_status(user_id)
-    msg_count = db.get_user_message_count(user_id)
+    subscription_status = await db.get_subscription_status(user_id)
+    msg_count = await db.get_user_message_count(user_id)
     
     # Формируем текст сообщения
     if subscription_status == "premium":
         # Получаем дату окончания подписки
-        expiry_date = db.execute_query(
+        expiry_date = await db.execute_query(
             "SELECT subscription_expiry FROM users WHERE user_id = ?",
             (user_id,),
             True
@@ -59,47 +92,18 @@ async def subscription_command(message: Message):
         expiry_str = "Неизвестно"
         if expiry_date and expiry_date[0][0]:
             try:
-                # Преобразуем строку даты в объект datetime
-                if isinstance(expiry_date[0][0], str):
-                    expiry = datetime.fromisoformat(expiry_date[0][0])
-                else:
-                    expiry = expiry_date[0][0]
+                # Срок подписки хранится в секундах Unix
+                expiry = datetime.fromtimestamp(expiry_date[0][0])
                 expiry_str = expiry.strftime("%d.%m.%Y")
             except Exception as e:
                 logger.error(f"Error parsing expiry date: {e}")
         
-        text = (
-            f"🔹 <b>Информация о подписке</b>\n\n"
-            f"У вас активна <b>Премиум подписка</b>\n"
-            f"Действует до: <b>{expiry_str}</b>\n"
-            f"Использовано сообщений: <b>{msg_count}/{SUBSCRIPTION['messages_limit']}</b>\n\n"
-            f"Хотите продлить подписку?"
-        )
+        text = _PREMIUM_TEXT_TEMPLATE.format(expiry_str=expiry_str, msg_count=msg_count)
     else:
-        limit = config.SUBSCRIPTION_LIMITS["free"]
-        text = (
-            f"🔹 <b>Информация о подписке</b>\n\n"
-            f"У вас базовый тариф (бесплатный)\n"
-            f"Лимит сообщений: <b>{limit}</b>\n"
-            f"Использовано: <b>{msg_count}/{limit}</b>\n\n"
-            f"Преимущества Премиум подписки:\n"
-            f"✅ Расширенный лимит сообщений: {SUBSCRIPTION['messages_limit']}\n"
-            f"✅ Доступ ко всем функциям бота\n"
-            f"✅ Приоритетная поддержка\n\n"
-            f"Стоимость: <b>{SUBSCRIPTION['price']} {CURRENCY}</b>\n"
-            f"Срок: <b>{SUBSCRIPTION['days']} дней</b>"
-        )
-    
-    # Создаем кнопку для оплаты
-    keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
-        [types.InlineKeyboardButton(
-            text=f"Оформить подписку за {SUBSCRIPTION['price']} {CURRENCY}",
-            callback_data="subscribe"
-        )]
-    ])
+        text = _FREE_TEXT_TEMPLATE.format(msg_count=msg_count)
     
     # Отправляем сообщение с информацией о подписке
-    await message.answer(text, reply_markup=keyboard, parse_mode="HTML")
+    await message.answer(text, reply_markup=_SUBSCRIPTION_KB, parse_mode="HTML")
     
     logger.info(f"Subscription info shown to user {user_id}")
 
@@ -111,8 +115,9 @@ async def subscribe_callback(callback_query: types.CallbackQuery):
     
     user_id = callback_query.from_user.id
     
-    # Создаем платеж в ЮKassa
-    payment_info = create_payment(
+    # Создаем платеж в ЮKassa (синхронный HTTP-запрос SDK - в отдельном потоке)
+    payment_info = await asyncio.to_thread(
+        create_payment,
         amount=SUBSCRIPTION["price"],
         description=f"{SUBSCRIPTION['title']} - {SUBSCRIPTION['description']}",
         user_id=user_id,
@@ -126,7 +131,7 @@ async def subscribe_callback(callback_query: types.CallbackQuery):
         return
     
     # Сохраняем информацию о платеже в базе данных
-    db.save_payment_info(user_id, payment_info["id"], "premium", SUBSCRIPTION["price"])
+    await db.save_payment_info(user_id, payment_info["id"], "premium", SUBSCRIPTION["price"])
     
     # Создаем клавиатуру с кнопками оплаты и проверки
     keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
@@ -163,7 +168,7 @@ async def check_payment_callback(callback_query: types.CallbackQuery):
     user_id = callback_query.from_user.id
     
     # Получаем информацию о последнем платеже пользователя
-    payment_info = db.get_last_payment(user_id)
+    payment_info = await db.get_last_payment(user_id)
     
     if not payment_info:
         await callback_query.message.answer("⚠️ Информация о платеже не найдена")
@@ -172,7 +177,7 @@ async def check_payment_callback(callback_query: types.CallbackQuery):
     payment_id = payment_info[0]
     
     # Проверяем статус платежа
-    payment_status = check_payment_status(payment_id)
+    payment_status = await asyncio.to_thread(check_payment_status, payment_id)
     
     if not payment_status:
         await callback_query.message.answer(
@@ -183,8 +188,11 @@ async def check_payment_callback(callback_query: types.CallbackQuery):
     # Если платеж успешно оплачен
     if payment_status["status"] == "succeeded" and payment_status["paid"]:
         # Обновляем статус подписки пользователя
-        update_subscription(user_id, "premium", SUBSCRIPTION["days"])
-        update_message_limit(user_id, SUBSCRIPTION["messages_limit"])
+        await update_subscription(user_id, "premium", SUBSCRIPTION["days"])
+        await update_message_limit(user_id, SUBSCRIPTION["messages_limit"])
+        # Статус и лимит кэшируются в обоих менеджерах БД
+        db.invalidate_subscription_cache(user_id)
+        DBManager().invalidate_subscription_cache(user_id)
         
         # Отправляем сообщение об успешной подписке
         await callback_query.message.answer(
@@ -205,34 +213,34 @@ async def check_payment_callback(callback_query: types.CallbackQuery):
             parse_mode="HTML"
         )
 
-def update_subscription(user_id: int, status: str, days: int):
+async def update_subscription(user_id: int, status: str, days: int):
     """
     Обновляет статус подписки пользователя в базе данных
     """
     try:
-        # Вычисляем дату окончания подписки
-        expiry_date = datetime.now() + timedelta(days=days)
+        # Вычисляем дату окончания подписки (секунды Unix, как хранится в users)
+        expiry_ts = int(time.time()) + days * 86400
         
         # Обновляем статус подписки и дату окончания
-        db.execute_query(
+        await db.execute_query(
             "UPDATE users SET subscription_status = ?, subscription_expiry = ? WHERE user_id = ?",
-            (status, expiry_date, user_id)
+            (status, expiry_ts, user_id)
         )
         
-        logger.info(f"Updated subscription for user {user_id} to {status} until {expiry_date}")
+        logger.info(f"Updated subscription for user {user_id} to {status} until {expiry_ts}")
         return True
     except Exception as e:
         logger.error(f"Error updating subscription for user {user_id}: {e}")
         return False
 
-def update_message_limit(user_id: int, limit: int):
+async def update_message_limit(user_id: int, limit: int):
     """
     Обновляет лимит сообщений пользователя в базе данных
     """
     try:
         # Обновляем лимит сообщений для пользователя
         # Сначала сбрасываем счетчик сообщений
-        db.execute_query(
+        await db.execute_query(
             "UPDATE users SET messages_count = 0, message_limit = ? WHERE user_id = ?",
             (limit, user_id)
         )
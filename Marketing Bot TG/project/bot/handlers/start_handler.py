@@ -19,7 +19,7 @@ async def start_command(message: types.Message):
     first_name = message.from_user.first_name
     
     # Обновляем информацию о активности пользователя
-    db.update_user_activity(user_id)
+    await db.update_user_activity_async(user_id)
     
     # Отправляем приветственное сообщение
     await message.answer(
@@ -2,6 +2,7 @@
 Обработчик для создания ценностного предложения
 """
 import logging
+import asyncio
 import re
 from aiogram import types, F
 from aiogram.filters.command import Command
@@ -51,11 +52,13 @@ async def handle_value_proposition_info(message: types.Message, state: FSMContex
 
     try:
         # Импортируем здесь, чтобы избежать циклических импортов
-        from bot.knowledge_base.vector_kb_manager import VectorKnowledgeBaseManager
-        
-        # Получаем контент из базы знаний по запросу
-        kb_manager = VectorKnowledgeBaseManager()
-        knowledge_content = kb_manager.get_content_for_query(business_info)
+        from bot.knowledge_base.vector_kb_manager import get_vector_kb_manager
+
+        # Получаем контент из базы знаний по запросу. Менеджер общий (индекс загружается
+        # один раз), а поиск с запросом embeddings выполняется в отдельном потоке,
+        # чтобы не блокировать цикл событий
+        kb_manager = get_vector_kb_manager()
+        knowledge_content = await asyncio.to_thread(kb_manager.get_content_for_query, business_info)
         
         # Добавляем дополнительный контекст из базы знаний, если он найден
         kb_context = ""
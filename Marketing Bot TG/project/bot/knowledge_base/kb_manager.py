@@ -3,6 +3,7 @@
 """
 import os
 import logging
+import functools
 import time
 import json
 import sqlite3
@@ -11,11 +12,36 @@ import PyPDF2
 import docx  # Добавляем библиотеку для работы с DOCX
 from bot.config import config
 from bot.database import DBManager
+from bot.utils.ttl_cache import TTLCache
 import shutil
 from docx import Document
 
 logger = logging.getLogger(__name__)
 
+# Кэш результатов get_content_for_query. База знаний меняется только при загрузке
+# и удалении документов (тогда кэш очищается), поэтому записи живут долго.
+# Общий для всех экземпляров менеджеров: ключ - (вид поиска, нормализованный запрос)
+KB_QUERY_CACHE_TTL = 6 * 60 * 60
+KB_QUERY_CACHE_SIZE = 2048
+query_cache = TTLCache(KB_QUERY_CACHE_SIZE, KB_QUERY_CACHE_TTL)
+
+# Отличает промах кэша от закэшированного None (в базе знаний ничего не найдено)
+CACHE_MISS = object()
+
+def normalize_query(query):
+    """Ключ кэша: поиск не зависит от регистра и лишних пробелов"""
+    return " ".join(query.lower().split())
+
+def invalidates_query_cache(method):
+    """Декоратор методов, изменяющих базу знаний: после них кэш запросов очищается"""
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        try:
+            return method(*args, **kwargs)
+        finally:
+            query_cache.clear()
+    return wrapper
+
 class KnowledgeBaseManager:
     """
     Класс для управления базой знаний, включающей PDF документы.
@@ -167,6 +193,7 @@ class KnowledgeBaseManager:
         """
         return self._extract_text_from_file(pdf_path)
 
+    @invalidates_query_cache
     def load_document_directly(self, file_path, title=None):
         """
         Загрузить документ напрямую из локального пути (PDF или DOCX).
@@ -418,6 +445,7 @@ class KnowledgeBaseManager:
             logger.error(error_msg)
             return False, error_msg
 
+    @invalidates_query_cache
     def add_pdf_to_knowledge_base(self, file_path, title, admin_id):
         """
         Добавить PDF файл в базу знаний
@@ -524,6 +552,7 @@ class KnowledgeBaseManager:
             logger.error(f"Ошибка при добавлении PDF в базу знаний: {e}")
             return False
 
+    @invalidates_query_cache
     def remove_pdf_from_knowledge_base(self, filename, admin_id):
         """
         Удалить PDF файл из базы знаний
@@ -572,6 +601,7 @@ class KnowledgeBaseManager:
             logger.error(f"Ошибка при удалении PDF из базы знаний: {e}")
             return False
 
+    @invalidates_query_cache
     def remove_pdf_by_id(self, doc_id):
         """
         Программный метод для удаления PDF файла по его ID без проверки прав администратора
@@ -786,6 +816,17 @@ class KnowledgeBaseManager:
         Returns:
             str: Объединенный релевантный контент для использования в запросе к GPT
         """
+        cache_key = ("text", normalize_query(query))
+        content = query_cache.get(cache_key, CACHE_MISS)
+        if content is not CACHE_MISS:
+            return content
+
+        content = self._find_content_for_query(query)
+        query_cache.set(cache_key, content)
+        return content
+
+    def _find_content_for_query(self, query):
+        """Поиск по ключевым словам для get_content_for_query, без кэша"""
         search_results = self.search_in_knowledge_base(query, limit=5)
 
         if not search_results:
@@ -832,6 +873,7 @@ class KnowledgeBaseManager:
             logger.error(f"Ошибка при получении контента страницы: {e}")
             return None
 
+    @invalidates_query_cache
     def add_document_to_knowledge_base(self, file_path, title):
         """
         Добавить PDF файл в базу знаний (новый интерфейс)
@@ -917,49 +959,37 @@ class KnowledgeBaseManager:
                     'error': f"Не удалось извлечь текст из файла {filename}"
                 }
 
-            # Добавляем информацию о документе в БД
+            # Добавляем информацию о документе и контент страниц в БД одной транзакцией:
+            # метод выполняется в потоке (asyncio.to_thread), и параллельные запросы
+            # не должны видеть документ без страниц
             current_time = time.strftime('%Y-%m-%d %H:%M:%S')
-            result = self.db_manager.execute_query(
-                """
-                INSERT INTO knowledge_base_docs
-                (filename, title, upload_date, file_path, num_pages, admin_id)
-                VALUES (?, ?, ?, ?, ?, ?)
-                """,
-                (filename, title, current_time, target_path, num_pages, 0)  # 0 = системная загрузка
-            )
-
-            if not result:
+            try:
+                with self.db_manager.transaction() as conn:
+                    doc_id = conn.execute(
+                        """
+                        INSERT INTO knowledge_base_docs
+                        (filename, title, upload_date, file_path, num_pages, admin_id)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                        """,
+                        (filename, title, current_time, target_path, num_pages, 0)  # 0 = системная загрузка
+                    ).lastrowid
+
+                    # Добавляем контент каждой страницы в БД
+                    conn.executemany(
+                        """
+                        INSERT INTO knowledge_base_content
+                        (doc_id, page_num, content)
+                        VALUES (?, ?, ?)
+                        """,
+                        [(doc_id, page_num, content) for page_num, content in pages_text.items()]
+                    )
+            except sqlite3.Error as e:
+                logger.error(f"Ошибка при добавлении документа {filename} в базу данных: {e}")
                 return {
                     'success': False, 
                     'error': f"Ошибка при добавлении документа {filename} в базу данных"
                 }
 
-            # Получаем ID добавленного документа
-            doc_id = self.db_manager.execute_query(
-                "SELECT doc_id FROM knowledge_base_docs WHERE filename = ?",
-                (filename,),
-                fetch=True
-            )
-
-            if not doc_id or not doc_id[0]:
-                return {
-                    'success': False, 
-                    'error': f"Не удалось получить ID для документа {filename}"
-                }
-
-            doc_id = doc_id[0][0]
-
-            # Добавляем контент каждой страницы в БД
-            for page_num, content in pages_text.items():
-                self.db_manager.execute_query(
-                    """
-                    INSERT INTO knowledge_base_content
-                    (doc_id, page_num, content)
-                    VALUES (?, ?, ?)
-                    """,
-                    (doc_id, page_num, content)
-                )
-
             logger.info(f"PDF файл {filename} успешно добавлен в базу знаний с ID {doc_id}")
             
             return {
@@ -976,6 +1006,7 @@ class KnowledgeBaseManager:
                 'error': error_msg
             }
 
+    @invalidates_query_cache
     def delete_document_from_knowledge_base(self, doc_id):
         """
         Удалить PDF файл из базы знаний по ID документа
@@ -1004,17 +1035,16 @@ class KnowledgeBaseManager:
 
             file_path = doc_info[0][0]
 
-            # Удаляем контент документа
-            self.db_manager.execute_query(
-                "DELETE FROM knowledge_base_content WHERE doc_id = ?",
-                (doc_id,)
-            )
-
-            # Удаляем запись о документе
-            self.db_manager.execute_query(
-                "DELETE FROM knowledge_base_docs WHERE doc_id = ?",
-                (doc_id,)
-            )
+            # Удаляем контент и запись о документе одной транзакцией
+            with self.db_manager.transaction() as conn:
+                conn.execute(
+                    "DELETE FROM knowledge_base_content WHERE doc_id = ?",
+                    (doc_id,)
+                )
+                conn.execute(
+                    "DELETE FROM knowledge_base_docs WHERE doc_id = ?",
+                    (doc_id,)
+                )
 
             # НЕ удаляем файл физически с диска, просто логируем
             if os.path.exists(file_path):
@@ -7,6 +7,7 @@ import json
 import logging
 import tempfile
 import pickle
+import threading
 from pathlib import Path
 import numpy as np
 from typing import List, Dict, Tuple, Optional, Any, Union
@@ -21,10 +22,28 @@ from langchain_community.document_loaders import PyPDFLoader
 # Импорты проекта
 from bot.config import config
 from bot.database import DBManager
-from bot.knowledge_base.kb_manager import KnowledgeBaseManager
+from bot.knowledge_base.kb_manager import (
+    CACHE_MISS, KnowledgeBaseManager, invalidates_query_cache, normalize_query, query_cache
+)
 
 logger = logging.getLogger(__name__)
 
+# Общий экземпляр для обработчиков (см. get_vector_kb_manager)
+_instance = None
+_instance_lock = threading.Lock()
+
+def get_vector_kb_manager():
+    """
+    Возвращает общий VectorKnowledgeBaseManager, создавая его при первом вызове.
+    Загрузка FAISS-индекса и клиента embeddings выполняется один раз за время работы бота
+    """
+    global _instance
+    if _instance is None:
+        with _instance_lock:
+            if _instance is None:
+                _instance = VectorKnowledgeBaseManager()
+    return _instance
+
 class VectorKnowledgeBaseManager:
     """
     Улучшенный менеджер базы знаний с использованием векторных embeddings
@@ -136,6 +155,7 @@ class VectorKnowledgeBaseManager:
             logger.error(f"Ошибка при сохранении векторного индекса: {e}")
             return False
 
+    @invalidates_query_cache
     def load_pdf_directly(self, pdf_path: str, title: Optional[str] = None) -> Tuple[bool, str]:
         """
         Загрузить PDF файл в базу знаний и векторное хранилище
@@ -193,6 +213,7 @@ class VectorKnowledgeBaseManager:
             # то всё равно считаем операцию успешной
             return True, doc_id
 
+    @invalidates_query_cache
     def remove_pdf_by_id(self, doc_id: Union[int, str]) -> Tuple[bool, str]:
         """
         Удалить PDF файл из обычной базы знаний и векторного хранилища
@@ -264,13 +285,22 @@ class VectorKnowledgeBaseManager:
         """
         # Проверяем возможность использования векторного поиска
         if use_vector_search and self.vector_store is not None and self.embeddings is not None:
+            # Результат обычного поиска кэширует сам kb_manager, здесь кэшируется векторный.
+            # Ошибка векторного поиска (например, сбой API embeddings) не кэшируется
+            cache_key = ("vector", normalize_query(query))
+            content = query_cache.get(cache_key, CACHE_MISS)
+            if content is not CACHE_MISS:
+                return content
+
             try:
                 # Выполняем векторный поиск
                 docs_with_scores = self.vector_store.similarity_search_with_score(query, k=5)
 
                 if not docs_with_scores:
                     logger.info("Векторный поиск не дал результатов, используем обычный поиск")
-                    return self.kb_manager.get_content_for_query(query)
+                    content = self.kb_manager.get_content_for_query(query)
+                    query_cache.set(cache_key, content)
+                    return content
 
                 # Фильтруем документы с низким сходством (порог можно настроить)
                 threshold = 0.7  # Порог сходства (1.0 - точное совпадение)
@@ -281,7 +311,9 @@ class VectorKnowledgeBaseManager:
 
                 if not filtered_docs:
                     logger.info("Все найденные документы ниже порога сходства, используем обычный поиск")
-                    return self.kb_manager.get_content_for_query(query)
+                    content = self.kb_manager.get_content_for_query(query)
+                    query_cache.set(cache_key, content)
+                    return content
 
                 # Формируем результат
                 relevant_content = []
@@ -294,7 +326,9 @@ class VectorKnowledgeBaseManager:
                         f"Документ: {title} (ID: {doc_id}, Страница: {page_num}, Релевантность: {1.0 - score:.2f})\n\n{doc.page_content}"
                     )
 
-                return "\n\n---\n\n".join(relevant_content)
+                content = "\n\n---\n\n".join(relevant_content)
+                query_cache.set(cache_key, content)
+                return content
 
             except Exception as e:
                 logger.error(f"Ошибка при выполнении векторного поиска: {e}")
@@ -370,6 +404,7 @@ class VectorKnowledgeBaseManager:
             # Если векторный поиск недоступен или отключен, используем обычный поиск
             return self.kb_manager.search_in_knowledge_base(query, limit)
 
+    @invalidates_query_cache
     def add_document_to_knowledge_base(self, pdf_path, title=None):
         """
         Добавить PDF файл в базу знаний и обновить векторный индекс
@@ -434,6 +469,7 @@ class VectorKnowledgeBaseManager:
                 'error': error_msg
             }
 
+    @invalidates_query_cache
     def delete_document_from_knowledge_base(self, doc_id):
         """
         Удалить документ из базы знаний и обновить векторный индекс
@@ -512,6 +548,7 @@ class VectorKnowledgeBaseManager:
                 'error': error_msg
             }
 
+    @invalidates_query_cache
     def rebuild_index(self):
         """
         Полное пересоздание векторного индекса для всех документов в базе знаний.
@@ -1,9 +1,16 @@
 from bot.utils.text_utils import remove_asterisks, split_message, split_response_into_sections
-from bot.utils.ai_client import generate_gpt_response
+from bot.utils.ai_client import generate_gpt_response, stream_gpt_response
+from bot.utils.rate_limiter import RateLimiter, KeyedRateLimiter, chat_limiter
+from bot.utils.ttl_cache import TTLCache
 
 __all__ = [
     'remove_asterisks',
     'split_message',
     'split_response_into_sections',
-    'generate_gpt_response'
+    'generate_gpt_response',
+    'stream_gpt_response',
+    'RateLimiter',
+    'KeyedRateLimiter',
+    'chat_limiter',
+    'TTLCache'
 ]
@@ -8,19 +8,35 @@ from bot.config import config
 
 logger = logging.getLogger(__name__)
 
+# Один клиент OpenAI на весь процесс: пул соединений httpx переиспользуется,
+# и запросы к GPT не начинаются с нового TCP+TLS соединения
+_client = None
+
 def get_ai_client():
-    """Initialize and return an OpenAI client"""
+    """Initialize (once) and return the shared OpenAI client"""
+    global _client
+    if _client is not None:
+        return _client
     try:
-        client = AsyncOpenAI(
+        _client = AsyncOpenAI(
             api_key=config.OPENAI_API_KEY,
-            http_client=httpx.AsyncClient()
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=config.OPENAI_CONNECTION_LIMIT)
+            )
         )
-        return client
+        return _client
     except Exception as e:
         logger.error(f"Error initializing OpenAI client: {e}")
         raise
 
-async def generate_gpt_response(messages, model=None, max_tokens=None, temperature=None):
+async def close_ai_client():
+    """Закрывает общий клиент OpenAI и его соединения (при остановке бота)"""
+    global _client
+    if _client is not None:
+        await _client.close()
+        _client = None
+
+async def generate_gpt_response(messages, model=None, max_tokens=None, temperature=None, response_format=None):
     """
     Generate a response from the GPT model
 
@@ -29,6 +45,7 @@ async def generate_gpt_response(messages, model=None, max_tokens=None, temperatu
         model (str, optional): The model to use. Defaults to config.GPT_MODEL.
         max_tokens (int, optional): Maximum tokens to generate. Defaults to config.GPT_MAX_TOKENS.
         temperature (float, optional): Sampling temperature. Defaults to config.GPT_TEMP.
+        response_format (dict, optional): Формат ответа, например {"type": "json_object"}.
 
     Returns:
         str: The generated response text
@@ -37,15 +54,50 @@ async def generate_gpt_response(messages, model=None, max_tokens=None, temperatu
     model = model or config.GPT_MODEL
     max_tokens = max_tokens or config.GPT_MAX_TOKENS
     temperature = temperature or config.GPT_TEMP
+    # response_format передаем только если он задан
+    extra_args = {"response_format": response_format} if response_format else {}
 
     try:
         response = await client.chat.completions.create(
             model=model,
             messages=messages,
             max_tokens=max_tokens,
-            temperature=temperature
+            temperature=temperature,
+            **extra_args
         )
         return response.choices[0].message.content
     except Exception as e:
         logger.error(f"Error generating GPT response: {e}")
         raise
+
+async def stream_gpt_response(messages, model=None, max_tokens=None, temperature=None, response_format=None):
+    """
+    Generate a response from the GPT model as a stream of text fragments
+
+    Args:
+        Те же, что у generate_gpt_response
+
+    Yields:
+        str: The next fragment of the generated text
+    """
+    client = get_ai_client()
+    model = model or config.GPT_MODEL
+    max_tokens = max_tokens or config.GPT_MAX_TOKENS
+    temperature = temperature or config.GPT_TEMP
+    extra_args = {"response_format": response_format} if response_format else {}
+
+    try:
+        stream = await client.chat.completions.create(
+            model=model,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            stream=True,
+            **extra_args
+        )
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+    except Exception as e:
+        logger.error(f"Error streaming GPT response: {e}")
+        raise
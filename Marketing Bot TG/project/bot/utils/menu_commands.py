@@ -21,6 +21,7 @@ BOT_COMMANDS = [
 ADMIN_COMMANDS = BOT_COMMANDS + [
     BotCommand(command="stats", description="Статистика использования бота"),
     BotCommand(command="broadcast", description="Отправить сообщение всем пользователям"),
+    BotCommand(command="resume_broadcast", description="Продолжить прерванную рассылку"),
 ]
 
 async def set_bot_commands(bot: Bot, admin_ids=None):
@@ -0,0 +1,83 @@
+"""
+Ограничитель частоты запросов (token bucket) для Telegram Bot API
+"""
+import asyncio
+import time
+
+
+class RateLimiter:
+    """
+    Token bucket: не больше rate операций за period секунд.
+    Токены копятся непрерывно, поэтому отправка идет ровно на пределе, без пауз
+    между пачками. Использование: `async with limiter:` перед каждым запросом
+    """
+
+    def __init__(self, rate, period=1.0):
+        self.rate = rate
+        self.period = period
+        self._tokens = float(rate)
+        self._updated = time.monotonic()
+        # Очередь ожидающих: токены выдаются по порядку обращения
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Ждет, пока в корзине появится токен, и забирает его"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.rate,
+                    self._tokens + (now - self._updated) * self.rate / self.period
+                )
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                # Спим ровно до появления следующего токена
+                await asyncio.sleep((1 - self._tokens) * self.period / self.rate)
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
+
+
+class KeyedRateLimiter:
+    """
+    Отдельный RateLimiter для каждого ключа (например, chat_id).
+    Использование: `async with limiter(chat_id):`
+    """
+
+    # При таком числе ключей из словаря удаляются корзины, которые успели наполниться
+    MAX_KEYS = 10000
+
+    def __init__(self, rate, period=1.0):
+        self.rate = rate
+        self.period = period
+        self._limiters = {}
+
+    def __call__(self, key):
+        limiter = self._limiters.get(key)
+        if limiter is None:
+            if len(self._limiters) >= self.MAX_KEYS:
+                self._prune()
+            limiter = self._limiters[key] = RateLimiter(self.rate, self.period)
+        return limiter
+
+    def _prune(self):
+        """Удаляет корзины, неиспользуемые дольше period: они уже полные и равны новым"""
+        now = time.monotonic()
+        for key, limiter in list(self._limiters.items()):
+            if now - limiter._updated >= self.period and not limiter._lock.locked():
+                del self._limiters[key]
+
+
+# Лимит Telegram на сообщения в один чат: не больше 20 в минуту (для групп),
+# короткая серия до 20 сообщений уходит без ожидания
+CHAT_RATE_LIMIT = 20
+CHAT_RATE_PERIOD = 60
+
+# Общий для всех обработчиков, отправляющих несколько сообщений подряд в один чат
+chat_limiter = KeyedRateLimiter(CHAT_RATE_LIMIT, CHAT_RATE_PERIOD)
@@ -3,13 +3,18 @@ Utility functions for text processing
 """
 import re
 
+# Пары звездочек markdown (*, **, ***) вокруг текста
+_ASTERISKS_RE = re.compile(r'\*{1,3}(.*?)\*{1,3}')
+
 def remove_asterisks(text):
     """
     Remove asterisks often used for text formatting in markdown
     """
+    # Большинство ответов без звездочек: проверка подстроки дешевле прохода регулярным выражением
+    if '*' not in text:
+        return text
     # Remove asterisks patterns (*, **, ***)
-    cleaned_text = re.sub(r'\*{1,3}(.*?)\*{1,3}', r'\1', text)
-    return cleaned_text
+    return _ASTERISKS_RE.sub(r'\1', text)
 
 def split_message(text, max_length=4000):
     """
@@ -18,52 +23,42 @@ def split_message(text, max_length=4000):
     if len(text) <= max_length:
         return [text]
 
-    # Find suitable break points (paragraphs)
+    # Find suitable break points (paragraphs).
+    # Поиск идет по индексам в исходной строке: без копирования остатка текста на каждой части
     parts = []
-    while text:
-        if len(text) <= max_length:
-            parts.append(text)
-            break
-
+    start = 0
+    while len(text) - start > max_length:
+        end = start + max_length
         # Try to find a newline character before the max_length
-        cutoff = text[:max_length].rfind('\n')
+        cutoff = text.rfind('\n', start, end)
         if cutoff == -1:  # If no newline, try space
-            cutoff = text[:max_length].rfind(' ')
+            cutoff = text.rfind(' ', start, end)
         if cutoff == -1:  # If no space, force break
-            cutoff = max_length - 1
+            cutoff = end - 1
 
-        parts.append(text[:cutoff + 1])
-        text = text[cutoff + 1:]
+        parts.append(text[start:cutoff + 1])
+        start = cutoff + 1
 
+    parts.append(text[start:])
     return parts
 
+# Заголовок нумерованного раздела ("1. ...")
+_SECTION_HEADING_RE = re.compile(r'\d+\.\s+[^\n]+')
+
 def split_response_into_sections(response):
     """
     Split a response into logical sections based on numbers (1., 2., etc.)
     """
-    # Find section headings (numbered points)
-    pattern = r'(\d+\.\s+[^\n]+)'
-    matches = re.finditer(pattern, response)
-
-    section_positions = []
-    for match in matches:
-        section_positions.append(match.start())
-
-    # Add end of string position
-    section_positions.append(len(response))
-
-    sections = []
-    for i in range(len(section_positions) - 1):
-        start = section_positions[i]
-        end = section_positions[i + 1]
-        section_text = response[start:end].strip()
-        sections.append(section_text)
+    # Find section headings (numbered points); each section runs to the next heading
+    matches = list(_SECTION_HEADING_RE.finditer(response))
+    sections = [response[a.start():b.start()].strip() for a, b in zip(matches, matches[1:])]
+    if matches:
+        sections.append(response[matches[-1].start():].strip())
 
-    # Check for text before the first section
-    if section_positions and section_positions[0] > 0:
-        intro = response[:section_positions[0]].strip()
-        if intro:
-            sections.insert(0, intro)
+    # Check for text before the first section (without headings - the whole text)
+    intro = response[:matches[0].start() if matches else len(response)].strip()
+    if intro:
+        sections.insert(0, intro)
 
     return sections
 
@@ -0,0 +1,56 @@
+"""
+Ограниченный по размеру кэш со временем жизни записей (LRU + TTL)
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    Кэш не больше maxsize записей, каждая живет ttl секунд.
+    При переполнении вытесняется запись, которую дольше всех не читали.
+    Потокобезопасен: используется и из asyncio.to_thread
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # {key: (value, expires_at по time.monotonic())}, порядок - от давно использованных к недавним
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Возвращает значение или default, если записи нет или она истекла"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            if entry[1] <= time.monotonic():
+                # Истекшая запись удаляется при чтении
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value):
+        """Сохраняет значение, при переполнении вытесняет самую старую запись"""
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """Удаляет запись и возвращает ее значение"""
+        with self._lock:
+            entry = self._data.pop(key, None)
+            return default if entry is None else entry[0]
+
+    def clear(self):
+        """Удаляет все записи"""
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
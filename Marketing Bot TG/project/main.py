@@ -3,18 +3,23 @@
 Main entry point for the Telegram bot
 """
 import asyncio
+import atexit
 import logging
+import logging.handlers
+import queue
 import sys
 import os
 import nest_asyncio
 from aiogram import Bot, Dispatcher
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.enums import ParseMode
 # Комментируем этот импорт, так как он не найден
 # from aiogram.client.default import DefaultBotProperties
 from bot.config import config
 from bot.handlers import register_handlers
 from bot.utils.menu_commands import set_bot_commands, set_menu_button
-from bot.knowledge_base.vector_kb_manager import VectorKnowledgeBaseManager
+from bot.utils.ai_client import close_ai_client
+from bot.knowledge_base.vector_kb_manager import get_vector_kb_manager
 from bot.database import DBManager
 from bot.database.async_db_manager import AsyncDBManager
 from pathlib import Path
@@ -26,6 +31,16 @@ logging.basicConfig(
     stream=sys.stdout
 )
 
+# Обработчики только кладут записи в очередь, вывод выполняет отдельный поток
+# QueueListener: запись в stdout не блокирует цикл событий
+_log_queue = queue.SimpleQueue()
+_root_logger = logging.getLogger()
+_log_listener = logging.handlers.QueueListener(_log_queue, *_root_logger.handlers, respect_handler_level=True)
+_root_logger.handlers = [logging.handlers.QueueHandler(_log_queue)]
+_log_listener.start()
+# При выходе поток дописывает оставшиеся в очереди записи
+atexit.register(_log_listener.stop)
+
 # Apply nest_asyncio for Google Colab compatibility
 nest_asyncio.apply()
 
@@ -55,9 +70,11 @@ def load_knowledge_base():
         
         # Инициализация менеджеров
         # Примечание: Для базы знаний пока используем старый DBManager, 
-        # так как VectorKnowledgeBaseManager не адаптирован для асинхронного доступа
+        # так как VectorKnowledgeBaseManager не адаптирован для асинхронного доступа.
+        # Векторный менеджер - общий экземпляр обработчиков: rebuild_index обновляет
+        # его vector_store, и обработчики сразу работают с новым индексом
         db_manager = DBManager()
-        vector_kb_manager = VectorKnowledgeBaseManager(db_manager)
+        vector_kb_manager = get_vector_kb_manager()
         
         # Очищаем существующие записи из БД, но НЕ удаляем физические файлы
         # Вместо удаления через manager, удаляем напрямую из базы данных
@@ -72,6 +89,8 @@ def load_knowledge_base():
             import shutil
             shutil.rmtree(vector_index_path, ignore_errors=True)
             logging.info(f"Удален существующий векторный индекс: {vector_index_path}")
+        # Загруженный в память индекс ссылается на только что удаленные документы
+        vector_kb_manager.vector_store = None
         
         # Загружаем документ напрямую
         result = vector_kb_manager.kb_manager.load_document_directly(file_path, title)
@@ -99,8 +118,11 @@ async def main():
     # Загружаем документ в базу знаний при запуске
     load_knowledge_base()
     
-    # Initialize bot and dispatcher
-    bot = Bot(token=config.TELEGRAM_TOKEN, parse_mode=ParseMode.HTML)
+    # Initialize bot and dispatcher.
+    # Одна сессия aiohttp на все запросы бота: соединения с api.telegram.org
+    # переиспользуются, пула хватает на все воркеры рассылки
+    session = AiohttpSession(limit=config.TELEGRAM_CONNECTION_LIMIT)
+    bot = Bot(token=config.TELEGRAM_TOKEN, session=session, parse_mode=ParseMode.HTML)
     dp = Dispatcher()
 
     # Set up commands in bot menu
@@ -117,8 +139,12 @@ async def main():
         logging.info("Starting bot")
         await dp.start_polling(bot, close_timeout=5, allowed_updates=["message", "callback_query", "inline_query"], drop_pending_updates=True)
     finally:
-        # Закрываем соединение с базой данных при завершении работы
+        # Закрываем HTTP-сессии и соединение с базой данных при завершении работы
+        await bot.session.close()
+        await close_ai_client()
         await async_db.close()
+        # Синхронный менеджер дописывает очередь фонового писателя и выполняет PRAGMA optimize
+        DBManager().close()
         logging.info("Соединение с базой данных закрыто")
 
 if __name__ == "__main__":